@@ -0,0 +1,236 @@
+import csv
+import os
+import sqlite3
+
+import matplotlib.pyplot as plt
+from matplotlib.backend_bases import MouseButton
+
+from schema import (
+    SCHEMA_VERSION,
+    bump_generation,
+    create_schema,
+    get_schema_version,
+    is_empty_database,
+    set_schema_version,
+)
+from zones import get_zone_bounds
+
+# Zones drawn on the floorplan: a rectangle is drawn with two clicks, then its
+# name is typed into the figure and Enter saves it (Escape cancels). The
+# rectangle following the mouse and the name being typed are animated artists
+# blitted over a saved background, so the figure is only redrawn in full when
+# zoomed or resized, however dense the plot below. Every saved zone is
+# appended to the zones CSV read by ingest_trajectory.insert_zones and/or
+# inserted into the zones table and R-tree of a database right away.
+
+# the header pandas.DataFrame.to_csv wrote for the zones CSV
+ZONES_CSV_HEADER = ["", "0", "1", "2", "3", "4"]
+
+
+def count_csv_zones(csv_path):
+    if not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0:
+        return 0
+    with open(csv_path, newline="") as csv_file:
+        return max(sum(1 for _ in csv.reader(csv_file)) - 1, 0)
+
+
+def append_zone_csv(csv_path, index, zone):
+    # zone is x, y, w, h and name in plot coordinates
+    is_new_file = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+    with open(csv_path, "a", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        if is_new_file:
+            csv_writer.writerow(ZONES_CSV_HEADER)
+        csv_writer.writerow([index, *zone])
+
+
+def open_zones_database(db_path):
+    con = sqlite3.connect(db_path)
+    cur = con.cursor()
+    if not is_empty_database(cur) and get_schema_version(cur) < SCHEMA_VERSION:
+        raise RuntimeError(
+            f"{db_path} has schema version {get_schema_version(cur)}, "
+            f"upgrade it to {SCHEMA_VERSION} with python migrate_db.py {db_path}"
+        )
+    create_schema(cur)
+    set_schema_version(cur, SCHEMA_VERSION)
+    con.commit()
+    return con
+
+
+def insert_zone(con, bounds, name):
+    # One transaction per zone. Trajectory rows ingested before keep their
+    # zone_id, the zone applies to shifts ingested after it.
+    x_min, x_max, y_min, y_max = [float(value) for value in bounds]
+    with con:
+        cur = con.cursor()
+        cur.execute(
+            "INSERT INTO zones(x_min, x_max, y_min, y_max, name) VALUES (?, ?, ?, ?, ?)",
+            (x_min, x_max, y_min, y_max, name),
+        )
+        zone_id = cur.lastrowid
+        cur.execute(
+            "INSERT INTO zones_rtree(id, x_min, x_max, y_min, y_max) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (zone_id, x_min, x_max, y_min, y_max),
+        )
+        bump_generation(cur)
+    return zone_id
+
+
+class ZoneAnnotator:
+    def __init__(
+        self, ax, csv_path=None, con=None, meter_to_unit=1, floorplan_height=None
+    ):
+        self.ax = ax
+        self.canvas = ax.figure.canvas
+        self.csv_path = csv_path
+        self.con = con
+        self.meter_to_unit = meter_to_unit
+        self.floorplan_height = floorplan_height
+        self.zones_count = 0 if csv_path is None else count_csv_zones(csv_path)
+        self.first_corner = None
+        # x, y, w, h of the rectangle being named
+        self.pending_zone = None
+        self.name = ""
+        self.suspended_keymaps = {}
+        self.background = None
+        self.rectangle = plt.Rectangle(
+            (0, 0), 0, 0, fill=False, linestyle="--", animated=True, visible=False
+        )
+        ax.add_patch(self.rectangle)
+        self.label = ax.text(
+            0, 0, "", fontsize=8, backgroundcolor="w", animated=True, visible=False
+        )
+        # the saved zones must not change the view
+        ax.set_autoscale_on(False)
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+        self.canvas.mpl_connect("button_press_event", self.on_press)
+        self.canvas.mpl_connect("motion_notify_event", self.on_motion)
+        self.canvas.mpl_connect("key_press_event", self.on_key)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.rectangle)
+        self.ax.draw_artist(self.label)
+
+    def blit(self):
+        if self.background is None or not self.canvas.supports_blit:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.rectangle)
+        self.ax.draw_artist(self.label)
+        self.canvas.blit(self.ax.bbox)
+
+    def is_navigating(self):
+        toolbar = self.canvas.toolbar
+        return toolbar is not None and toolbar.mode != ""
+
+    def on_press(self, event):
+        if (
+            event.inaxes is not self.ax
+            or event.button is not MouseButton.LEFT
+            or self.is_navigating()
+        ):
+            return
+        if self.pending_zone is not None:
+            print("Type the name of the zone and press Enter, or Escape to cancel")
+            return
+        if self.first_corner is None:
+            self.first_corner = (event.xdata, event.ydata)
+            self.rectangle.set_bounds(event.xdata, event.ydata, 0, 0)
+            self.rectangle.set_visible(True)
+            self.blit()
+            return
+        lx = min(event.xdata, self.first_corner[0])
+        ly = min(event.ydata, self.first_corner[1])
+        w = abs(event.xdata - self.first_corner[0])
+        h = abs(event.ydata - self.first_corner[1])
+        self.first_corner = None
+        if w == 0 or h == 0:
+            self.rectangle.set_visible(False)
+            self.blit()
+            return
+        self.rectangle.set_bounds(lx, ly, w, h)
+        self.pending_zone = (lx, ly, w, h)
+        self.name = ""
+        # typing the name must not trigger the key bindings of matplotlib
+        self.suspended_keymaps = {
+            key: plt.rcParams[key] for key in plt.rcParams if key.startswith("keymap.")
+        }
+        for key in self.suspended_keymaps:
+            plt.rcParams[key] = []
+        self.label.set_position((lx, ly))
+        self.label.set_text("Name: _")
+        self.label.set_visible(True)
+        print(f"Zone ({lx}, {ly}), {w} {h}: type its name and press Enter")
+        self.blit()
+
+    def on_motion(self, event):
+        if (
+            self.first_corner is None
+            or self.pending_zone is not None
+            or event.inaxes is not self.ax
+        ):
+            return
+        self.rectangle.set_bounds(
+            self.first_corner[0],
+            self.first_corner[1],
+            event.xdata - self.first_corner[0],
+            event.ydata - self.first_corner[1],
+        )
+        self.blit()
+
+    def on_key(self, event):
+        if self.pending_zone is None:
+            if event.key == "escape" and self.first_corner is not None:
+                self.first_corner = None
+                self.rectangle.set_visible(False)
+                self.blit()
+            return
+        if event.key == "enter":
+            if self.name.strip() != "":
+                self.save_zone(self.name.strip())
+                self.finish_naming()
+            return
+        if event.key == "escape":
+            self.finish_naming()
+            return
+        if event.key == "backspace":
+            self.name = self.name[:-1]
+        elif event.key is not None and len(event.key) == 1:
+            self.name += event.key
+        self.label.set_text(f"Name: {self.name}_")
+        self.blit()
+
+    def finish_naming(self):
+        self.pending_zone = None
+        self.rectangle.set_visible(False)
+        self.label.set_visible(False)
+        plt.rcParams.update(self.suspended_keymaps)
+        self.suspended_keymaps = {}
+        self.blit()
+
+    def save_zone(self, name):
+        lx, ly, w, h = self.pending_zone
+        if self.csv_path is not None:
+            append_zone_csv(self.csv_path, self.zones_count, (lx, ly, w, h, name))
+        if self.con is not None:
+            insert_zone(
+                self.con,
+                get_zone_bounds(
+                    lx, ly, w, h, self.meter_to_unit, self.floorplan_height
+                ),
+                name,
+            )
+        self.zones_count += 1
+        print(f"Saved zone {name} ({lx}, {ly}), {w} {h}")
+        # drawn once into the background instead of redrawing the figure
+        patch = self.ax.add_patch(plt.Rectangle((lx, ly), w, h, fill=False))
+        text = self.ax.text(lx, ly, name, fontsize=8, clip_on=True)
+        if self.background is not None and self.canvas.supports_blit:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(patch)
+            self.ax.draw_artist(text)
+            self.background = self.canvas.copy_from_bbox(self.ax.bbox)
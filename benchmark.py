@@ -0,0 +1,410 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas
+
+import util
+from db_util import BulkWriter, update_statistics
+from downsampling import parse_downsampling
+from ingest_trajectory import insert_activity, insert_stops, insert_trajectory
+from proximity import update_proximity
+from rollups import insert_shift, update_rollups
+from schema import SCHEMA_VERSION, create_schema, set_schema_version
+from segmentation import STATIC_VELOCITY_M_S
+from synthetic_data import (
+    generate_zones,
+    get_shift_start_ns,
+    write_shift_csv,
+)
+from shift_cache import read_cached_shift_chunks, write_shift_cache
+from zone_visits import get_zone_visits, insert_zone_visits
+from zones import fill_zones_rtree, get_zone_ids, load_zones
+
+# Times the ingest and query paths on synthetic shifts of 1x, 10x and 100x the
+# length of a shift and writes the results as JSON. Given the JSON of an
+# earlier run, steps slower by more than the tolerance are reported and the
+# exit code is 1.
+
+TIME_SUBSAMPLING_RATE = 15
+MIN_TIME_INTERVAL_NS = 600 * 1e9
+FORKLIFT_ID = 1
+FOLLOWER_LAG_NS = 10 * 10**9
+
+# representative analytical queries, :start_ns and :end_ns are the first hour
+# of the data
+QUERIES = {
+    "trajectory_window": "SELECT count(*), avg(velocity_meters_per_second) "
+    "FROM trajectory WHERE forklift_id = :forklift_id "
+    "AND time_ns >= :start_ns AND time_ns < :end_ns",
+    "trajectory_hourly_max_velocity": "SELECT time_ns / 3600000000000, "
+    "max(velocity_meters_per_second) FROM trajectory "
+    "WHERE forklift_id = :forklift_id GROUP BY 1",
+    "zone_samples": "SELECT zone, count(*) FROM trajectory_zones "
+    "WHERE forklift_id = :forklift_id GROUP BY zone",
+    "zone_window": "SELECT count(*) FROM trajectory_zones WHERE zone = 'Zone-6' "
+    "AND time_ns >= :start_ns AND time_ns < :end_ns",
+    "zone_visits": "SELECT count(*), sum(duration_s) FROM zone_visits "
+    "WHERE zone_id = (SELECT id FROM zones WHERE name = 'Zone-6') "
+    "AND enter_ns >= :start_ns AND enter_ns < :end_ns",
+    "proximity_events": "SELECT count(*), min(min_distance_m) FROM proximity_events "
+    "WHERE forklift_id = :forklift_id AND start_ns >= :start_ns "
+    "AND start_ns < :end_ns",
+    "zone_congestion": "SELECT zone_id, max(max_forklifts), sum(congested_seconds) "
+    "FROM zone_congestion WHERE hour_start_ns > :start_ns - 3600000000000 "
+    "AND hour_start_ns < :end_ns GROUP BY zone_id",
+    "long_stops": "SELECT count(*), avg(end_ns - start_ns) / 1e9 FROM stops "
+    "WHERE forklift_id = :forklift_id AND end_ns - start_ns > 60000000000",
+    "active_time": "SELECT sum(min(end_ns, :end_ns) - max(start_ns, :start_ns)) / 1e9 "
+    "FROM activity WHERE forklift_id = :forklift_id "
+    "AND start_ns < :end_ns AND end_ns > :start_ns",
+    "hour_rollups": "SELECT hour_start, active_seconds, distance_m "
+    "FROM rollup_forklift_hour_readable WHERE forklift_id = :forklift_id "
+    "ORDER BY hour_start_ns",
+    "shift_rollups": "SELECT forklift_id, shift_type, sum(active_seconds), "
+    "sum(distance_m) FROM rollup_forklift_shift GROUP BY 1, 2",
+    "point_zones": "SELECT zones.name FROM zones_rtree "
+    "JOIN zones ON zones.id = zones_rtree.id "
+    "WHERE zones_rtree.x_min <= 60 AND zones_rtree.x_max >= 60 "
+    "AND zones_rtree.y_min <= 120 AND zones_rtree.y_max >= 120",
+}
+
+
+def time_call(function, repeat=1):
+    # the result of the last call and the seconds of every call
+    seconds = []
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - time_start)
+    return result, seconds
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "numpy": np.__version__,
+        "pandas": pandas.__version__,
+        "sqlite": sqlite3.sqlite_version,
+        "schema_version": SCHEMA_VERSION,
+    }
+
+
+def benchmark_scale(scale, args, work_dir):
+    results = []
+
+    def record(name, seconds, rows):
+        median = statistics.median(seconds)
+        result = {
+            "scale": scale,
+            "name": name,
+            "rows": int(rows),
+            "seconds": seconds,
+            "min_seconds": min(seconds),
+            "median_seconds": median,
+            "rows_per_second": rows / median if median > 0 else None,
+        }
+        results.append(result)
+        print(
+            f"{scale}x {name}: {median:.4f} s for {rows} rows "
+            f"({result['rows_per_second'] or float('inf'):.0f} rows/s)"
+        )
+
+    csv_path = os.path.join(work_dir, f"shift_{scale}x.csv")
+    start_ns = get_shift_start_ns(args.date, "day")
+    poses_count, seconds = time_call(
+        lambda: write_shift_csv(
+            csv_path,
+            start_ns,
+            duration_s=scale * args.hours * 3600,
+            pose_rate_hz=args.pose_rate,
+            gaps_count=5 * scale,
+            frame_switches_count=4 * scale,
+            seed=args.seed,
+        )
+    )
+    record("generate_csv", seconds, poses_count)
+
+    # ingest path
+    df, seconds = time_call(
+        lambda: pandas.read_csv(
+            csv_path,
+            usecols=list(util.SHIFT_CSV_DTYPES.keys()),
+            dtype=util.SHIFT_CSV_DTYPES,
+        )
+    )
+    record("read_csv", seconds, poses_count)
+    (velocities_abs, headings, velocity_timestamps, data_mask), seconds = time_call(
+        lambda: util.get_velocities(df, TIME_SUBSAMPLING_RATE), args.repeat
+    )
+    record("get_velocities", seconds, poses_count)
+    velocity_chunks, seconds = time_call(
+        lambda: util.concatenate_velocity_chunks(
+            util.get_velocities_chunked(
+                util.read_shift_csv_frames(csv_path, args.chunk_size),
+                args.downsampling,
+            )
+        )
+    )
+    record("read_csv_get_velocities_chunked", seconds, poses_count)
+    cache_dir = os.path.join(work_dir, "shift_cache")
+    _, seconds = time_call(
+        lambda: write_shift_cache(
+            csv_path, os.path.join(cache_dir, f"{scale}x"), args.chunk_size
+        )
+    )
+    record("write_shift_cache", seconds, poses_count)
+    _, seconds = time_call(
+        lambda: util.concatenate_velocity_chunks(
+            util.get_velocities_chunked(
+                read_cached_shift_chunks(
+                    os.path.join(cache_dir, f"{scale}x"), args.chunk_size
+                ),
+                args.downsampling,
+            )
+        ),
+        args.repeat,
+    )
+    record("read_cache_get_velocities_chunked", seconds, poses_count)
+    _, _, _, pose_timestamps, coordinates, fid_world_mask, durations_s = velocity_chunks
+
+    activity_timestamps = velocity_timestamps[velocities_abs >= STATIC_VELOCITY_M_S]
+    # local datetimes, as util.get_shift_time returns them
+    shift_start = datetime.datetime.fromtimestamp(start_ns // 10**9)
+    shift_end = datetime.datetime.fromtimestamp(velocity_timestamps.max() // 10**9 + 1)
+    time_periods, seconds = time_call(
+        lambda: util.get_activity_periods(
+            MIN_TIME_INTERVAL_NS, shift_start, shift_end, activity_timestamps
+        ),
+        args.repeat,
+    )
+    record("get_activity_periods", seconds, len(activity_timestamps))
+    stop_records, seconds = time_call(
+        lambda: util.get_stopping_locations(
+            df, data_mask, velocities_abs, STATIC_VELOCITY_M_S
+        ),
+        args.repeat,
+    )
+    record("get_stopping_locations", seconds, len(velocities_abs))
+    stop_records = tuple(np.array(values) for values in zip(*stop_records))
+    if len(stop_records) == 0:
+        stop_records = (np.zeros(0, dtype=np.int64),) * 2 + (np.zeros(0),) * 2
+    df = None
+
+    velocities_abs, headings, velocity_timestamps = [
+        values[fid_world_mask] for values in velocity_chunks[:3]
+    ]
+    coordinates = coordinates[fid_world_mask]
+    durations_s = durations_s[fid_world_mask]
+    print(
+        f"{scale}x {args.downsampling} keeps {len(velocity_timestamps)} "
+        f"of {poses_count} poses"
+    )
+
+    db_path = os.path.join(work_dir, f"benchmark_{scale}x.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    con = sqlite3.connect(db_path)
+    cur = con.cursor()
+    create_schema(cur)
+    set_schema_version(cur, SCHEMA_VERSION)
+    writer = BulkWriter(con, batch_size=args.batch_size, verbose=False)
+    with writer.transaction():
+        writer.insert(
+            "zones",
+            ["x_min", "x_max", "y_min", "y_max", "name"],
+            [np.array(values) for values in zip(*generate_zones())],
+        )
+        fill_zones_rtree(cur)
+
+    zone_ids, seconds = time_call(
+        lambda: get_zone_ids(coordinates, load_zones(cur)), args.repeat
+    )
+    record("get_zone_ids", seconds, len(coordinates))
+
+    def insert(function, *arguments):
+        with writer.transaction():
+            return function(FORKLIFT_ID, *arguments, writer)
+
+    _, seconds = time_call(lambda: insert(insert_activity, time_periods))
+    record("insert_activity", seconds, len(time_periods))
+    _, seconds = time_call(lambda: insert(insert_stops, stop_records))
+    record("insert_stops", seconds, len(stop_records[0]))
+    _, seconds = time_call(
+        lambda: insert(
+            insert_trajectory,
+            velocity_timestamps,
+            coordinates,
+            headings,
+            velocities_abs,
+            durations_s,
+            zone_ids,
+        )
+    )
+    record("insert_trajectory", seconds, len(velocity_timestamps))
+    zone_visits, seconds = time_call(
+        lambda: get_zone_visits(
+            velocity_timestamps, durations_s, coordinates, zone_ids, load_zones(cur)
+        ),
+        args.repeat,
+    )
+    record("get_zone_visits", seconds, len(velocity_timestamps))
+    _, seconds = time_call(lambda: insert(insert_zone_visits, zone_visits))
+    record("insert_zone_visits", seconds, len(zone_visits[0]))
+
+    data_start_ns = int(velocity_timestamps.min())
+    data_end_ns = int(velocity_timestamps.max()) + 1
+
+    def update():
+        with writer.transaction():
+            insert_shift(cur, FORKLIFT_ID, "day", start_ns, data_end_ns)
+            update_rollups(cur, FORKLIFT_ID, start_ns, data_end_ns)
+
+    _, seconds = time_call(update)
+    record("update_rollups", seconds, len(velocity_timestamps))
+    # a second forklift following the first FOLLOWER_LAG_NS behind, for the
+    # proximity events of the pair
+    with writer.transaction():
+        insert_trajectory(
+            FORKLIFT_ID + 1,
+            velocity_timestamps + FOLLOWER_LAG_NS,
+            coordinates,
+            headings,
+            velocities_abs,
+            durations_s,
+            zone_ids,
+            writer,
+        )
+
+    def update():
+        with writer.transaction():
+            return update_proximity(
+                cur, data_start_ns, data_end_ns + FOLLOWER_LAG_NS, load_zones(cur)
+            )
+
+    _, seconds = time_call(update)
+    record("update_proximity", seconds, 2 * len(velocity_timestamps))
+    _, seconds = time_call(lambda: update_statistics(con))
+    record("update_statistics", seconds, len(velocity_timestamps))
+
+    # query path
+    parameters = {
+        "forklift_id": FORKLIFT_ID,
+        "start_ns": data_start_ns,
+        "end_ns": data_start_ns + 3600 * 10**9,
+    }
+    for name, query in QUERIES.items():
+        rows, seconds = time_call(
+            lambda: cur.execute(query, parameters).fetchall(), args.repeat
+        )
+        record(f"query_{name}", seconds, len(rows))
+    con.close()
+    if not args.keep:
+        os.remove(db_path)
+        os.remove(csv_path)
+        shutil.rmtree(cache_dir)
+    return results
+
+
+def find_regressions(results, baseline_results, tolerance):
+    baseline = {
+        (result["scale"], result["name"]): result["median_seconds"]
+        for result in baseline_results
+    }
+    regressions = []
+    for result in results:
+        baseline_seconds = baseline.get((result["scale"], result["name"]))
+        if baseline_seconds is None or baseline_seconds == 0:
+            continue
+        ratio = result["median_seconds"] / baseline_seconds
+        if ratio > 1 + tolerance:
+            regressions.append(
+                {
+                    "scale": result["scale"],
+                    "name": result["name"],
+                    "baseline_seconds": baseline_seconds,
+                    "median_seconds": result["median_seconds"],
+                    "ratio": ratio,
+                }
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", default="1,10,100", help="shift multiples")
+    parser.add_argument("--hours", type=float, default=12.0, help="of a shift")
+    parser.add_argument("--pose_rate", type=float, default=15.0)
+    parser.add_argument("--date", default="20241125", help="YYYYMMDD")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=50000)
+    parser.add_argument("--chunk_size", type=int, default=1000000)
+    parser.add_argument(
+        "--downsampling",
+        default="stride:15",
+        help="of the chunked path and the inserted trajectory, see downsampling.py",
+    )
+    parser.add_argument("--work_dir", help="for the CSVs and databases")
+    parser.add_argument("--keep", action="store_true", help="keep CSVs and DBs")
+    parser.add_argument("-o", "--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="results JSON of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    try:
+        parse_downsampling(args.downsampling)
+    except ValueError as e:
+        parser.error(str(e))
+
+    scales = [int(scale) for scale in args.scales.split(",")]
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        work_dir = args.work_dir or temporary_dir
+        os.makedirs(work_dir, exist_ok=True)
+        results = []
+        for scale in scales:
+            results += benchmark_scale(scale, args, work_dir)
+
+    report = {
+        "environment": get_environment(),
+        "parameters": vars(args),
+        "results": results,
+    }
+    exit_code = 0
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline_results = json.load(baseline_file)["results"]
+        report["regressions"] = find_regressions(
+            results, baseline_results, args.tolerance
+        )
+        for regression in report["regressions"]:
+            print(
+                f"Regression {regression['scale']}x {regression['name']}: "
+                f"{regression['median_seconds']:.4f} s, "
+                f"{regression['ratio']:.2f} times the baseline"
+            )
+        exit_code = 1 if len(report["regressions"]) > 0 else 0
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Wrote {args.output}")
+    exit(exit_code)
@@ -0,0 +1,75 @@
+import contextlib
+import time
+
+import numpy as np
+
+
+class BulkWriter:
+    def __init__(self, con, batch_size=50000, verbose=True):
+        self.con = con
+        self.batch_size = batch_size
+        self.verbose = verbose
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # everything written inside the block is committed at once, or rolled
+        # back if ingest fails half way through a file. Inside a transaction
+        # opened before, e.g. by an outer block, the block is part of it and
+        # whoever opened it commits or rolls back.
+        if self.con.in_transaction:
+            yield self
+            return
+        self.con.execute("BEGIN")
+        try:
+            yield self
+        except BaseException:
+            self.con.rollback()
+            raise
+        self.con.commit()
+
+    def insert(self, table, columns, values):
+        columns_str = ", ".join(columns)
+        placeholders = ", ".join(["?"] * len(columns))
+        query = f"INSERT INTO {table}({columns_str}) VALUES ({placeholders})"
+        rows_count = max(
+            [len(value) for value in values if np.ndim(value) > 0], default=0
+        )
+        column_lists = [
+            [value] * rows_count if np.ndim(value) == 0 else np.asarray(value).tolist()
+            for value in values
+        ]
+
+        cur = self.con.cursor()
+        time_start = time.perf_counter()
+        for batch_start in range(0, rows_count, self.batch_size):
+            batch_end = batch_start + self.batch_size
+            cur.executemany(
+                query,
+                zip(*[column[batch_start:batch_end] for column in column_lists]),
+            )
+        elapsed = time.perf_counter() - time_start
+
+        if self.verbose:
+            rows_per_second = rows_count / elapsed if elapsed > 0 else float("inf")
+            print(
+                f"Inserted {rows_count} rows into {table} in {elapsed:.2f} s "
+                f"({rows_per_second:.0f} rows/s)"
+            )
+        return rows_count
+
+
+def add_missing_columns(cur, table, column_definitions):
+    # brings a table created by an earlier schema version up to date, e.g.
+    # column_definitions = {"duration_s": "float"}
+    columns = [row[1] for row in cur.execute(f"PRAGMA table_info({table})")]
+    for column, definition in column_definitions.items():
+        if column not in columns:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def update_statistics(con):
+    # lets the query planner pick the zone and time indexes; analysis_limit
+    # keeps it to a sample of each index so it stays cheap on large tables
+    con.execute("PRAGMA analysis_limit=1000")
+    con.execute("ANALYZE")
+    con.commit()
@@ -0,0 +1,221 @@
+import math
+
+import numpy as np
+
+# Downsampling of the poses before velocities are computed, applied chunk by
+# chunk by util.get_velocities_chunked:
+# stride:RATE keeps every RATE-th pose (the original behaviour),
+# time:SECONDS keeps the first pose of every SECONDS interval,
+# error:METERS keeps the poses needed to reconstruct the trajectory within
+# METERS by linear interpolation in time (Douglas-Peucker with the
+# synchronized Euclidean distance), so turns, stops and starts are kept while
+# straight runs at constant speed and parked periods shrink to a few poses.
+#
+# The time and error modes judge continuity on the original poses: a pair of
+# kept poses is continuous if no gap of MAX_POSE_INTERVAL_NS or reference
+# frame change lies between them, and the poses around every such break are
+# kept.
+#
+# The result does not depend on how the poses are chunked. select returns the
+# poses it keeps among the ones it could decide on, and the undecided poses at
+# the end of a chunk are passed to it again in front of the next chunk: the
+# last pose, which may come before a break, and for the error mode the poses
+# since the last pose kept for sure, as Douglas-Peucker splits the segments
+# between kept poses independently of each other.
+
+MAX_POSE_INTERVAL_NS = 2 * 1e9
+
+
+def get_pose_breaks(timestamps, ref_frame_cat, ref_frame_ind, previous_pose):
+    # True before every pose that does not continue the previous one;
+    # previous_pose is the last pose of the previous chunk, or None
+    breaks = np.ones(len(timestamps), dtype=bool)
+    breaks[1:] = (
+        (timestamps[1:] - timestamps[:-1] >= MAX_POSE_INTERVAL_NS)
+        | (ref_frame_cat[1:] != ref_frame_cat[:-1])
+        | (ref_frame_ind[1:] != ref_frame_ind[:-1])
+    )
+    if previous_pose is not None and len(timestamps) > 0:
+        previous_timestamp, previous_cat, previous_ind = previous_pose
+        breaks[0] = (
+            timestamps[0] - previous_timestamp >= MAX_POSE_INTERVAL_NS
+            or ref_frame_cat[0] != previous_cat
+            or ref_frame_ind[0] != previous_ind
+        )
+    return breaks
+
+
+def get_break_neighbours(breaks):
+    # the poses right before and right after every break, the pose before the
+    # break at the start of the next chunk is decided with that chunk
+    keep_mask = np.copy(breaks)
+    keep_mask[:-1] |= breaks[1:]
+    return keep_mask
+
+
+def simplify_trajectory(timestamps, t_x, t_y, tolerance_m, keep_mask):
+    # Douglas-Peucker on the synchronized Euclidean distance: the distance of
+    # a pose from the position interpolated in time between the kept poses
+    # around it. All segments are split in the same pass, so the number of
+    # numpy calls grows with the depth of the recursion, not with the number
+    # of kept poses.
+    keep_mask = np.copy(keep_mask)
+    poses_count = len(timestamps)
+    if poses_count < 3:
+        keep_mask[:] = True
+        return keep_mask
+    keep_mask[0] = True
+    keep_mask[-1] = True
+    times = (timestamps - timestamps[0]).astype(np.float64)
+    while True:
+        kept = np.flatnonzero(keep_mask)
+        if len(kept) == poses_count:
+            return keep_mask
+        segments = np.minimum(
+            np.searchsorted(kept, np.arange(poses_count), side="right") - 1,
+            len(kept) - 2,
+        )
+        first = kept[segments]
+        last = kept[segments + 1]
+        durations = times[last] - times[first]
+        fractions = np.divide(
+            times - times[first],
+            durations,
+            out=np.zeros(poses_count),
+            where=durations > 0,
+        )
+        errors = np.hypot(
+            t_x - (t_x[first] + fractions * (t_x[last] - t_x[first])),
+            t_y - (t_y[first] + fractions * (t_y[last] - t_y[first])),
+        )
+        errors[keep_mask] = 0
+        segment_errors = np.maximum.reduceat(errors, kept[:-1])
+        is_split = (errors > tolerance_m) & (errors == segment_errors[segments])
+        splits = np.flatnonzero(is_split)
+        if len(splits) == 0:
+            return keep_mask
+        # one split per segment, at its largest error
+        is_first_split = np.ones(len(splits), dtype=bool)
+        is_first_split[1:] = segments[splits[1:]] != segments[splits[:-1]]
+        keep_mask[splits[is_first_split]] = True
+
+
+def force_max_interval(timestamps, keep_mask, max_interval_ns, previous_bucket):
+    # keeps the first pose of every max_interval_ns, so that no kept pair
+    # spans much more time than that and activity gaps are not hidden in long
+    # pairs; previous_bucket is the interval of the pose before timestamps
+    keep_mask = np.copy(keep_mask)
+    if max_interval_ns is None or len(timestamps) == 0:
+        return keep_mask
+    buckets = timestamps // int(max_interval_ns)
+    keep_mask[1:] |= buckets[1:] != buckets[:-1]
+    keep_mask[0] |= buckets[0] != previous_bucket
+    return keep_mask
+
+
+class StrideDownsampling:
+    is_continuity_from_poses = False
+
+    def __init__(self, rate=15):
+        self.rate = int(rate)
+        self.rows_seen = 0
+
+    def select(self, timestamps, t_x, t_y, breaks, is_last):
+        # the phase is carried over, so chunked sampling equals sampling the
+        # whole file
+        phase = (-self.rows_seen) % self.rate
+        self.rows_seen += len(timestamps)
+        return np.arange(phase, len(timestamps), self.rate), len(timestamps)
+
+
+class TimeDownsampling:
+    is_continuity_from_poses = True
+
+    def __init__(self, interval_s=1.0):
+        self.interval_ns = int(interval_s * 1e9)
+        self.previous_bucket = None
+
+    def select(self, timestamps, t_x, t_y, breaks, is_last):
+        # the last pose is decided with the next chunk, the last pose of the
+        # shift is kept
+        decided_count = len(timestamps) if is_last else len(timestamps) - 1
+        if decided_count <= 0:
+            return np.zeros(0, dtype=np.int64), 0
+        buckets = timestamps // self.interval_ns
+        keep_mask = get_break_neighbours(breaks)
+        keep_mask[1:] |= buckets[1:] != buckets[:-1]
+        keep_mask[0] |= buckets[0] != self.previous_bucket
+        keep_mask[-1] |= is_last
+        self.previous_bucket = buckets[decided_count - 1]
+        return np.flatnonzero(keep_mask[:decided_count]), decided_count
+
+
+class ErrorBoundedDownsampling:
+    is_continuity_from_poses = True
+
+    def __init__(self, tolerance_m=0.1, max_interval_s=10.0):
+        self.tolerance_m = tolerance_m
+        self.max_interval_ns = int(max_interval_s * 1e9)
+        self.previous_bucket = None
+
+    def select(self, timestamps, t_x, t_y, breaks, is_last):
+        if len(timestamps) == 0:
+            return np.zeros(0, dtype=np.int64), 0
+        keep_mask = get_break_neighbours(breaks)
+        keep_mask[-1] |= is_last
+        keep_mask = force_max_interval(
+            timestamps, keep_mask, self.max_interval_ns, self.previous_bucket
+        )
+        # the poses from the last one kept for sure on are simplified with
+        # the next chunk, that pose ends the last segment of this one
+        decided_count = len(timestamps) if is_last else np.flatnonzero(keep_mask)[-1]
+        end = len(timestamps) if is_last else decided_count + 1
+        # simplified independently between breaks
+        run_starts = np.unique(
+            np.concatenate([[0], np.flatnonzero(breaks[:end]), [end]])
+        )
+        for run_start, run_end in zip(run_starts[:-1], run_starts[1:]):
+            if run_end - run_start > 2:
+                keep_mask[run_start:run_end] = simplify_trajectory(
+                    timestamps[run_start:run_end],
+                    t_x[run_start:run_end],
+                    t_y[run_start:run_end],
+                    self.tolerance_m,
+                    keep_mask[run_start:run_end],
+                )
+        if decided_count > 0:
+            self.previous_bucket = timestamps[decided_count - 1] // self.max_interval_ns
+        return np.flatnonzero(keep_mask[:decided_count]), decided_count
+
+
+DOWNSAMPLING_MODES = {
+    "stride": StrideDownsampling,
+    "time": TimeDownsampling,
+    "error": ErrorBoundedDownsampling,
+}
+
+
+def parse_downsampling(spec):
+    # e.g. stride:15, time:1.0, error:0.1
+    mode, _, value = spec.partition(":")
+    if mode not in DOWNSAMPLING_MODES:
+        raise ValueError(
+            f"Unknown downsampling {spec}, use one of "
+            + ", ".join(f"{mode}:VALUE" for mode in DOWNSAMPLING_MODES)
+        )
+    if value == "":
+        return DOWNSAMPLING_MODES[mode]()
+    try:
+        number = float(value)
+    except ValueError:
+        number = math.nan
+    # a stride is a whole number of poses, a time interval at least 1 ns
+    if not (
+        math.isfinite(number)
+        and number > 0
+        and (mode != "stride" or number.is_integer())
+        and (mode != "time" or int(number * 1e9) > 0)
+    ):
+        kind = "a positive integer" if mode == "stride" else "a positive number"
+        raise ValueError(f"Invalid downsampling {spec}, {mode} takes {kind}")
+    return DOWNSAMPLING_MODES[mode](number)
@@ -0,0 +1,90 @@
+import os
+import struct
+import time
+
+# The floorplan scale (unit_to_meters of the map session) and the pixel size of
+# the floorplan image, resolved once and stored in the floorplan table. Later
+# runs read them from the database while the session and image files are
+# unchanged, without importing slamcore or decoding the image.
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def create_floorplan_table(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS floorplan(id integer primary key check (id = 1), floorplan_path text, session_path text, floorplan_mtime_ns int, session_mtime_ns int, unit_to_meters float, width_pix int, height_pix int, resolved_ns int)"
+    )
+
+
+def get_meter_to_unit(session_path):
+    # slamcore is only needed for resolving the floorplan, not for ingesting
+    import slamcore
+
+    session = slamcore.load_session_file(str(session_path))
+    return session.floor_plan.unit_to_meters
+
+
+def get_png_size(image_path):
+    # width and height from the IHDR chunk, the first chunk of every PNG
+    with open(image_path, "rb") as image_file:
+        header = image_file.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+
+def get_image_size(image_path):
+    size = get_png_size(image_path)
+    if size is None:
+        # other formats are decoded
+        import cv2
+
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Cannot read the floorplan image {image_path}")
+        size = (image.shape[1], image.shape[0])
+    return size
+
+
+def get_mtime_ns(path):
+    return os.stat(path).st_mtime_ns
+
+
+def get_floorplan(cur, floorplan_path, session_path):
+    # (unit_to_meters, width_pix, height_pix), resolved from the files only if
+    # the floorplan table has none for these files as they are now
+    floorplan_mtime_ns = get_mtime_ns(floorplan_path)
+    session_mtime_ns = get_mtime_ns(session_path)
+    row = cur.execute(
+        "SELECT unit_to_meters, width_pix, height_pix FROM floorplan "
+        "WHERE floorplan_path = ? AND session_path = ? "
+        "AND floorplan_mtime_ns = ? AND session_mtime_ns = ?",
+        (floorplan_path, session_path, floorplan_mtime_ns, session_mtime_ns),
+    ).fetchone()
+    if row is not None:
+        return row
+    unit_to_meters = get_meter_to_unit(session_path)
+    width_pix, height_pix = get_image_size(floorplan_path)
+    cur.execute(
+        "INSERT OR REPLACE INTO floorplan(id, floorplan_path, session_path, "
+        "floorplan_mtime_ns, session_mtime_ns, unit_to_meters, width_pix, "
+        "height_pix, resolved_ns) VALUES (1, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            floorplan_path,
+            session_path,
+            floorplan_mtime_ns,
+            session_mtime_ns,
+            unit_to_meters,
+            width_pix,
+            height_pix,
+            time.time_ns(),
+        ),
+    )
+    return unit_to_meters, width_pix, height_pix
+
+
+def load_floorplan(cur):
+    # the stored (unit_to_meters, width_pix, height_pix), None if not resolved
+    return cur.execute(
+        "SELECT unit_to_meters, width_pix, height_pix FROM floorplan"
+    ).fetchone()
@@ -0,0 +1,421 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import matplotlib.pyplot as plt
+import numpy as np
+import xxhash
+from matplotlib.colors import LogNorm
+
+from floorplan import get_meter_to_unit, load_floorplan
+from partitions import get_trajectory_source
+from schema_digest import get_generation
+
+# Occupancy (trajectory points) and dwell time (sum of duration_s) binned into
+# a grid in plot space: floorplan pixels when a floorplan is shown, meters
+# otherwise, as in visualize_inputs.scatter_on_floorplan. Every grid is
+# summed 2x2 into coarser levels, and the level matching the zoom is drawn
+# with imshow, cropped to the view, so a week of all forklifts stays
+# interactive. Pyramids built from the database are cached on disk per
+# database generation.
+
+HEATMAP_FORMAT_VERSION = 1
+METRICS = ["occupancy", "dwell"]
+META_FILE_NAME = "meta.json"
+MIN_LEVEL_SIZE = 64
+
+
+def get_default_cache_dir():
+    return os.environ.get(
+        "AWARE_HEATMAP_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "aware_heatmap_cache"),
+    )
+
+
+def get_plot_coordinates(x, y, meter_to_pixel, floorplan_height_pix):
+    if floorplan_height_pix is None:
+        return x, y
+    return meter_to_pixel * x, floorplan_height_pix - meter_to_pixel * y
+
+
+def get_floorplan_grid(floorplan_width_pix, floorplan_height_pix):
+    # one cell per floorplan pixel, centered on the pixel
+    return {
+        "x_min": -0.5,
+        "y_min": -0.5,
+        "cell_size": 1.0,
+        "width": int(floorplan_width_pix),
+        "height": int(floorplan_height_pix),
+    }
+
+
+def get_bounds_grid(x_min, x_max, y_min, y_max, cell_size):
+    return {
+        "x_min": float(x_min),
+        "y_min": float(y_min),
+        "cell_size": float(cell_size),
+        "width": max(int(np.ceil((x_max - x_min) / cell_size)), 1),
+        "height": max(int(np.ceil((y_max - y_min) / cell_size)), 1),
+    }
+
+
+def create_grids(grid):
+    shape = (grid["height"], grid["width"])
+    return {
+        "occupancy": np.zeros(shape, dtype=np.int64),
+        "dwell": np.zeros(shape, dtype=np.float64),
+    }
+
+
+def accumulate_grids(grids, grid, plot_x, plot_y, durations_s):
+    # adds the points to the grids in place, points outside are dropped
+    columns = np.floor((plot_x - grid["x_min"]) / grid["cell_size"]).astype(np.int64)
+    rows = np.floor((plot_y - grid["y_min"]) / grid["cell_size"]).astype(np.int64)
+    inside = (
+        (columns >= 0)
+        & (columns < grid["width"])
+        & (rows >= 0)
+        & (rows < grid["height"])
+    )
+    cells = rows[inside] * grid["width"] + columns[inside]
+    cells_count = grid["width"] * grid["height"]
+    shape = (grid["height"], grid["width"])
+    grids["occupancy"] += np.bincount(cells, minlength=cells_count).reshape(shape)
+    grids["dwell"] += np.bincount(
+        cells, weights=np.asarray(durations_s)[inside], minlength=cells_count
+    ).reshape(shape)
+    return grids
+
+
+def downsample_grid(values):
+    # sums 2x2 blocks, an odd last row or column is padded with zeros
+    height, width = values.shape
+    padded = np.pad(values, ((0, height % 2), (0, width % 2)))
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).sum(
+        axis=(1, 3)
+    )
+
+
+def build_pyramid(values, min_size=MIN_LEVEL_SIZE):
+    # level k has cells of 2^k x 2^k cells of level 0
+    levels = [values]
+    while max(levels[-1].shape) > min_size:
+        levels.append(downsample_grid(levels[-1]))
+    return levels
+
+
+def build_pyramids(grids):
+    return {metric: build_pyramid(values) for metric, values in grids.items()}
+
+
+def write_pyramid_cache(cache_path, grid, pyramids):
+    # written into a temporary directory renamed at the end, as the shift cache
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary_path = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_")
+    try:
+        for metric, levels in pyramids.items():
+            for level, values in enumerate(levels):
+                np.save(os.path.join(temporary_path, f"{metric}_{level}.npy"), values)
+        meta = {
+            "version": HEATMAP_FORMAT_VERSION,
+            "grid": grid,
+            "levels": {metric: len(levels) for metric, levels in pyramids.items()},
+        }
+        with open(os.path.join(temporary_path, META_FILE_NAME), "w") as meta_file:
+            json.dump(meta, meta_file)
+        try:
+            os.rename(temporary_path, cache_path)
+        except OSError:
+            # written concurrently by another process
+            if not os.path.exists(os.path.join(cache_path, META_FILE_NAME)):
+                raise
+    finally:
+        if os.path.exists(temporary_path):
+            shutil.rmtree(temporary_path)
+
+
+def load_pyramid_cache(cache_path):
+    # the grid and read-only memory maps of the levels
+    with open(os.path.join(cache_path, META_FILE_NAME)) as meta_file:
+        meta = json.load(meta_file)
+    if meta["version"] != HEATMAP_FORMAT_VERSION:
+        raise ValueError(f"{cache_path} has heatmap format version {meta['version']}")
+    pyramids = {
+        metric: [
+            np.load(os.path.join(cache_path, f"{metric}_{level}.npy"), mmap_mode="r")
+            for level in range(levels_count)
+        ]
+        for metric, levels_count in meta["levels"].items()
+    }
+    return meta["grid"], pyramids
+
+
+def read_trajectory_chunks(
+    con, start_ns, end_ns, forklift_ids=None, chunk_size=1000000
+):
+    # x, y and duration_s of the trajectory points in the time range, rows
+    # ingested before duration_s existed count as one second as in the rollups
+    query = (
+        "SELECT x, y, coalesce(duration_s, 1.0) "
+        f"FROM {get_trajectory_source(con.cursor(), start_ns, end_ns)} "
+        "WHERE time_ns >= ? AND time_ns < ?"
+    )
+    parameters = [start_ns, end_ns]
+    if forklift_ids:
+        query += f" AND forklift_id IN ({', '.join('?' * len(forklift_ids))})"
+        parameters += list(forklift_ids)
+    cursor = con.execute(query, parameters)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if len(rows) == 0:
+            break
+        values = np.array(rows, dtype=np.float64)
+        yield values[:, 0], values[:, 1], values[:, 2]
+
+
+def get_data_bounds(con, start_ns, end_ns, forklift_ids=None):
+    query = (
+        "SELECT min(x), max(x), min(y), max(y) "
+        f"FROM {get_trajectory_source(con.cursor(), start_ns, end_ns)} "
+        "WHERE time_ns >= ? AND time_ns < ?"
+    )
+    parameters = [start_ns, end_ns]
+    if forklift_ids:
+        query += f" AND forklift_id IN ({', '.join('?' * len(forklift_ids))})"
+        parameters += list(forklift_ids)
+    return con.execute(query, parameters).fetchone()
+
+
+def get_heatmap_cache_key(
+    db_path, generation, start_ns, end_ns, forklift_ids, grid, meter_to_pixel
+):
+    key = json.dumps(
+        [
+            HEATMAP_FORMAT_VERSION,
+            os.path.abspath(db_path),
+            generation,
+            start_ns,
+            end_ns,
+            sorted(forklift_ids or []),
+            grid,
+            meter_to_pixel,
+        ]
+    )
+    return xxhash.xxh3_128(key.encode()).hexdigest()
+
+
+def build_db_pyramids(
+    db_path,
+    start_ns,
+    end_ns,
+    grid,
+    meter_to_pixel,
+    floorplan_height_pix,
+    forklift_ids=None,
+    cache_dir=None,
+):
+    # pyramids of the trajectory points in the time range, reused from
+    # cache_dir while the database generation is unchanged
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        cache_path = None
+        generation = get_generation(con.cursor())
+        if cache_dir is not None and generation is not None:
+            cache_path = os.path.join(
+                cache_dir,
+                get_heatmap_cache_key(
+                    db_path,
+                    generation,
+                    start_ns,
+                    end_ns,
+                    forklift_ids,
+                    grid,
+                    meter_to_pixel,
+                ),
+            )
+            if os.path.exists(os.path.join(cache_path, META_FILE_NAME)):
+                return load_pyramid_cache(cache_path)[1]
+        grids = create_grids(grid)
+        for x, y, durations_s in read_trajectory_chunks(
+            con, start_ns, end_ns, forklift_ids
+        ):
+            plot_x, plot_y = get_plot_coordinates(
+                x, y, meter_to_pixel, floorplan_height_pix
+            )
+            accumulate_grids(grids, grid, plot_x, plot_y, durations_s)
+    finally:
+        con.close()
+    pyramids = build_pyramids(grids)
+    if cache_path is not None:
+        try:
+            write_pyramid_cache(cache_path, grid, pyramids)
+        except OSError as e:
+            print(f"Cannot cache the heatmap in {cache_dir}: {e}")
+    return pyramids
+
+
+def show_heatmap(ax, grid, levels, cmap="inferno", alpha=0.6):
+    # Draws the level with about one cell per screen pixel, cropped to the
+    # view and redrawn on zoom and pan. Values are per cell of level 0, so the
+    # colors do not change with the level.
+    vmax = max(float(np.max(levels[0])), 1e-9)
+    norm = LogNorm(vmin=vmax * 1e-3, vmax=vmax, clip=True)
+    top_cell_size = grid["cell_size"] * 2 ** (len(levels) - 1)
+    image = ax.imshow(
+        np.ma.masked_less_equal(np.asarray(levels[-1], dtype=np.float64), 0),
+        origin="lower",
+        extent=(
+            grid["x_min"],
+            grid["x_min"] + levels[-1].shape[1] * top_cell_size,
+            grid["y_min"],
+            grid["y_min"] + levels[-1].shape[0] * top_cell_size,
+        ),
+        cmap=cmap,
+        norm=norm,
+        alpha=alpha,
+        interpolation="nearest",
+    )
+    # the view is kept when the extent of the image changes
+    ax.set_autoscale_on(False)
+    drawn_view = {}
+
+    def update(_=None):
+        x_start, x_end = sorted(ax.get_xlim())
+        y_start, y_end = sorted(ax.get_ylim())
+        screen_width = max(ax.get_window_extent().width, 1)
+        cells_per_pixel = (x_end - x_start) / grid["cell_size"] / screen_width
+        level = int(
+            np.clip(np.floor(np.log2(max(cells_per_pixel, 1))), 0, len(levels) - 1)
+        )
+        cell_size = grid["cell_size"] * 2**level
+        height, width = levels[level].shape
+        column_start, column_end = np.clip(
+            [
+                int(np.floor((x_start - grid["x_min"]) / cell_size)),
+                int(np.ceil((x_end - grid["x_min"]) / cell_size)),
+            ],
+            0,
+            width,
+        )
+        row_start, row_end = np.clip(
+            [
+                int(np.floor((y_start - grid["y_min"]) / cell_size)),
+                int(np.ceil((y_end - grid["y_min"]) / cell_size)),
+            ],
+            0,
+            height,
+        )
+        view = (level, column_start, column_end, row_start, row_end)
+        if drawn_view.get("view") == view:
+            return
+        drawn_view["view"] = view
+        values = np.zeros((1, 1))
+        if column_end > column_start and row_end > row_start:
+            values = np.asarray(
+                levels[level][row_start:row_end, column_start:column_end],
+                dtype=np.float64,
+            ) / (4**level)
+        image.set_data(np.ma.masked_less_equal(values, 0))
+        image.set_extent(
+            (
+                grid["x_min"] + column_start * cell_size,
+                grid["x_min"] + max(column_end, column_start + 1) * cell_size,
+                grid["y_min"] + row_start * cell_size,
+                grid["y_min"] + max(row_end, row_start + 1) * cell_size,
+            )
+        )
+
+    ax.callbacks.connect("xlim_changed", update)
+    ax.callbacks.connect("ylim_changed", update)
+    ax.figure.canvas.mpl_connect("resize_event", update)
+    update()
+    return image
+
+
+def get_local_day_ns(date):
+    # local midnight of a YYYYMMDD date
+    return int(datetime.datetime.strptime(date, "%Y%m%d").timestamp()) * int(1e9)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_path", nargs="?", default="aware_data.db")
+    parser.add_argument(
+        "--start", help="YYYYMMDD, the first day of the data if omitted"
+    )
+    parser.add_argument("--days", type=float, default=7.0)
+    parser.add_argument("--forklift", type=int, action="append", default=[])
+    parser.add_argument("--metric", choices=METRICS, default="dwell")
+    parser.add_argument("-m", "--map_session")
+    parser.add_argument("-f", "--floorplan")
+    parser.add_argument(
+        "--cell_size", type=float, default=0.25, help="meters, without a floorplan"
+    )
+    parser.add_argument("--cache_dir", default=get_default_cache_dir())
+    parser.add_argument(
+        "--no_cache", action="store_true", help="build the heatmap without caching it"
+    )
+    parser.add_argument("-o", "--output", help="save the figure instead of showing it")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(f"file:{args.db_path}?mode=ro", uri=True)
+    if args.start is None:
+        (start_ns,) = con.execute("SELECT min(time_ns) FROM trajectory").fetchone()
+        if start_ns is None:
+            parser.error(f"{args.db_path} has no trajectory")
+    else:
+        start_ns = get_local_day_ns(args.start)
+    end_ns = start_ns + int(args.days * 24 * 3600 * 1e9)
+
+    fig = plt.figure("Heatmap")
+    ax = plt.gca()
+    if args.floorplan is not None:
+        import cv2
+
+        img_floorplan = cv2.imread(args.floorplan)
+        plt.imshow(img_floorplan)
+        if args.map_session is not None:
+            meter_to_pixel = get_meter_to_unit(args.map_session)
+        else:
+            # the scale stored by the ingest
+            floorplan = load_floorplan(con)
+            if floorplan is None:
+                parser.error(f"{args.db_path} has no floorplan, use --map_session")
+            meter_to_pixel = floorplan[0]
+        floorplan_height_pix = img_floorplan.shape[0]
+        grid = get_floorplan_grid(img_floorplan.shape[1], floorplan_height_pix)
+    else:
+        meter_to_pixel = 1
+        floorplan_height_pix = None
+        bounds = get_data_bounds(con, start_ns, end_ns, args.forklift)
+        if bounds[0] is None:
+            parser.error("no trajectory in the time range")
+        grid = get_bounds_grid(*bounds, args.cell_size)
+    con.close()
+
+    pyramids = build_db_pyramids(
+        args.db_path,
+        start_ns,
+        end_ns,
+        grid,
+        meter_to_pixel,
+        floorplan_height_pix,
+        args.forklift,
+        None if args.no_cache else args.cache_dir,
+    )
+    image = show_heatmap(ax, grid, pyramids[args.metric])
+    fig.colorbar(
+        image,
+        ax=ax,
+        label="trajectory points" if args.metric == "occupancy" else "seconds",
+    )
+    ax.set_aspect("equal", adjustable="box")
+    if args.output is not None:
+        fig.savefig(args.output, dpi=200)
+    else:
+        plt.show()
@@ -0,0 +1,213 @@
+import argparse
+import concurrent.futures
+import glob
+import os
+import re
+import time
+
+import pandas
+
+from db_util import update_statistics
+from ingest_trajectory import open_database, process_shift, write_shift
+from ingested_files import get_file_signature
+from instrumentation import configure_spans, get_run_id, span, spans_config
+from partitions import HOT_WEEKS
+from schema_digest import load_schema_digest
+from downsampling import parse_downsampling
+from shift_cache import get_default_cache_dir
+
+# e.g. 4_shift_20241125_0600_cleaned_cleaned.csv
+SHIFT_FILE_PATTERN = re.compile(r"(\d+)_shift_(\d{8})_(\d{4})")
+SHIFT_START_TO_TYPE = {"0600": "day", "1800": "night"}
+
+
+def get_shift_from_filename(csv_path):
+    match = SHIFT_FILE_PATTERN.search(os.path.basename(csv_path))
+    if match is None or match.group(3) not in SHIFT_START_TO_TYPE:
+        raise ValueError(f"Cannot infer forklift and shift from {csv_path}")
+    return int(match.group(1)), SHIFT_START_TO_TYPE[match.group(3)]
+
+
+def collect_shifts(manifest_path, glob_patterns):
+    # list of (csv_path, forklift_id, shift_type)
+    shifts = []
+    if manifest_path is not None:
+        df = pandas.read_csv(manifest_path, dtype=str)
+        for csv_path, forklift_id, shift_type in df[
+            ["csv_path", "forklift_id", "shift_type"]
+        ].values:
+            shifts.append((csv_path, int(forklift_id), shift_type))
+    for glob_pattern in glob_patterns:
+        for csv_path in sorted(glob.glob(glob_pattern)):
+            forklift_id, shift_type = get_shift_from_filename(csv_path)
+            shifts.append((csv_path, forklift_id, shift_type))
+    return shifts
+
+
+def ingest_shifts(
+    shifts,
+    writer,
+    workers=None,
+    chunk_size=1000000,
+    force=False,
+    cache_dir=None,
+    downsampling=None,
+    hot_weeks=HOT_WEEKS,
+):
+    # parsing and velocity computation run in worker processes, while this
+    # process is the only one writing into the database
+    with span("ingest_shifts", shifts=len(shifts)) as attributes:
+        ingested_count, skipped_count = submit_shifts(
+            shifts,
+            writer,
+            workers,
+            chunk_size,
+            force,
+            cache_dir,
+            downsampling,
+            hot_weeks,
+        )
+        attributes["ingested"] = ingested_count
+        attributes["skipped"] = skipped_count
+    return ingested_count
+
+
+def submit_shifts(
+    shifts, writer, workers, chunk_size, force, cache_dir, downsampling, hot_weeks
+):
+    time_start = time.perf_counter()
+    ingested_count = 0
+    skipped_count = 0
+    cur = writer.con.cursor()
+    # the workers record their spans in the same run
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=configure_spans,
+        initargs=(spans_config["path"], get_run_id()),
+    ) as executor:
+        futures = {}
+        for csv_path, forklift_id, shift_type in shifts:
+            if not os.path.exists(csv_path):
+                print(f"Skipping missing {csv_path}")
+                continue
+            # files already ingested with the same content are not parsed again
+            file_signature, is_ingested = get_file_signature(
+                cur, csv_path, forklift_id, shift_type
+            )
+            if is_ingested and not force:
+                skipped_count += 1
+                continue
+            future = executor.submit(
+                process_shift,
+                csv_path,
+                shift_type,
+                chunk_size=chunk_size,
+                cache_dir=cache_dir,
+                content_hash=file_signature[0],
+                downsampling=downsampling,
+            )
+            futures[future] = (csv_path, forklift_id, file_signature)
+
+        for future in concurrent.futures.as_completed(futures):
+            csv_path, forklift_id, file_signature = futures.pop(future)
+            print(f"Writing forklift {forklift_id} from {csv_path}")
+            write_shift(
+                forklift_id,
+                future.result(),
+                writer,
+                ingested_file=(csv_path, file_signature),
+                hot_weeks=hot_weeks,
+            )
+            ingested_count += 1
+
+    print(
+        f"Ingested {ingested_count} shifts, skipped {skipped_count} unchanged, "
+        f"in {time.perf_counter() - time_start:.1f} s"
+    )
+    return ingested_count, skipped_count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("zones_path")
+    parser.add_argument("floorplan_path")
+    parser.add_argument("session_path")
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        help="CSV with csv_path, forklift_id and shift_type columns",
+    )
+    parser.add_argument(
+        "-g",
+        "--glob",
+        action="append",
+        default=[],
+        help="glob of shift CSVs named <forklift>_shift_<YYYYMMDD>_<0600|1800>*.csv",
+    )
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--db_path", default="aware_data.db")
+    parser.add_argument("--batch_size", type=int, default=50000)
+    parser.add_argument("--chunk_size", type=int, default=1000000)
+    parser.add_argument(
+        "--force", action="store_true", help="ingest unchanged files again"
+    )
+    parser.add_argument("--cache_dir", default=get_default_cache_dir())
+    parser.add_argument(
+        "--no_cache", action="store_true", help="parse the CSVs without caching them"
+    )
+    parser.add_argument(
+        "--downsampling",
+        default="stride:15",
+        help="stride:RATE, time:SECONDS or error:METERS, see downsampling.py",
+    )
+    parser.add_argument(
+        "--hot_weeks",
+        type=int,
+        default=HOT_WEEKS,
+        help="weeks up to the newest one whose trajectory is also kept as rows, "
+        "older weeks are compacted to their chunks, see partitions.py",
+    )
+    parser.add_argument(
+        "--spans",
+        default=os.environ.get("AWARE_SPANS"),
+        help="JSONL file or .db the stage timings are recorded in, see instrumentation.py",
+    )
+    args = parser.parse_args()
+    if args.spans is not None:
+        configure_spans(args.spans)
+    try:
+        parse_downsampling(args.downsampling)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.hot_weeks < 0:
+        parser.error("--hot_weeks must not be negative")
+
+    shifts = collect_shifts(args.manifest, args.glob)
+    if len(shifts) == 0:
+        parser.error("no shift CSVs given, use --manifest or --glob")
+
+    # zones and the floorplan are loaded once for the whole run
+    con, writer = open_database(
+        args.db_path,
+        args.zones_path,
+        args.floorplan_path,
+        args.session_path,
+        batch_size=args.batch_size,
+    )
+    ingested_count = ingest_shifts(
+        shifts,
+        writer,
+        args.workers,
+        args.chunk_size,
+        args.force,
+        None if args.no_cache else args.cache_dir,
+        args.downsampling,
+        args.hot_weeks,
+    )
+    if ingested_count > 0:
+        with span("update_statistics"):
+            update_statistics(con)
+        # the schema digest for the LLM prompts is rebuilt for the new generation
+        with span("load_schema_digest"):
+            load_schema_digest(args.db_path)
+    con.close()
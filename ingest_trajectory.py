@@ -3,172 +3,474 @@ import os
 import argparse
 import pandas
 import numpy as np
-import datetime
 import sys
-import cv2
-from util import get_shift_time, get_activity_periods, get_velocities
-from visualize_inputs import get_meter_to_unit
-
-
-def insert_activity(forklift_id, time_periods, cur, con):
-    query_with_param = "INSERT INTO activity(forklift_id, start, end) VALUES(?, ?, ?)"
-    for activity_record in time_periods:
-        time_start, time_end, status = activity_record
-        if status:
-            time_start = datetime.datetime.fromtimestamp(int(time_start / 1e9))
-            time_end = datetime.datetime.fromtimestamp(int(time_end / 1e9))
-            cur.execute(query_with_param, (forklift_id, time_start, time_end))
-    con.commit()
+import time
+from util import (
+    get_shift_time,
+    get_activity_periods,
+    get_velocities_chunked,
+    concatenate_velocity_chunks,
+)
+from segmentation import STATIC_VELOCITY_M_S, get_stopping_locations
+from db_util import BulkWriter, update_statistics
+from schema import (
+    SCHEMA_VERSION,
+    bump_generation,
+    create_schema,
+    get_schema_version,
+    is_empty_database,
+    set_schema_version,
+)
+from rollups import insert_shift, update_rollups
+from downsampling import parse_downsampling
+from floorplan import get_floorplan
+from partitions import (
+    HOT_WEEKS,
+    compact_partitions_before,
+    get_hot_start_ns,
+    insert_trajectory_rows,
+)
+from proximity import update_proximity
+from trajectory_chunks import insert_trajectory_chunks
+from instrumentation import configure_spans, span, timed_iterator, traced
+from shift_cache import get_default_cache_dir, read_shift_chunks
+from ingested_files import (
+    delete_ingested_rows,
+    get_file_signature,
+    record_ingested_file,
+)
+from zone_visits import get_zone_visits, insert_zone_visits
+from zones import fill_zones_rtree, get_zone_bounds, get_zone_ids, load_zones
+
+
+def insert_activity(forklift_id, time_periods, writer):
+    time_periods = np.array(time_periods, dtype=np.int64).reshape(-1, 3)
+    active_periods = time_periods[time_periods[:, 2] > 0]
+    writer.insert(
+        "activity",
+        ["forklift_id", "start_ns", "end_ns"],
+        [forklift_id, active_periods[:, 0], active_periods[:, 1]],
+    )
 
 
 def insert_trajectory(
-    forklift_id, velocity_timestamps, coordinates, headings, velocities_abs, cur, con
+    forklift_id,
+    velocity_timestamps,
+    coordinates,
+    headings,
+    velocities_abs,
+    durations_s,
+    zone_ids,
+    writer,
+    hot_weeks=None,
 ):
-    query_with_param = "INSERT INTO trajectory(forklift_id, time, x, y, heading_x, heading_y, velocity_meters_per_second) VALUES (?, ?, ?, ?, ?, ?, ? )"
-    for trajectory_record in zip(
-        velocity_timestamps, coordinates, headings, velocities_abs
-    ):
-        time_ns, coordinate, heading, velocity_abs = trajectory_record
-        time_moment = datetime.datetime.fromtimestamp(int(time_ns / 1e9))
-        cur.execute(
-            query_with_param,
-            (
-                forklift_id,
-                time_moment,
-                coordinate[0],
-                coordinate[1],
-                heading[0],
-                heading[1],
-                velocity_abs,
-            ),
-        )
-    con.commit()
+    # into the compressed chunks, and as rows into the partitions of the
+    # weeks that are not compacted. With hot_weeks, only the last hot_weeks
+    # weeks up to the newest one keep their rows, older partitions are
+    # compacted, see partitions.get_hot_start_ns.
+    cur = writer.con.cursor()
+    hot_start_ns = None
+    if hot_weeks is not None and len(velocity_timestamps) > 0:
+        hot_start_ns = get_hot_start_ns(cur, hot_weeks, velocity_timestamps.max())
+        compact_partitions_before(cur, hot_start_ns)
+    insert_trajectory_chunks(
+        cur,
+        forklift_id,
+        velocity_timestamps,
+        coordinates,
+        headings,
+        velocities_abs,
+        durations_s,
+        zone_ids,
+    )
+    return insert_trajectory_rows(
+        writer,
+        [
+            "forklift_id",
+            "time_ns",
+            "x",
+            "y",
+            "heading_x",
+            "heading_y",
+            "velocity_meters_per_second",
+            "duration_s",
+            "zone_id",
+        ],
+        [
+            forklift_id,
+            velocity_timestamps,
+            coordinates[:, 0],
+            coordinates[:, 1],
+            headings[:, 0],
+            headings[:, 1],
+            velocities_abs,
+            durations_s,
+            np.where(zone_ids >= 0, zone_ids, None),
+        ],
+        hot_start_ns,
+    )
+
+
+def insert_stops(forklift_id, stop_records, writer):
+    stop_starts, stop_ends, stop_x, stop_y = stop_records
+    writer.insert(
+        "stops",
+        ["forklift_id", "start_ns", "end_ns", "x", "y"],
+        [forklift_id, stop_starts, stop_ends, stop_x, stop_y],
+    )
 
 
-def insert_zones(zones_path, session_path, floorplan_path, cur, con):
-    meter_to_unit = get_meter_to_unit(session_path)
-    img_floorplan = cv2.imread(floorplan_path)
-    floorplan_height = img_floorplan.shape[0]
+def insert_zones(zones_path, session_path, floorplan_path, writer):
+    meter_to_unit, _, floorplan_height = get_floorplan(
+        writer.con.cursor(), floorplan_path, session_path
+    )
     df = pandas.read_csv(zones_path)
-    query_with_param = (
-        "INSERT INTO zones(x_min, x_max, y_min, y_max, name) VALUES (?, ?, ?, ?, ?)"
-    )
-    for row in df.values:
-        minimum_x, minimum_y, w, h, name = row[1:]
-        maximum_x = minimum_x + w
-        maximum_y = minimum_y + h
-
-        minimum_x = minimum_x / meter_to_unit
-        maximum_x = maximum_x / meter_to_unit
-        minimum_y = (floorplan_height - minimum_y) / meter_to_unit
-        maximum_y = (floorplan_height - maximum_y) / meter_to_unit
-        cur.execute(
-            query_with_param,
-            (minimum_x, maximum_x, minimum_y, maximum_y, name),
-        )
+    minimum_x, minimum_y, w, h, names = [df[column] for column in df.columns[1:]]
+    writer.insert(
+        "zones",
+        ["x_min", "x_max", "y_min", "y_max", "name"],
+        [
+            *get_zone_bounds(
+                minimum_x, minimum_y, w, h, meter_to_unit, floorplan_height
+            ),
+            names,
+        ],
+    )
+    fill_zones_rtree(writer.con.cursor())
+    bump_generation(writer.con.cursor())
 
-    con.commit()
 
+@traced()
+def process_shift(
+    csv_path,
+    shift_type,
+    time_subsampling_rate=15,
+    static_threshold=STATIC_VELOCITY_M_S,
+    min_time_interval_ns=600 * 1e9,
+    chunk_size=1000000,
+    cache_dir=None,
+    content_hash=None,
+    downsampling=None,
+    positions_dtype=np.float64,
+):
+    # the parsed CSV columns are cached in cache_dir, see shift_cache.py;
+    # downsampling is a spec of downsampling.parse_downsampling, by default
+    # every time_subsampling_rate-th pose is kept; positions_dtype np.float32
+    # halves the memory of the positions at about 10 um resolution
+    # data processing starts here
+    with span("read_velocities", csv_path=csv_path) as attributes:
+        velocity_arrays = concatenate_velocity_chunks(
+            get_velocities_chunked(
+                timed_iterator(
+                    read_shift_chunks(
+                        csv_path, chunk_size, cache_dir, content_hash, positions_dtype
+                    ),
+                    attributes,
+                    "read_seconds",
+                    "poses",
+                    get_rows=lambda frame: len(frame.timestamps),
+                ),
+                time_subsampling_rate if downsampling is None else downsampling,
+            )
+        )
+        attributes["rows"] = len(velocity_arrays[0])
+    processed_shift = process_velocities(
+        velocity_arrays, shift_type, static_threshold, min_time_interval_ns
+    )
+    print(f"Length of trajectory is {len(processed_shift[1])}")
+    return processed_shift
 
-if __name__ == "__main__":
-    time_subsampling_rate = 15
-    min_time_interval_ns = 600 * 1e9
-    is_insert_trajectory = True
-    is_insert_zones = True
-    parser = argparse.ArgumentParser()
-    parser.add_argument("csv_path")
-    parser.add_argument("forklift_id")
-    parser.add_argument("shift_type", choices=["day", "night"])
-    parser.add_argument("zones_path")
-    parser.add_argument("floorplan_path")
-    parser.add_argument("session_path")
 
-    args = parser.parse_args()
+def process_velocities(
+    velocity_arrays,
+    shift_type,
+    static_threshold=STATIC_VELOCITY_M_S,
+    min_time_interval_ns=600 * 1e9,
+):
+    # the activity, trajectory and stops of a shift from the concatenated
+    # output of util.get_velocities_chunked, as write_shift takes them
+    (
+        velocities_abs,
+        headings,
+        velocity_timestamps,
+        pose_timestamps,
+        coordinates,
+        fid_world_mask,
+        durations_s,
+    ) = velocity_arrays
+    static_mask = velocities_abs < static_threshold
+    dynamic_mask = np.invert(static_mask)
 
-    db_path = "aware_data.db"
-    is_creating_tables = not os.path.exists(db_path)
+    activity_timestamps = velocity_timestamps[dynamic_mask]
 
-    con = sqlite3.connect(
-        db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    shift_start, shift_end = get_shift_time(velocity_timestamps, shift_type)
+    shift_record = (
+        shift_type,
+        int(shift_start.timestamp()) * int(1e9),
+        int(shift_end.timestamp()) * int(1e9),
     )
-    cur = con.cursor()
-    if is_creating_tables:
-        cur.execute(
-            "CREATE TABLE activity(forklift_id int, start timestamp, end timestamp)"
+    with span("activity_periods", rows=len(activity_timestamps)):
+        time_periods = get_activity_periods(
+            min_time_interval_ns, shift_start, shift_end, activity_timestamps
         )
+
+    # trajectory (locations, headings, velocities)
+    trajectory_rows = np.flatnonzero(fid_world_mask)
+    pose_timestamps = pose_timestamps[trajectory_rows]
+    coordinates = coordinates[trajectory_rows]
+    velocity_timestamps = velocity_timestamps[trajectory_rows]
+    headings = headings[trajectory_rows]
+    velocities_abs = velocities_abs[trajectory_rows]
+    durations_s = durations_s[trajectory_rows]
+
+    with span("stopping_locations", rows=len(velocities_abs)):
+        stop_records = get_stopping_locations(
+            pose_timestamps,
+            coordinates[:, 0],
+            coordinates[:, 1],
+            velocities_abs,
+            static_threshold,
+            velocity_timestamps,
+        )
+    return (
+        time_periods,
+        velocity_timestamps,
+        coordinates,
+        headings,
+        velocities_abs,
+        durations_s,
+        stop_records,
+        shift_record,
+    )
+
+
+def write_shift(
+    forklift_id,
+    processed_shift,
+    writer,
+    is_insert_trajectory=True,
+    ingested_file=None,
+    hot_weeks=HOT_WEEKS,
+):
+    # ingested_file is (csv_path, file_signature) of the CSV the shift was
+    # processed from: rows of earlier ingests of it are replaced and the file
+    # is recorded in ingested_files. hot_weeks is as for insert_trajectory.
+    # The proximity events and zone congestion of the hours written are
+    # updated in the same transaction. Returns the time range written.
+    (
+        time_periods,
+        velocity_timestamps,
+        coordinates,
+        headings,
+        velocities_abs,
+        durations_s,
+        stop_records,
+        shift_record,
+    ) = processed_shift
+    shift_type, shift_start_ns, shift_end_ns = shift_record
+    # all rows of one shift file are written in a single transaction
+    with span("write_shift", forklift_id=forklift_id), writer.transaction():
+        cur = writer.con.cursor()
+        # recompute the rollups of every hour this file has data or shift time in
+        rollup_times = [shift_start_ns, shift_end_ns]
+        if ingested_file is not None:
+            csv_path, file_signature = ingested_file
+            with span("delete_ingested_rows"):
+                rollup_times += delete_ingested_rows(
+                    cur, forklift_id, csv_path, shift_start_ns, shift_end_ns
+                )
+
+        with span("insert_activity", rows=len(time_periods)):
+            insert_activity(forklift_id, time_periods, writer)
+        with span("insert_stops", rows=len(stop_records[0])):
+            insert_stops(forklift_id, stop_records, writer)
+        zones = load_zones(cur)
         if is_insert_trajectory:
-            cur.execute(
-                "CREATE TABLE trajectory(forklift_id int, time timestamp, x float, y float, heading_x float, heading_y float, velocity_meters_per_second float)"
-            )
+            with span("get_zone_ids", rows=len(coordinates)):
+                zone_ids = get_zone_ids(coordinates, zones)
+            with span("insert_trajectory", rows=len(velocity_timestamps)):
+                insert_trajectory(
+                    forklift_id,
+                    velocity_timestamps,
+                    coordinates,
+                    headings,
+                    velocities_abs,
+                    durations_s,
+                    zone_ids,
+                    writer,
+                    hot_weeks,
+                )
+            with span("insert_zone_visits") as attributes:
+                zone_visits = get_zone_visits(
+                    velocity_timestamps, durations_s, coordinates, zone_ids, zones
+                )
+                attributes["rows"] = len(zone_visits[0])
+                insert_zone_visits(forklift_id, zone_visits, writer)
 
-        if args.zones_path and is_insert_zones:
-            cur.execute(
-                "CREATE TABLE zones(x_min float, x_max float, y_min float, y_max float, name text)"
+        insert_shift(cur, forklift_id, shift_type, shift_start_ns, shift_end_ns)
+        data_start_ns, data_end_ns = None, None
+        if len(velocity_timestamps) > 0:
+            data_start_ns = int(velocity_timestamps.min())
+            data_end_ns = int(velocity_timestamps.max())
+            rollup_times += [data_start_ns, data_end_ns + 1]
+        with span("update_rollups"):
+            update_rollups(
+                cur, forklift_id, int(min(rollup_times)), int(max(rollup_times))
             )
-
-            insert_zones(
-                args.zones_path, args.session_path, args.floorplan_path, cur, con
+        if ingested_file is not None:
+            record_ingested_file(
+                cur,
+                forklift_id,
+                shift_record,
+                data_start_ns,
+                data_end_ns,
+                csv_path,
+                file_signature,
+                time.time_ns(),
             )
+        with span("update_proximity") as attributes:
+            attributes["rows"] = update_proximity(
+                cur, int(min(rollup_times)), int(max(rollup_times)), zones
+            )
+        bump_generation(cur)
+    return int(min(rollup_times)), int(max(rollup_times))
 
-        con.commit()
-
-    forklift_id = args.forklift_id
 
-    if not os.path.exists(args.csv_path):
-        sys.exit(0)
-    df = pandas.read_csv(
-        args.csv_path, dtype={"acq_timestamp [ns]": np.int64}, low_memory=False
+@traced()
+def open_database(db_path, zones_path, floorplan_path, session_path, batch_size=50000):
+    con = sqlite3.connect(
+        db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
     )
+    cur = con.cursor()
+    writer = BulkWriter(con, batch_size=batch_size)
+    is_creating_tables = is_empty_database(cur)
+    if not is_creating_tables and get_schema_version(cur) < SCHEMA_VERSION:
+        raise RuntimeError(
+            f"{db_path} has schema version {get_schema_version(cur)}, "
+            f"upgrade it to {SCHEMA_VERSION} with python migrate_db.py {db_path}"
+        )
+    create_schema(cur)
+    set_schema_version(cur, SCHEMA_VERSION)
+    con.commit()
+    if is_creating_tables:
+        if zones_path:
+            with writer.transaction():
+                insert_zones(zones_path, session_path, floorplan_path, writer)
+    return con, writer
 
-    # data processing params
-    time_subsampling_rate = 15
-    static_threshold = 0.05
-    # data processing starts here
-    velocities_abs, headings, velocity_timestamps, data_mask = get_velocities(
-        df, time_subsampling_rate
-    )
 
-    static_mask = velocities_abs < static_threshold
-    dynamic_mask = np.invert(static_mask)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_path")
+    parser.add_argument("forklift_id", type=int)
+    parser.add_argument("shift_type", choices=["day", "night"])
+    parser.add_argument("zones_path")
+    parser.add_argument("floorplan_path")
+    parser.add_argument("session_path")
+    parser.add_argument("--batch_size", type=int, default=50000)
+    parser.add_argument("--chunk_size", type=int, default=1000000)
+    parser.add_argument(
+        "--force", action="store_true", help="ingest even if already ingested"
+    )
+    parser.add_argument("--cache_dir", default=get_default_cache_dir())
+    parser.add_argument(
+        "--no_cache", action="store_true", help="parse the CSV without caching it"
+    )
+    parser.add_argument(
+        "--downsampling",
+        default="stride:15",
+        help="stride:RATE, time:SECONDS or error:METERS, see downsampling.py",
+    )
+    parser.add_argument(
+        "--hot_weeks",
+        type=int,
+        default=HOT_WEEKS,
+        help="weeks up to the newest one whose trajectory is also kept as rows, "
+        "older weeks are compacted to their chunks, see partitions.py",
+    )
+    parser.add_argument(
+        "--spans",
+        default=os.environ.get("AWARE_SPANS"),
+        help="JSONL file or .db the stage timings are recorded in, see instrumentation.py",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="ingest the lines appended to the CSV, or written to stdin if csv_path "
+        "is -, as they arrive, see live_ingest.py",
+    )
+    parser.add_argument(
+        "--batch_s", type=float, default=2.0, help="seconds between live writes"
+    )
+    parser.add_argument(
+        "--idle_timeout_s",
+        type=float,
+        default=600.0,
+        help="seconds without new lines after which a followed CSV is finished",
+    )
 
-    activity_timestamps = velocity_timestamps[dynamic_mask]
+    args = parser.parse_args()
+    try:
+        parse_downsampling(args.downsampling)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.hot_weeks < 0:
+        parser.error("--hot_weeks must not be negative")
+    if args.spans is not None:
+        configure_spans(args.spans)
 
-    # insert activities into DB
-    shift_start, shift_end = get_shift_time(velocity_timestamps, args.shift_type)
-    time_periods = get_activity_periods(
-        min_time_interval_ns, shift_start, shift_end, activity_timestamps
+    db_path = "aware_data.db"
+    con, writer = open_database(
+        db_path,
+        args.zones_path,
+        args.floorplan_path,
+        args.session_path,
+        batch_size=args.batch_size,
     )
 
-    insert_activity(forklift_id, time_periods, cur, con)
+    if args.follow:
+        from live_ingest import ingest_live
 
-    if not is_insert_trajectory:
-        exit()
+        writer.verbose = False
+        ingest_live(
+            writer,
+            args.forklift_id,
+            args.shift_type,
+            args.csv_path,
+            args.downsampling,
+            args.batch_s,
+            args.idle_timeout_s,
+            args.hot_weeks,
+        )
+        with span("update_statistics"):
+            update_statistics(con)
+        sys.exit(0)
 
-    # insert trajectory (locations, headings, velocities) into DB
-    fid_world_mask = (
-        df["reference_frame_category"] == "ReferenceFrameCategory.FiducialWorld"
-    )
-    trajectory_mask = data_mask * fid_world_mask
-    coordinates = np.stack(
-        [df["t_x [m]"].array[trajectory_mask], df["t_y [m]"].array[trajectory_mask]],
-        axis=1,
+    if not os.path.exists(args.csv_path):
+        sys.exit(0)
+    file_signature, is_ingested = get_file_signature(
+        con.cursor(), args.csv_path, args.forklift_id, args.shift_type
     )
-    trajectory_mask_for_data_mask = trajectory_mask[data_mask]
-    velocity_timestamps = velocity_timestamps[trajectory_mask_for_data_mask]
-    headings = headings[trajectory_mask_for_data_mask]
-    velocities_abs = velocities_abs[trajectory_mask_for_data_mask]
+    if is_ingested and not args.force:
+        print(f"Skipping unchanged {args.csv_path}")
+        sys.exit(0)
 
-    print(
-        f"Length of trajectory is {len(velocity_timestamps)} {len(coordinates)} {len(headings)} {len(velocities_abs)} "
+    processed_shift = process_shift(
+        args.csv_path,
+        args.shift_type,
+        chunk_size=args.chunk_size,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        content_hash=file_signature[0],
+        downsampling=args.downsampling,
     )
-    insert_trajectory(
-        forklift_id,
-        velocity_timestamps,
-        coordinates,
-        headings,
-        velocities_abs,
-        cur,
-        con,
+    write_shift(
+        args.forklift_id,
+        processed_shift,
+        writer,
+        ingested_file=(args.csv_path, file_signature),
+        hot_weeks=args.hot_weeks,
     )
+    with span("update_statistics"):
+        update_statistics(con)
 
     # database filled
@@ -0,0 +1,134 @@
+import os
+
+import xxhash
+
+from partitions import delete_trajectory_rows
+
+# Every ingested shift CSV is recorded in ingested_files with a hash of its
+# content, so re-running the ingest skips unchanged files. A changed file
+# replaces the rows of its forklift in its time range in the same transaction
+# as the new rows are written.
+
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def create_ingested_files_table(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS ingested_files(forklift_id int not null, shift_type text not null, shift_start_ns int not null, shift_end_ns int not null, data_start_ns int, data_end_ns int, csv_path text not null, content_hash text not null, size_bytes int, mtime_ns int, ingested_ns int, PRIMARY KEY(forklift_id, shift_start_ns))"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS ingested_files_path_index ON ingested_files(csv_path)"
+    )
+
+
+def get_file_hash(csv_path):
+    file_hash = xxhash.xxh3_128()
+    with open(csv_path, "rb") as csv_file:
+        while True:
+            block = csv_file.read(HASH_BLOCK_SIZE)
+            if len(block) == 0:
+                break
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_file_signature(cur, csv_path, forklift_id, shift_type):
+    # (content_hash, size_bytes, mtime_ns) of the file, and whether this
+    # content is already ingested for the forklift and shift type. The hash is
+    # reused without reading the file while its path, size and mtime match.
+    stat = os.stat(csv_path)
+    row = cur.execute(
+        "SELECT content_hash FROM ingested_files WHERE csv_path = ? "
+        "AND size_bytes = ? AND mtime_ns = ?",
+        (csv_path, stat.st_size, stat.st_mtime_ns),
+    ).fetchone()
+    content_hash = get_file_hash(csv_path) if row is None else row[0]
+    (ingested_count,) = cur.execute(
+        "SELECT count(*) FROM ingested_files WHERE forklift_id = ? "
+        "AND shift_type = ? AND content_hash = ?",
+        (forklift_id, shift_type, content_hash),
+    ).fetchone()
+    return (content_hash, stat.st_size, stat.st_mtime_ns), ingested_count > 0
+
+
+def delete_ingested_rows(cur, forklift_id, csv_path, shift_start_ns, shift_end_ns):
+    # Deletes the rows of the forklift within the shift and within the time
+    # ranges of earlier ingests of the same shift or file. Returns the deleted
+    # time range [start_ns, end_ns), for the rollups to be recomputed. Shift
+    # windows end before shift_end_ns, where the next shift starts, data
+    # ranges include data_end_ns.
+    ranges = cur.execute(
+        "SELECT shift_start_ns, min(shift_start_ns, coalesce(data_start_ns, "
+        "shift_start_ns)), max(shift_end_ns, coalesce(data_end_ns + 1, "
+        "shift_end_ns)) FROM ingested_files "
+        "WHERE forklift_id = ? AND (shift_start_ns = ? OR csv_path = ?)",
+        (forklift_id, shift_start_ns, csv_path),
+    ).fetchall()
+    start_ns = min([shift_start_ns] + [row[1] for row in ranges])
+    end_ns = max([shift_end_ns] + [row[2] for row in ranges])
+    parameters = {
+        "forklift_id": forklift_id,
+        "start_ns": start_ns,
+        "end_ns": end_ns,
+    }
+    delete_trajectory_rows(cur, forklift_id, start_ns, end_ns - 1)
+    for table in ["activity", "stops"]:
+        cur.execute(
+            f"DELETE FROM {table} WHERE forklift_id = :forklift_id "
+            "AND start_ns >= :start_ns AND start_ns < :end_ns",
+            parameters,
+        )
+    cur.execute(
+        "DELETE FROM zone_visits WHERE forklift_id = :forklift_id "
+        "AND enter_ns >= :start_ns AND enter_ns < :end_ns",
+        parameters,
+    )
+    for old_shift_start_ns, *_ in ranges:
+        cur.execute(
+            "DELETE FROM shifts WHERE forklift_id = ? AND start_ns = ?",
+            (forklift_id, old_shift_start_ns),
+        )
+        cur.execute(
+            "DELETE FROM rollup_forklift_shift WHERE forklift_id = ? "
+            "AND shift_start_ns = ?",
+            (forklift_id, old_shift_start_ns),
+        )
+    cur.execute(
+        "DELETE FROM ingested_files WHERE forklift_id = ? "
+        "AND (shift_start_ns = ? OR csv_path = ?)",
+        (forklift_id, shift_start_ns, csv_path),
+    )
+    return start_ns, end_ns
+
+
+def record_ingested_file(
+    cur,
+    forklift_id,
+    shift_record,
+    data_start_ns,
+    data_end_ns,
+    csv_path,
+    file_signature,
+    ingested_ns,
+):
+    shift_type, shift_start_ns, shift_end_ns = shift_record
+    content_hash, size_bytes, mtime_ns = file_signature
+    cur.execute(
+        "INSERT OR REPLACE INTO ingested_files(forklift_id, shift_type, "
+        "shift_start_ns, shift_end_ns, data_start_ns, data_end_ns, csv_path, "
+        "content_hash, size_bytes, mtime_ns, ingested_ns) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            forklift_id,
+            shift_type,
+            shift_start_ns,
+            shift_end_ns,
+            data_start_ns,
+            data_end_ns,
+            csv_path,
+            content_hash,
+            size_bytes,
+            mtime_ns,
+            ingested_ns,
+        ),
+    )
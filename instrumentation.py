@@ -0,0 +1,283 @@
+import argparse
+import contextlib
+import contextvars
+import datetime
+import functools
+import json
+import os
+import resource
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+# Spans time the stages of the ingest and of answering a question: wall and
+# CPU seconds, the peak resident memory of the process and counters set by the
+# stage, such as rows or tokens. They are appended to a JSONL file, or to the
+# metrics table of an SQLite file if the path ends in .db, one row per span,
+# and summarized per stage by running this file. Without a configured path
+# spans cost two clock reads and record nothing. The metrics table may be in
+# the database being ingested, whose write transaction is held by the caller
+# during nested spans, so spans are written there once the outermost span of
+# the thread closed.
+#
+#     with span("insert_trajectory") as attributes:
+#         attributes["rows"] = insert_trajectory(...)
+
+METRICS_DB_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+# numeric attributes telling spans apart rather than counting, besides *_id
+IDENTIFYING_ATTRIBUTES = ["branch"]
+SPAN_COLUMNS = [
+    "run_id",
+    "span_id",
+    "parent_id",
+    "name",
+    "start_ns",
+    "wall_seconds",
+    "cpu_seconds",
+    "peak_rss_mb",
+    "rss_growth_mb",
+    "pid",
+    "attributes",
+]
+
+spans_config = {"path": os.environ.get("AWARE_SPANS"), "run_id": None}
+current_span_id = contextvars.ContextVar("current_span_id", default=None)
+# per thread, the spans closed within its outer span, not yet written to a
+# metrics database
+pending_spans = threading.local()
+
+
+def configure_spans(path, run_id=None):
+    # also the initializer of worker processes, which pass the run_id of the
+    # process that started them
+    spans_config["path"] = path
+    spans_config["run_id"] = run_id or uuid.uuid4().hex[:12]
+    return spans_config["run_id"]
+
+
+def get_run_id():
+    if spans_config["run_id"] is None:
+        spans_config["run_id"] = uuid.uuid4().hex[:12]
+    return spans_config["run_id"]
+
+
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def is_metrics_db(path):
+    return path.endswith(METRICS_DB_EXTENSIONS)
+
+
+def create_metrics_table(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS metrics(run_id text, span_id text, parent_id text, name text, start_ns int, wall_seconds float, cpu_seconds float, peak_rss_mb float, rss_growth_mb float, pid int, attributes text)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS metrics_run_index ON metrics(run_id, start_ns)"
+    )
+
+
+def write_spans(path, records):
+    if is_metrics_db(path):
+        con = sqlite3.connect(path, timeout=30)
+        try:
+            with con:
+                create_metrics_table(con.cursor())
+                con.executemany(
+                    f"INSERT INTO metrics({', '.join(SPAN_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(SPAN_COLUMNS))})",
+                    [
+                        [record[column] for column in SPAN_COLUMNS[:-1]]
+                        + [json.dumps(record["attributes"], default=str)]
+                        for record in records
+                    ],
+                )
+        finally:
+            con.close()
+    else:
+        # one write per line, so lines of concurrent worker processes do not
+        # interleave
+        with open(path, "a") as spans_file:
+            for record in records:
+                spans_file.write(json.dumps(record, default=str) + "\n")
+
+
+def record_span(path, record):
+    records = [record]
+    if is_metrics_db(path):
+        if not hasattr(pending_spans, "records"):
+            pending_spans.records = []
+        pending_spans.records.append(record)
+        if record["parent_id"] is not None:
+            return
+        records = pending_spans.records
+        pending_spans.records = []
+    try:
+        write_spans(path, records)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Cannot record {len(records)} spans in {path}: {e}")
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    # yields the attributes, counters set on them are recorded with the span
+    path = spans_config["path"]
+    if path is None:
+        yield attributes
+        return
+    span_id = uuid.uuid4().hex[:16]
+    parent_id = current_span_id.get()
+    token = current_span_id.set(span_id)
+    start_ns = time.time_ns()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    peak_rss_start = get_peak_rss_mb()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        current_span_id.reset(token)
+        peak_rss = get_peak_rss_mb()
+        record = {
+            "run_id": get_run_id(),
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "name": name,
+            "start_ns": start_ns,
+            "wall_seconds": time.perf_counter() - wall_start,
+            "cpu_seconds": time.process_time() - cpu_start,
+            "peak_rss_mb": peak_rss,
+            "rss_growth_mb": peak_rss - peak_rss_start,
+            "pid": os.getpid(),
+            "attributes": attributes,
+        }
+        record_span(path, record)
+
+
+def traced(name=None):
+    # decorator running the function in a span named after it
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_iterator(iterable, attributes, key, rows_key=None, get_rows=len):
+    # adds the seconds spent producing the items to attributes[key], e.g. the
+    # parsing time of CSV chunks consumed by a later stage, and their rows,
+    # counted by get_rows, to attributes[rows_key]
+    attributes.setdefault(key, 0.0)
+    if rows_key is not None:
+        attributes.setdefault(rows_key, 0)
+    iterator = iter(iterable)
+    while True:
+        time_start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            attributes[key] += time.perf_counter() - time_start
+            return
+        attributes[key] += time.perf_counter() - time_start
+        if rows_key is not None:
+            attributes[rows_key] += get_rows(item)
+        yield item
+
+
+def load_spans(path):
+    # pandas is only imported for summarizing, spans are recorded without it
+    import pandas
+
+    if is_metrics_db(path):
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        spans = pandas.read_sql_query("SELECT * FROM metrics", con)
+        con.close()
+        spans["attributes"] = spans["attributes"].map(json.loads)
+    else:
+        spans = pandas.read_json(path, lines=True)
+    return spans
+
+
+def summarize_spans(spans):
+    # per span name: count, wall time statistics, CPU time, memory and the
+    # sums of the numeric attributes
+    import pandas
+
+    attributes = pandas.json_normalize(spans["attributes"].tolist())
+    # counters and flags are summed, identifiers are not
+    attributes = attributes.select_dtypes(["number", "bool"])
+    attributes = attributes.drop(
+        columns=[
+            column
+            for column in attributes.columns
+            if column.endswith("_id") or column in IDENTIFYING_ATTRIBUTES
+        ]
+    )
+    attributes = attributes.astype(float).add_prefix("sum_")
+    spans = pandas.concat(
+        [spans.drop(columns=["attributes"]).reset_index(drop=True), attributes],
+        axis=1,
+    )
+    groups = spans.groupby("name")
+    summary = pandas.DataFrame(
+        {
+            "count": groups.size(),
+            "total_s": groups["wall_seconds"].sum(),
+            "mean_s": groups["wall_seconds"].mean(),
+            "p95_s": groups["wall_seconds"].quantile(0.95),
+            "max_s": groups["wall_seconds"].max(),
+            "cpu_s": groups["cpu_seconds"].sum(),
+            "peak_rss_mb": groups["peak_rss_mb"].max(),
+            "rss_growth_mb": groups["rss_growth_mb"].max(),
+        }
+    )
+    summary = summary.join(groups[list(attributes.columns)].sum())
+    return summary.sort_values("total_s", ascending=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "spans_path",
+        nargs="?",
+        default=spans_config["path"],
+        help="JSONL file or metrics database, $AWARE_SPANS by default",
+    )
+    parser.add_argument("--run", help="run_id to summarize, the last run by default")
+    parser.add_argument("--all", action="store_true", help="summarize all runs")
+    parser.add_argument("--runs", action="store_true", help="list the runs")
+    args = parser.parse_args()
+    if args.spans_path is None:
+        parser.error("no spans file given")
+
+    spans = load_spans(args.spans_path)
+    if len(spans) == 0:
+        sys.exit(f"No spans in {args.spans_path}")
+    runs = spans.groupby("run_id").agg(
+        start_ns=("start_ns", "min"),
+        spans=("name", "size"),
+        wall_seconds=("wall_seconds", "max"),
+    )
+    runs = runs.sort_values("start_ns")
+    if args.runs:
+        runs["start"] = runs["start_ns"].map(
+            lambda start_ns: datetime.datetime.fromtimestamp(start_ns / 1e9)
+        )
+        print(runs.drop(columns=["start_ns"]).to_string())
+        sys.exit(0)
+    if not args.all:
+        run_id = args.run or runs.index[-1]
+        spans = spans[spans["run_id"] == run_id]
+        print(f"Run {run_id}")
+    print(summarize_spans(spans).to_string(float_format="{:.3f}".format))
@@ -10,8 +10,19 @@ from langchain.callbacks.tracers import ConsoleCallbackHandler
 
 import argparse
 import os
+import sqlite3
 from enum import Enum
 
+from instrumentation import configure_spans, span
+from llm_usage import TokenUsageHandler
+from reliable_graph import request_with_a_reliable_graph
+from schema_digest import get_hidden_tables, get_schema_digest_text
+from sql_cache import SQLResultCache
+from sql_guard import GuardedQuerySQLDatabaseTool
+
+# shared by all SQL executions of this process, keyed by the database generation
+sql_result_cache = SQLResultCache()
+
 
 class State(TypedDict):
     question: str
@@ -63,24 +74,36 @@ def request_with_a_single_query(question, db, llm):
     for message in query_prompt_template.messages:
         message.pretty_print()
 
+    # built once per database generation instead of introspecting on every call
+    table_info = get_schema_digest_text(db)
+
     def write_query(state: State):
         """Generate SQL query to fetch information."""
         prompt = query_prompt_template.invoke(
             {
                 "dialect": db.dialect,
                 "top_k": 10,
-                "table_info": db.get_table_info(),
+                "table_info": table_info,
                 "input": state["question"],
             }
         )
         structured_llm = llm.with_structured_output(QueryOutput)
-        result = structured_llm.invoke(prompt)
+        usage = TokenUsageHandler()
+        with span("write_query") as attributes:
+            result = structured_llm.invoke(prompt, config={"callbacks": [usage]})
+            attributes.update(usage.usage)
         return {"query": result["query"]}
 
+    execute_query_tool = GuardedQuerySQLDatabaseTool(db=db, cache=sql_result_cache)
+
     def execute_query(state: State):
         """Execute SQL query."""
-        execute_query_tool = QuerySQLDatabaseTool(db=db)
-        return {"result": execute_query_tool.invoke(state["query"])}
+        hits = sql_result_cache.stats()["hits"]
+        with span("execute_query") as attributes:
+            result = execute_query_tool.invoke(state["query"])
+            attributes["cache_hit"] = sql_result_cache.stats()["hits"] > hits
+            attributes["result_chars"] = len(result)
+        return {"result": result}
 
     def generate_answer(state: State):
         """Answer question using retrieved information as context."""
@@ -91,7 +114,10 @@ def request_with_a_single_query(question, db, llm):
             f"SQL Query: {state['query']}\n"
             f"SQL Result: {state['result']}"
         )
-        response = llm.invoke(prompt)
+        usage = TokenUsageHandler()
+        with span("generate_answer") as attributes:
+            response = llm.invoke(prompt, config={"callbacks": [usage]})
+            attributes.update(usage.usage)
         return {"answer": response.content}
 
     graph_builder = StateGraph(State).add_sequence(
@@ -129,10 +155,8 @@ def request_with_an_agent(question, db, llm):
     DO NOT make any DML statements (INSERT, UPDATE, DELETE, DROP etc.) to the
     database.
 
-    To start you should ALWAYS look at the tables in the database to see what you
-    can query. Do NOT skip this step.
-
-    Then you should query the schema of the most relevant tables.
+    The tables and views you can query, with their columns and value ranges, are
+    listed at the end of this message. Only use those columns.
 
     """.format(
         dialect="SQLite",
@@ -156,16 +180,59 @@ executing a query, rewrite the query and try again.
 DO NOT make any DML statements (INSERT, UPDATE, DELETE, DROP etc.) to the
 database.
 
-To start you should ALWAYS look at the tables in the database to see what you
-can query. Do NOT skip this step.
-
-Then you should query the schema of the most relevant tables.
+The tables and views you can query, with their columns and value ranges, are
+listed at the end of this message. Only use those columns.
+
+Times are stored as integer nanoseconds since the Unix epoch in the time_ns, start_ns
+and end_ns columns, which are indexed together with forklift_id. Always filter on
+those columns, converting local datetimes like this:
+time_ns >= strftime('%s', '2024-11-25 06:00:00', 'utc') * 1000000000
+The views trajectory_readable, activity_readable and stops_readable show the same
+rows with the times as local datetimes in the time, start and end columns; use them
+only to display times.
+
+For aggregate questions (active or idle time, distance driven, mean or maximum
+velocity, number of stops per forklift per hour or per shift) use the rollup tables
+instead of aggregating trajectory or activity rows:
+rollup_forklift_hour has one row per forklift and hour (hour_start_ns),
+rollup_forklift_shift has one row per forklift and shift (shift_type is day or night,
+shift_start_ns, shift_end_ns). Both have the columns active_seconds, idle_seconds,
+distance_m, mean_velocity, max_velocity and stop_count. The views
+rollup_forklift_hour_readable and rollup_forklift_shift_readable show the same rows
+with local datetimes.
+
+The trajectory points are not evenly spaced in time: duration_s is the number of
+seconds velocity_meters_per_second is averaged over, so the distance driven is
+sum(velocity_meters_per_second * duration_s), not a count of points.
 
 The table zones contains information about the zones defined in the facility.
 Every zone has a name. It is defined as a bounding box through minimum and maximum x and y values.
-Those values are stored in x_min and x_max columns.
-To identify whether a trajectory point is in the zone, it is enough to check if x
-for the trajectory point is between min_x and max_x and y is between min_y and max_y for the zone.
+Those values are stored in x_min, x_max, y_min and y_max columns.
+Every trajectory point is already assigned to the zone it is in: trajectory.zone_id
+is the id of the zone in the zones table, NULL if the point is outside of all zones.
+The view trajectory_zones only contains the points inside a zone.
+For questions about zones use the view trajectory_zones, which has the zone name in
+the zone column, and filter on it, e.g. WHERE zone = 'Goods-In'. Do NOT compare
+trajectory coordinates against zone boundaries.
+For how often or how long forklifts were in a zone use the table zone_visits, with
+one row per stay of a forklift in a zone: zone_id, enter_ns, exit_ns and duration_s
+in seconds, indexed by (zone_id, enter_ns) and (forklift_id, enter_ns). Count its
+rows for the number of visits and sum duration_s for the dwell time, e.g.
+SELECT count(*), sum(duration_s) FROM zone_visits
+WHERE zone_id = (SELECT id FROM zones WHERE name = 'Goods-In') AND forklift_id = 5.
+The view zone_visits_readable adds the zone name and the enter and exit datetimes.
+For forklifts close to each other use the table proximity_events, with one row
+per pair of forklifts within a few metres of each other: forklift_id and
+other_forklift_id (forklift_id < other_forklift_id, so match a forklift in either
+column), start_ns, end_ns, duration_s, min_distance_m and x, y and zone_id where they
+came closest. For how crowded a zone was use zone_congestion, per zone_id and
+hour_start_ns: max_forklifts at the same time, congested_seconds with two or more
+forklifts in the zone and forklift_seconds summed over the forklifts. The views
+proximity_events_readable and zone_congestion_readable add the zone names and datetimes.
+To find the zones containing an arbitrary point (px, py), use the R-tree zones_rtree:
+SELECT zones.name FROM zones_rtree JOIN zones ON zones.id = zones_rtree.id
+WHERE zones_rtree.x_min <= px AND zones_rtree.x_max >= px
+AND zones_rtree.y_min <= py AND zones_rtree.y_max >= py
 """.format(
         dialect="SQLite",
         top_k=5,
@@ -176,7 +243,23 @@ for the trajectory point is between min_x and max_x and y is between min_y and m
 
     toolkit = SQLDatabaseToolkit(db=db, llm=llm)
 
-    tools = toolkit.get_tools()
+    # The schema digest in the prompt replaces the list and schema tools.
+    # Queries of the agent run through the SQL guard, repeated ones are
+    # answered from the result cache.
+    schema_digest = get_schema_digest_text(db)
+    system_message += f"\nTables and views:\n{schema_digest}\n"
+    system_message_reliable += f"\nTables and views:\n{schema_digest}\n"
+    tools = [
+        (
+            GuardedQuerySQLDatabaseTool(
+                db=db, description=tool.description, cache=sql_result_cache
+            )
+            if type(tool) is QuerySQLDatabaseTool
+            else tool
+        )
+        for tool in toolkit.get_tools()
+        if tool.name not in ["sql_db_list_tables", "sql_db_schema"]
+    ]
 
     from langgraph.prebuilt import create_react_agent
     from langchain.globals import set_verbose, set_debug
@@ -186,28 +269,56 @@ for the trajectory point is between min_x and max_x and y is between min_y and m
 
     agent = create_react_agent(llm, tools, prompt=system_message)
 
-    for step in agent.stream(
-        {"messages": [{"role": "user", "content": question}]},
-        stream_mode="values",
-    ):
-        step["messages"][-1].pretty_print()
+    usage = TokenUsageHandler()
+    with span("agent") as attributes:
+        for step in agent.stream(
+            {"messages": [{"role": "user", "content": question}]},
+            {"callbacks": [usage]},
+            stream_mode="values",
+        ):
+            step["messages"][-1].pretty_print()
+        attributes.update(usage.usage)
 
 
 class LLMType(Enum):
     GEMINI = 1
     MISTRAL = 2
     OPENAI = 3
+    STUB = 4
 
 
 if __name__ == "__main__":
-    is_single_query = False
     llm_type = LLMType.OPENAI
 
     parser = argparse.ArgumentParser()
     parser.add_argument("question")
+    # reliable answers the question and two reformulations concurrently
+    parser.add_argument(
+        "--mode", choices=["single", "agent", "reliable"], default="agent"
+    )
+    # local chat model without network access, see stub_chat_model.py
+    parser.add_argument("--stub", action="store_true")
+    parser.add_argument("--branch_timeout", type=float, default=60.0)
+    parser.add_argument(
+        "--spans",
+        default=os.environ.get("AWARE_SPANS"),
+        help="JSONL file or .db to record the timing of the steps in",
+    )
     args = parser.parse_args()
+    configure_spans(args.spans)
+    if args.stub:
+        llm_type = LLMType.STUB
     # db = SQLDatabase.from_uri("sqlite:///Chinook.db")
-    db = SQLDatabase.from_uri("sqlite:///aware_data.db")
+    # the agent sees the tables of the schema digest, the weekly partitions
+    # only through the trajectory view
+    con = sqlite3.connect("file:aware_data.db?mode=ro", uri=True)
+    ignore_tables = get_hidden_tables(con.cursor())
+    con.close()
+    db = SQLDatabase.from_uri(
+        "sqlite:///aware_data.db",
+        ignore_tables=ignore_tables,
+        view_support=True,
+    )
     print(db.dialect)
     print(db.get_usable_table_names())
 
@@ -220,11 +331,22 @@ if __name__ == "__main__":
     elif llm_type == LLMType.MISTRAL:
         os.environ["MISTRAL_API_KEY"] = "zDyBZHJujQwCjujL2u7yRRU1NLCiccnL"
         llm = init_chat_model("mistral-large-latest", model_provider="mistralai")
+    elif llm_type == LLMType.STUB:
+        from stub_chat_model import StubChatModel
+
+        llm = StubChatModel()
     else:
         if not os.environ.get("OPENAI_API_KEY"):
             os.environ["OPENAI_API_KEY"] = ""
         llm = init_chat_model("gpt-5", model_provider="openai")
-    if is_single_query:
-        request_with_a_single_query(args.question, db, llm)
-    else:
-        request_with_an_agent(args.question, db, llm)
+    with span("question", mode=args.mode) as attributes:
+        if args.mode == "single":
+            request_with_a_single_query(args.question, db, llm)
+        elif args.mode == "reliable":
+            request_with_a_reliable_graph(
+                args.question, db, llm, sql_result_cache, args.branch_timeout
+            )
+        else:
+            request_with_an_agent(args.question, db, llm)
+        attributes["sql_cache_hits"] = sql_result_cache.stats()["hits"]
+    print(f"SQL result cache: {sql_result_cache.stats()}")
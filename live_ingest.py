@@ -0,0 +1,584 @@
+import io
+import os
+import select
+import stat
+import sys
+import time
+
+import numpy as np
+import pandas
+
+from ingest_trajectory import insert_activity, insert_stops, insert_trajectory
+from ingested_files import (
+    delete_ingested_rows,
+    get_file_signature,
+    record_ingested_file,
+)
+from instrumentation import span
+from partitions import HOT_WEEKS
+from proximity import update_proximity
+from rollups import insert_shift, update_rollups
+from schema import bump_generation
+from segmentation import STATIC_VELOCITY_M_S, get_stopping_locations
+from trajectory_chunks import delete_trajectory_chunks, insert_trajectory_chunks
+from util import (
+    SHIFT_CSV_DTYPES,
+    get_shift_frame,
+    get_shift_time,
+    get_velocities_chunked,
+)
+from zone_visits import get_zone_runs, insert_zone_visits, is_zone_visit
+from zones import get_zone_ids, load_zones
+
+# Live ingest of a shift still being recorded: the lines appended to a shift
+# CSV, or written to a pipe standing in for the localization feed, are read
+# in micro-batches of BATCH_S and written in one transaction each, so a pose
+# is queryable a few seconds after it is written:
+#
+#     python ingest_trajectory.py 4_shift_20241125_0600.csv 4 day zones.csv floorplan.png map.session --follow
+#     localization_feed | python ingest_trajectory.py - 4 day zones.csv floorplan.png map.session --follow
+#
+# Velocities are computed by util.get_velocities_chunked, which carries the
+# downsampling state and the undecided poses over to the next batch. The
+# activity periods, stops and zone visits are derived from the rows of the
+# batch and the ones going on at its start, see LiveShift, so a batch costs
+# the same at any point of the shift. Only the rows that changed, usually the
+# last one, are written again. When the feed ends, after IDLE_TIMEOUT_S
+# without new lines or at the end of the pipe, the trajectory chunks are
+# packed again per minute, proximity is updated and the CSV is recorded as
+# ingested. A pipe carries on into the next shift at the end of a shift.
+
+BATCH_S = 2.0
+POLL_S = 0.25
+IDLE_TIMEOUT_S = 600.0
+PROXIMITY_INTERVAL_NS = 300 * 1000000000
+READ_SIZE = 1 << 20
+NEXT_SHIFT_TYPE = {"day": "night", "night": "day"}
+
+
+def read_new_bytes(stream, is_pipe, poll_s):
+    # the bytes appended since the last read, b"" if none, None at the end of
+    # a pipe. Files are polled, they only end by the idle timeout.
+    if is_pipe:
+        is_ready, _, _ = select.select([stream], [], [], poll_s)
+        if not is_ready:
+            return b""
+        data = os.read(stream.fileno(), READ_SIZE)
+        return None if len(data) == 0 else data
+    data = stream.read(READ_SIZE)
+    if len(data) == 0:
+        time.sleep(poll_s)
+    return data
+
+
+def parse_shift_lines(header, lines, categories, positions_dtype):
+    chunk = pandas.read_csv(
+        io.BytesIO(header + lines),
+        usecols=list(SHIFT_CSV_DTYPES.keys()),
+        dtype=SHIFT_CSV_DTYPES,
+    )
+    return get_shift_frame(chunk, categories, positions_dtype)
+
+
+def follow_shift_frames(
+    csv_path,
+    batch_s=BATCH_S,
+    poll_s=POLL_S,
+    idle_timeout_s=IDLE_TIMEOUT_S,
+    positions_dtype=np.float64,
+):
+    # util.ShiftFrames of the complete lines appended to csv_path, or written
+    # to stdin if csv_path is -, one every batch_s at most
+    stream = sys.stdin.buffer if csv_path == "-" else open(csv_path, "rb")
+    is_pipe = not stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    categories = {}
+    header = None
+    pending = b""
+    lines = b""
+    batch_start = None
+    last_data = time.monotonic()
+    try:
+        while True:
+            data = read_new_bytes(stream, is_pipe, poll_s)
+            now = time.monotonic()
+            is_ended = data is None or (
+                idle_timeout_s is not None and now - last_data > idle_timeout_s
+            )
+            if data:
+                last_data = now
+                pending += data
+            # a last line without a newline is complete once the feed ends
+            lines_end = len(pending) if is_ended else pending.rfind(b"\n") + 1
+            if lines_end > 0:
+                if header is None:
+                    header_end = pending.find(b"\n") + 1 or lines_end
+                    header = pending[:header_end]
+                    pending = pending[header_end:]
+                    lines_end -= header_end
+                if lines_end > 0 and batch_start is None:
+                    batch_start = now
+                lines += pending[:lines_end]
+                pending = pending[lines_end:]
+            if len(lines.strip()) > 0 and (is_ended or now - batch_start >= batch_s):
+                yield parse_shift_lines(header, lines, categories, positions_dtype)
+                lines = b""
+                batch_start = None
+            if is_ended:
+                return
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+
+def replace_changed_rows(cur, table, time_column, forklift_id, written, rows):
+    # Writes rows, the rows of the forklift in table from the open tail on,
+    # over written, the open tail as written before: only the rows from the
+    # first one that changed on are deleted and inserted again. Returns the
+    # index of that row.
+    changed = 0
+    while changed < min(len(written), len(rows)) and written[changed] == rows[changed]:
+        changed += 1
+    if changed < len(written):
+        cur.execute(
+            f"DELETE FROM {table} WHERE forklift_id = ? AND {time_column} >= ? "
+            f"AND {time_column} <= ?",
+            (forklift_id, int(written[changed][0]), int(written[-1][0])),
+        )
+    return changed
+
+
+class ColumnBuffer:
+    # columns appended batch by batch into arrays grown by doubling, so every
+    # row is copied a constant number of times on average
+    def __init__(self):
+        self.columns = None
+        self.rows_count = 0
+
+    def append(self, columns):
+        rows_count = self.rows_count + len(columns[0])
+        if self.columns is None or rows_count > len(self.columns[0]):
+            capacity = max(rows_count, 2 * self.rows_count, 1024)
+            grown = [
+                np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+                for column in columns
+            ]
+            if self.columns is not None:
+                for grown_column, column in zip(grown, self.get()):
+                    grown_column[: self.rows_count] = column
+            self.columns = grown
+        for buffer_column, column in zip(self.columns, columns):
+            buffer_column[self.rows_count : rows_count] = column
+        self.rows_count = rows_count
+
+    def get(self):
+        return [column[: self.rows_count] for column in self.columns]
+
+
+class LiveShift:
+    # The rows of one shift of a forklift, written as its velocities arrive.
+    # Activity periods, stops and zone visits are derived as by
+    # process_velocities and write_shift from the rows of each batch and the
+    # state at the end of the previous one: the activity period, the stop and
+    # the zone visit going on. Those are the open tail, rewritten when a batch
+    # extends or closes them, the rows before it are final.
+    def __init__(
+        self,
+        writer,
+        forklift_id,
+        shift_type,
+        first_timestamp_ns,
+        csv_path=None,
+        static_threshold=STATIC_VELOCITY_M_S,
+        min_time_interval_ns=600 * 1e9,
+        hot_weeks=HOT_WEEKS,
+    ):
+        self.writer = writer
+        self.forklift_id = forklift_id
+        self.shift_type = shift_type
+        self.csv_path = csv_path
+        self.static_threshold = static_threshold
+        self.min_time_interval_ns = min_time_interval_ns
+        self.hot_weeks = hot_weeks
+        shift_start, shift_end = get_shift_time(
+            np.array([first_timestamp_ns]), shift_type
+        )
+        self.shift_start_ns = int(shift_start.timestamp()) * int(1e9)
+        self.shift_end_ns = int(shift_end.timestamp()) * int(1e9)
+        # the trajectory rows of the shift, packed into chunks again at the
+        # end, and the range of all velocity times
+        self.trajectory = ColumnBuffer()
+        self.data_range = None
+        # the last activity time, the shift start before the first, and the
+        # start of the activity after the last inactivity gap, None before the
+        # first gap, see segmentation.get_activity_periods
+        self.last_activity_ns = self.shift_start_ns
+        self.activity_start_ns = None
+        # (start_ns, end_ns, x, y) of the stop going on, if any
+        self.open_stop = None
+        # the zone run going on, as previous_run of get_zone_runs
+        self.zone_run = None
+        # the open tails as written, each row starting with its start time
+        self.open_rows = {"activity": [], "stops": [], "zone_visits": []}
+        self.proximity_start_ns = int(first_timestamp_ns)
+        cur = writer.con.cursor()
+        self.zones = load_zones(cur)
+        with writer.transaction():
+            # rows of an earlier run of the live ingest of this shift, or of
+            # an ingest of the file, are replaced
+            deleted_start_ns, deleted_end_ns = delete_ingested_rows(
+                cur,
+                forklift_id,
+                csv_path or "-",
+                self.shift_start_ns,
+                self.shift_end_ns,
+            )
+            insert_shift(
+                cur, forklift_id, shift_type, self.shift_start_ns, self.shift_end_ns
+            )
+            update_rollups(cur, forklift_id, deleted_start_ns, deleted_end_ns)
+            bump_generation(cur)
+        print(
+            f"Following the {shift_type} shift of forklift {forklift_id} from "
+            f"{shift_start} to {shift_end}"
+        )
+
+    def append(self, velocity_chunk):
+        # writes a batch of the output of util.get_velocities_chunked
+        (
+            velocities_abs,
+            headings,
+            velocity_timestamps,
+            _,
+            coordinates,
+            fid_world_mask,
+            durations_s,
+        ) = velocity_chunk
+        if len(velocity_timestamps) == 0:
+            return
+        batch_start_ns = int(velocity_timestamps.min())
+        batch_end_ns = int(velocity_timestamps.max()) + 1
+        if self.data_range is None:
+            self.data_range = (batch_start_ns, batch_end_ns - 1)
+        self.data_range = (
+            min(self.data_range[0], batch_start_ns),
+            max(self.data_range[1], batch_end_ns - 1),
+        )
+        trajectory_rows = np.flatnonzero(fid_world_mask)
+        zone_ids = get_zone_ids(coordinates[trajectory_rows], self.zones)
+        trajectory_columns = (
+            velocity_timestamps[trajectory_rows],
+            coordinates[trajectory_rows],
+            headings[trajectory_rows],
+            velocities_abs[trajectory_rows],
+            durations_s[trajectory_rows],
+            zone_ids,
+        )
+        self.trajectory.append(trajectory_columns)
+        cur = self.writer.con.cursor()
+        with span(
+            "live_batch", forklift_id=self.forklift_id, rows=len(trajectory_rows)
+        ), self.writer.transaction():
+            insert_trajectory(
+                self.forklift_id, *trajectory_columns, self.writer, self.hot_weeks
+            )
+            changed_start_ns = self.update_derived_rows(velocity_chunk, zone_ids)
+            update_rollups(
+                cur,
+                self.forklift_id,
+                min(changed_start_ns, batch_start_ns),
+                batch_end_ns,
+            )
+            if batch_end_ns - self.proximity_start_ns >= PROXIMITY_INTERVAL_NS:
+                update_proximity(cur, self.proximity_start_ns, batch_end_ns, self.zones)
+                self.proximity_start_ns = batch_end_ns
+            bump_generation(cur)
+
+    def get_activity_rows(self, velocity_timestamps, velocities_abs):
+        # (start_ns, end_ns) of the activity periods the batch closed, then of
+        # the one going on, and the number of closed ones
+        activity_timestamps = velocity_timestamps[
+            ~(velocities_abs < self.static_threshold)
+        ]
+        sequence = np.concatenate([[self.last_activity_ns], activity_timestamps])
+        gaps = np.flatnonzero(np.diff(sequence) > self.min_time_interval_ns)
+        # active from the end of a gap to the start of the next one, there is
+        # no period before the first gap
+        starts = [self.activity_start_ns] + sequence[gaps + 1].tolist()
+        rows = list(zip(starts[:-1], sequence[gaps].tolist()))
+        if self.activity_start_ns is None:
+            rows = rows[1:]
+        self.activity_start_ns = starts[-1]
+        self.last_activity_ns = int(sequence[-1])
+        closed_count = len(rows)
+        # active after the last gap until the last activity, inactive until
+        # the shift end
+        if (
+            self.activity_start_ns is not None
+            and self.last_activity_ns < self.shift_end_ns
+        ):
+            rows.append((self.activity_start_ns, self.last_activity_ns))
+        return rows, closed_count
+
+    def get_stop_rows(
+        self, pose_timestamps, velocity_timestamps, coordinates, velocities_abs
+    ):
+        # (start_ns, end_ns, x, y) of the stops the batch closed, then of the
+        # one going on, and the number of closed ones. The stop going on is
+        # continued from a static row standing in for its rows.
+        x, y = coordinates[:, 0], coordinates[:, 1]
+        if self.open_stop is not None:
+            start_ns, end_ns, stop_x, stop_y = self.open_stop
+            pose_timestamps = np.concatenate([[end_ns], pose_timestamps])
+            velocity_timestamps = np.concatenate([[start_ns], velocity_timestamps])
+            x = np.concatenate([[stop_x], x])
+            y = np.concatenate([[stop_y], y])
+            velocities_abs = np.concatenate([[-np.inf], velocities_abs])
+        starts, ends, stop_x, stop_y = get_stopping_locations(
+            pose_timestamps,
+            x,
+            y,
+            velocities_abs,
+            self.static_threshold,
+            velocity_timestamps,
+        )
+        rows = list(
+            zip(starts.tolist(), ends.tolist(), stop_x.tolist(), stop_y.tolist())
+        )
+        is_open = len(velocities_abs) > 0 and velocities_abs[-1] < self.static_threshold
+        self.open_stop = rows[-1] if is_open else None
+        return rows, len(rows) - is_open
+
+    def get_zone_visit_rows(
+        self, velocity_timestamps, durations_s, coordinates, zone_ids
+    ):
+        # (enter_ns, exit_ns, zone_id) of the zone visits the batch closed,
+        # then of the one going on, and the number of closed ones
+        open_rows = self.open_rows["zone_visits"]
+        if len(velocity_timestamps) == 0:
+            return open_rows, 0
+        states, enter_ns, exit_ns = get_zone_runs(
+            velocity_timestamps,
+            durations_s,
+            coordinates,
+            zone_ids,
+            self.zones,
+            previous_run=self.zone_run,
+        )
+        is_visit = is_zone_visit(states, enter_ns, exit_ns)
+        rows = list(
+            zip(
+                enter_ns[is_visit].tolist(),
+                exit_ns[is_visit].tolist(),
+                states[is_visit].tolist(),
+            )
+        )
+        closed_count = len(rows) - int(is_visit[-1])
+        if self.zone_run is not None and enter_ns[0] != self.zone_run[2]:
+            # the visit going on ended with the previous batch
+            rows = open_rows + rows
+            closed_count += len(open_rows)
+        inside_rows = np.flatnonzero(zone_ids >= 0)
+        last_zone_id = -1 if self.zone_run is None else self.zone_run[0]
+        if len(inside_rows) > 0:
+            last_zone_id = int(zone_ids[inside_rows[-1]])
+        self.zone_run = (
+            last_zone_id,
+            int(states[-1]),
+            int(enter_ns[-1]),
+            int(exit_ns[-1]),
+        )
+        return rows, closed_count
+
+    def update_derived_rows(self, velocity_chunk, zone_ids):
+        # Writes the activity periods, stops and zone visits the batch closed
+        # or changed. Returns the earliest time a row changed.
+        (
+            velocities_abs,
+            _,
+            velocity_timestamps,
+            pose_timestamps,
+            coordinates,
+            fid_world_mask,
+            durations_s,
+        ) = velocity_chunk
+        trajectory_rows = np.flatnonzero(fid_world_mask)
+        rows = {
+            "activity": (
+                "start_ns",
+                self.get_activity_rows(velocity_timestamps, velocities_abs),
+                lambda new_rows: insert_activity(
+                    self.forklift_id,
+                    [(start_ns, end_ns, 1) for start_ns, end_ns in new_rows],
+                    self.writer,
+                ),
+            ),
+            "stops": (
+                "start_ns",
+                self.get_stop_rows(
+                    pose_timestamps[trajectory_rows],
+                    velocity_timestamps[trajectory_rows],
+                    coordinates[trajectory_rows],
+                    velocities_abs[trajectory_rows],
+                ),
+                lambda new_rows: insert_stops(
+                    self.forklift_id,
+                    tuple(np.array(values) for values in zip(*new_rows)),
+                    self.writer,
+                ),
+            ),
+            "zone_visits": (
+                "enter_ns",
+                self.get_zone_visit_rows(
+                    velocity_timestamps[trajectory_rows],
+                    durations_s[trajectory_rows],
+                    coordinates[trajectory_rows],
+                    zone_ids,
+                ),
+                lambda new_rows: insert_zone_visits(
+                    self.forklift_id,
+                    tuple(
+                        np.array([row[column] for row in new_rows])
+                        for column in [2, 0, 1]
+                    ),
+                    self.writer,
+                ),
+            ),
+        }
+        changed_start_ns = self.shift_end_ns
+        cur = self.writer.con.cursor()
+        for table, (
+            time_column,
+            (table_rows, closed_count),
+            insert_rows,
+        ) in rows.items():
+            written = self.open_rows[table]
+            changed = replace_changed_rows(
+                cur, table, time_column, self.forklift_id, written, table_rows
+            )
+            if changed < len(table_rows):
+                insert_rows(table_rows[changed:])
+            changed_rows = written[changed:] + table_rows[changed:]
+            if len(changed_rows) > 0:
+                changed_start_ns = min(
+                    [changed_start_ns] + [int(row[0]) for row in changed_rows]
+                )
+            self.open_rows[table] = table_rows[closed_count:]
+        return changed_start_ns
+
+    def finish(self):
+        # packs the chunks of the shift per minute, which the batches split,
+        # and records the CSV as ingested
+        if self.data_range is None:
+            return
+        (
+            velocity_timestamps,
+            coordinates,
+            headings,
+            velocities_abs,
+            durations_s,
+            zone_ids,
+        ) = self.trajectory.get()
+        data_start_ns, data_end_ns = self.data_range
+        # recorded as write_shift does, from the trajectory rows
+        trajectory_range = (None, None)
+        if len(velocity_timestamps) > 0:
+            trajectory_range = (
+                int(velocity_timestamps.min()),
+                int(velocity_timestamps.max()),
+            )
+        cur = self.writer.con.cursor()
+        with span(
+            "live_finish", forklift_id=self.forklift_id
+        ), self.writer.transaction():
+            delete_trajectory_chunks(cur, self.forklift_id, data_start_ns, data_end_ns)
+            insert_trajectory_chunks(
+                cur,
+                self.forklift_id,
+                velocity_timestamps,
+                coordinates,
+                headings,
+                velocities_abs,
+                durations_s,
+                zone_ids,
+            )
+            # the hours of the shift after the last pose are idle
+            update_rollups(
+                cur,
+                self.forklift_id,
+                min(self.shift_start_ns, data_start_ns),
+                max(self.shift_end_ns, data_end_ns + 1),
+            )
+            update_proximity(cur, self.proximity_start_ns, data_end_ns + 1, self.zones)
+            if self.csv_path is not None:
+                file_signature, _ = get_file_signature(
+                    cur, self.csv_path, self.forklift_id, self.shift_type
+                )
+                record_ingested_file(
+                    cur,
+                    self.forklift_id,
+                    (self.shift_type, self.shift_start_ns, self.shift_end_ns),
+                    *trajectory_range,
+                    self.csv_path,
+                    file_signature,
+                    time.time_ns(),
+                )
+            bump_generation(cur)
+        print(
+            f"Ingested {len(velocity_timestamps)} trajectory rows of forklift "
+            f"{self.forklift_id} live"
+        )
+
+
+def split_velocity_chunk(velocity_chunk, mask):
+    return tuple(values[mask] for values in velocity_chunk)
+
+
+def ingest_live(
+    writer,
+    forklift_id,
+    shift_type,
+    csv_path,
+    downsampling="stride:15",
+    batch_s=BATCH_S,
+    idle_timeout_s=IDLE_TIMEOUT_S,
+    hot_weeks=HOT_WEEKS,
+):
+    # follows csv_path, or stdin if it is -, until the feed ends or is
+    # interrupted; hot_weeks is as for ingest_trajectory.insert_trajectory
+    live_shift = None
+    is_file = csv_path != "-"
+    try:
+        for velocity_chunk in get_velocities_chunked(
+            follow_shift_frames(csv_path, batch_s, idle_timeout_s=idle_timeout_s),
+            downsampling,
+        ):
+            velocity_timestamps = velocity_chunk[2]
+            if len(velocity_timestamps) == 0:
+                continue
+            if live_shift is None:
+                live_shift = LiveShift(
+                    writer,
+                    forklift_id,
+                    shift_type,
+                    velocity_timestamps[0],
+                    csv_path if is_file else None,
+                    hot_weeks=hot_weeks,
+                )
+            is_next_shift = velocity_timestamps >= live_shift.shift_end_ns
+            # a shift CSV is a single shift, as for the ingest of the file
+            if not is_file and is_next_shift.any():
+                live_shift.append(split_velocity_chunk(velocity_chunk, ~is_next_shift))
+                live_shift.finish()
+                velocity_chunk = split_velocity_chunk(velocity_chunk, is_next_shift)
+                live_shift = LiveShift(
+                    writer,
+                    forklift_id,
+                    NEXT_SHIFT_TYPE[live_shift.shift_type],
+                    velocity_chunk[2][0],
+                    hot_weeks=hot_weeks,
+                )
+            live_shift.append(velocity_chunk)
+    except KeyboardInterrupt:
+        print("Interrupted, finishing the shift")
+    if live_shift is not None:
+        live_shift.finish()
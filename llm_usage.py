@@ -0,0 +1,34 @@
+import threading
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Token counts of the chat model calls, summed from the usage_metadata of the
+# returned messages. Passed as a callback to the calls or graphs whose tokens
+# are recorded with their span:
+#
+#     usage = TokenUsageHandler()
+#     with span("generate_answer") as attributes:
+#         llm.invoke(prompt, config={"callbacks": [usage]})
+#         attributes.update(usage.usage)
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    def __init__(self):
+        super().__init__()
+        self.usage = {"llm_calls": 0, "input_tokens": 0, "output_tokens": 0}
+        # concurrent branches report from several threads
+        self.lock = threading.Lock()
+
+    def on_llm_end(self, response, **kwargs):
+        with self.lock:
+            self.usage["llm_calls"] += 1
+            for generations in response.generations:
+                for generation in generations:
+                    message = getattr(generation, "message", None)
+                    usage_metadata = getattr(message, "usage_metadata", None)
+                    if usage_metadata is None:
+                        continue
+                    self.usage["input_tokens"] += usage_metadata.get("input_tokens", 0)
+                    self.usage["output_tokens"] += usage_metadata.get(
+                        "output_tokens", 0
+                    )
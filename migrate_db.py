@@ -0,0 +1,253 @@
+import argparse
+import sqlite3
+import time
+
+from db_util import update_statistics
+from downsampling import MAX_POSE_INTERVAL_NS
+from schema import (
+    SCHEMA_VERSION,
+    bump_generation,
+    create_schema,
+    drop_views,
+    get_schema_version,
+    is_empty_database,
+    set_schema_version,
+)
+from partitions import (
+    create_trajectory_table,
+    fill_trajectory_chunks,
+    partition_trajectory,
+)
+from proximity import rebuild_proximity
+from rollups import backfill_shifts, rebuild_rollups
+from zone_visits import rebuild_zone_visits
+from zones import fill_zones_rtree, load_zones
+
+
+def get_tables(cur):
+    rows = cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return [row[0] for row in rows.fetchall()]
+
+
+def get_columns(cur, table):
+    return [row[1] for row in cur.execute(f"PRAGMA table_info({table})")]
+
+
+def epoch_ns_sql(column):
+    # legacy times are local datetime strings with whole seconds
+    return f"CAST(strftime('%s', {column}, 'utc') AS INTEGER) * 1000000000"
+
+
+def assign_missing_zone_ids(cur):
+    cur.execute(
+        "UPDATE trajectory SET zone_id = ("
+        "SELECT zones.id FROM zones_rtree JOIN zones ON zones.id = zones_rtree.id "
+        "WHERE zones_rtree.x_min <= trajectory.x AND zones_rtree.x_max >= trajectory.x "
+        "AND zones_rtree.y_min <= trajectory.y AND zones_rtree.y_max >= trajectory.y "
+        "AND zones.x_min <= trajectory.x AND zones.x_max >= trajectory.x "
+        "AND zones.y_min <= trajectory.y AND zones.y_max >= trajectory.y "
+        "ORDER BY (zones.x_max - zones.x_min) * (zones.y_max - zones.y_min), zones.id "
+        "LIMIT 1) WHERE zone_id IS NULL"
+    )
+
+
+def migrate_v0_to_v1(cur):
+    # text timestamps become integer nanoseconds, indexes and views are added
+    legacy_tables = [
+        table
+        for table in ["trajectory", "activity", "stops", "zones"]
+        if table in get_tables(cur)
+    ]
+    drop_views(cur)
+    legacy_indexes = cur.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"
+    ).fetchall()
+    for (index,) in legacy_indexes:
+        cur.execute(f"DROP INDEX {index}")
+    for table in legacy_tables:
+        cur.execute(f"ALTER TABLE {table} RENAME TO {table}_v0")
+
+    # a single trajectory table, partitioned by migrate_v7_to_v8
+    create_trajectory_table(cur, "trajectory")
+    create_schema(cur)
+
+    if "zones" in legacy_tables:
+        cur.execute(
+            "INSERT INTO zones(id, x_min, x_max, y_min, y_max, name) "
+            "SELECT rowid, min(x_min, x_max), max(x_min, x_max), "
+            "min(y_min, y_max), max(y_min, y_max), name FROM zones_v0"
+        )
+        fill_zones_rtree(cur)
+    if "trajectory" in legacy_tables:
+        zone_id = (
+            "zone_id" if "zone_id" in get_columns(cur, "trajectory_v0") else "NULL"
+        )
+        cur.execute(
+            "INSERT INTO trajectory(forklift_id, time_ns, x, y, heading_x, heading_y, velocity_meters_per_second, zone_id) "
+            f"SELECT forklift_id, {epoch_ns_sql('time')}, x, y, heading_x, heading_y, velocity_meters_per_second, {zone_id} "
+            "FROM trajectory_v0"
+        )
+        assign_missing_zone_ids(cur)
+    if "activity" in legacy_tables:
+        cur.execute(
+            "INSERT INTO activity(forklift_id, start_ns, end_ns) "
+            f"SELECT forklift_id, {epoch_ns_sql('start')}, {epoch_ns_sql('end')} "
+            "FROM activity_v0"
+        )
+    if "stops" in legacy_tables:
+        cur.execute(
+            "INSERT INTO stops(forklift_id, start_ns, end_ns, x, y) "
+            f"SELECT forklift_id, {epoch_ns_sql('start')}, {epoch_ns_sql('end')}, x, y "
+            "FROM stops_v0"
+        )
+
+    for table in legacy_tables:
+        cur.execute(f"DROP TABLE {table}_v0")
+
+
+def migrate_v1_to_v2(cur):
+    # rollup tables are created by create_schema, shifts are inferred from
+    # the trajectory times
+    create_schema(cur)
+    backfill_shifts(cur)
+    rebuild_rollups(cur)
+
+
+def migrate_v2_to_v3(cur):
+    create_schema(cur)
+
+
+def migrate_v3_to_v4(cur):
+    # files ingested before are not in ingested_files, their first re-ingest
+    # replaces the rows of their shift
+    create_schema(cur)
+
+
+def fill_legacy_durations(cur):
+    # Rows before version 5 hold the displacement between two kept poses as
+    # their velocity. A row starts at the first pose of its pair, so the pair
+    # lasts until the next row of the forklift if that continues it; else the
+    # mean of the forklift's pairs is assumed. The velocities become m/s, rows
+    # of forklifts without any continued pair keep a NULL duration_s.
+    cur.execute(
+        "CREATE TEMP TABLE legacy_durations AS SELECT rowid AS row_id, forklift_id, "
+        "(lead(time_ns) OVER (PARTITION BY forklift_id ORDER BY time_ns) - time_ns) "
+        "/ 1e9 AS duration_s FROM trajectory"
+    )
+    cur.execute(
+        "UPDATE legacy_durations SET duration_s = NULL "
+        "WHERE NOT (duration_s > 0 AND duration_s < ?)",
+        (MAX_POSE_INTERVAL_NS / 1e9,),
+    )
+    cur.execute(
+        "UPDATE legacy_durations SET duration_s = mean_durations.duration_s "
+        "FROM (SELECT forklift_id, avg(duration_s) AS duration_s "
+        "FROM legacy_durations GROUP BY forklift_id) AS mean_durations "
+        "WHERE legacy_durations.duration_s IS NULL "
+        "AND mean_durations.forklift_id = legacy_durations.forklift_id"
+    )
+    cur.execute(
+        "UPDATE trajectory SET duration_s = legacy_durations.duration_s, "
+        "velocity_meters_per_second = "
+        "velocity_meters_per_second / legacy_durations.duration_s "
+        "FROM legacy_durations WHERE legacy_durations.row_id = trajectory.rowid "
+        "AND legacy_durations.duration_s IS NOT NULL "
+        "AND trajectory.duration_s IS NULL"
+    )
+    cur.execute("DROP TABLE legacy_durations")
+
+
+def migrate_v4_to_v5(cur):
+    # create_schema adds the new columns, the velocities are converted to m/s
+    # and the rollups are recomputed with them weighted by duration_s
+    drop_views(cur)
+    create_schema(cur)
+    fill_legacy_durations(cur)
+    rebuild_rollups(cur)
+
+
+def migrate_v5_to_v6(cur):
+    # the floorplan is resolved again by the next ingest given its files
+    create_schema(cur)
+
+
+def migrate_v6_to_v7(cur):
+    # visits are derived from the zone ids already assigned to the trajectory
+    create_schema(cur)
+    rebuild_zone_visits(cur, load_zones(cur))
+
+
+def migrate_v7_to_v8(cur):
+    # the views are created again on the partitioned trajectory
+    drop_views(cur)
+    partition_trajectory(cur)
+    create_schema(cur)
+
+
+def migrate_v8_to_v9(cur):
+    # the rows ingested before are packed into chunks as well
+    create_schema(cur)
+    fill_trajectory_chunks(cur)
+
+
+def migrate_v9_to_v10(cur):
+    # from the trajectory of all shifts, with the default distance
+    create_schema(cur)
+    rebuild_proximity(cur)
+
+
+# migrations[version] upgrades a database from version to version + 1
+migrations = {
+    0: migrate_v0_to_v1,
+    1: migrate_v1_to_v2,
+    2: migrate_v2_to_v3,
+    3: migrate_v3_to_v4,
+    4: migrate_v4_to_v5,
+    5: migrate_v5_to_v6,
+    6: migrate_v6_to_v7,
+    7: migrate_v7_to_v8,
+    8: migrate_v8_to_v9,
+    9: migrate_v9_to_v10,
+}
+
+
+def migrate(con):
+    # all steps run in one transaction, so a failed migration leaves the
+    # database as it was
+    cur = con.cursor()
+    version = get_schema_version(cur)
+    if is_empty_database(cur):
+        version = SCHEMA_VERSION
+    cur.execute("BEGIN")
+    try:
+        while version < SCHEMA_VERSION:
+            print(f"Migrating schema version {version} to {version + 1}")
+            migrations[version](cur)
+            version += 1
+        create_schema(cur)
+        set_schema_version(cur, version)
+        bump_generation(cur)
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+    return version
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_path", nargs="?", default="aware_data.db")
+    parser.add_argument("--vacuum", action="store_true")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.db_path, isolation_level=None)
+    time_start = time.perf_counter()
+    version = migrate(con)
+    if args.vacuum:
+        con.execute("VACUUM")
+    update_statistics(con)
+    con.close()
+    print(
+        f"{args.db_path} is at schema version {version} "
+        f"({time.perf_counter() - time_start:.1f} s)"
+    )
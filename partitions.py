@@ -0,0 +1,571 @@
+import argparse
+import datetime
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+from db_util import add_missing_columns
+from trajectory_chunks import (
+    delete_trajectory_chunks,
+    insert_trajectory_chunks,
+    read_chunked_trajectory,
+)
+
+# Trajectory rows are stored in one table per week, trajectory_YYYYMMDD named
+# after the Monday (UTC) the week starts on, each with its own indexes, so an
+# ingest only updates the indexes of the weeks it writes to, however many
+# weeks are stored. The trajectory_partitions table lists the weeks.
+#
+# trajectory is a view, the UNION ALL of the partitions, for the agent and ad
+# hoc queries: SQLite pushes the forklift and time conditions of a query into
+# every partition and searches their indexes, one index probe per partition
+# outside the time range. The ingest, the rollups and the heatmap are routed
+# to the partitions overlapping their time range only, see
+# get_trajectory_source.
+#
+# Every row is also stored in the compressed chunks of trajectory_chunks.py.
+# The partitions are the hot tier: only the last HOT_WEEKS weeks up to the
+# newest one ingested keep their rows, the ingest compacts the older ones,
+# dropping their rows and keeping only the chunks, and writes the rows of
+# older weeks to the chunks only. Old weeks can also be compacted by hand, or
+# archived into a database file of their own. Either way they leave the view,
+# and the ingest, the rollups and the heatmap read them by expanding the
+# chunks of their time range. Their rollups and zone visits stay in the
+# database:
+#
+#     python partitions.py aware_data.db --compact_before 20250101
+#     python partitions.py aware_data.db --archive_before 20250101 --archive_dir archive
+#     python partitions.py aware_data.db --restore trajectory_20241125
+
+PARTITION_NS = 7 * 24 * 3600 * 1000000000
+# 1970-01-01 was a Thursday, the weeks start on the Monday after
+PARTITION_OFFSET_NS = 4 * 24 * 3600 * 1000000000
+PARTITION_NAME_PATTERN = re.compile(r"trajectory_\d{8}")
+# weeks whose rows the ingest keeps, see get_hot_start_ns
+HOT_WEEKS = 2
+# partitions whose rows are in this database
+HOT_PARTITION_SQL = "archive_path IS NULL AND compacted = 0"
+TRAJECTORY_COLUMNS = [
+    "forklift_id",
+    "time_ns",
+    "x",
+    "y",
+    "heading_x",
+    "heading_y",
+    "velocity_meters_per_second",
+    "zone_id",
+    "duration_s",
+]
+
+
+def create_trajectory_table(cur, table, schema="main"):
+    cur.execute(
+        f"CREATE TABLE IF NOT EXISTS {schema}.{table}(forklift_id int not null, time_ns int not null, x float, y float, heading_x float, heading_y float, velocity_meters_per_second float, zone_id int, duration_s float)"
+    )
+    cur.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema}.{table}_forklift_time_index ON {table}(forklift_id, time_ns)"
+    )
+    cur.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema}.{table}_zone_index ON {table}(zone_id, forklift_id, time_ns)"
+    )
+
+
+def create_partitions_table(cur):
+    # archive_path is the database file of an archived partition, NULL while
+    # the partition is in this database, compacted is 1 for partitions whose
+    # rows are only in the chunks
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS trajectory_partitions(name text primary key, start_ns int not null, end_ns int not null, archive_path text, compacted int not null default 0)"
+    )
+    add_missing_columns(
+        cur, "trajectory_partitions", {"compacted": "int not null default 0"}
+    )
+
+
+def is_partitioned(cur):
+    # databases before schema version 8 have a single trajectory table
+    row = cur.execute(
+        "SELECT type FROM sqlite_master WHERE name = 'trajectory'"
+    ).fetchone()
+    return row is None or row[0] != "table"
+
+
+def is_partition_table(name):
+    return PARTITION_NAME_PATTERN.fullmatch(name) is not None
+
+
+def get_partition_start_ns(time_ns):
+    # also for arrays of times
+    return (time_ns - PARTITION_OFFSET_NS) // PARTITION_NS * PARTITION_NS + (
+        PARTITION_OFFSET_NS
+    )
+
+
+def get_partition_name(start_ns):
+    start = datetime.datetime.fromtimestamp(
+        int(start_ns) // 1000000000, datetime.timezone.utc
+    )
+    return f"trajectory_{start:%Y%m%d}"
+
+
+def get_union_sql(tables):
+    columns = ", ".join(TRAJECTORY_COLUMNS)
+    if len(tables) == 0:
+        # no rows, with the columns of the partitions
+        return (
+            "SELECT "
+            + ", ".join(f"NULL AS {column}" for column in TRAJECTORY_COLUMNS)
+            + " WHERE 0"
+        )
+    return " UNION ALL ".join(f"SELECT {columns} FROM {table}" for table in tables)
+
+
+def create_trajectory_view(cur):
+    tables = [
+        row[0]
+        for row in cur.execute(
+            f"SELECT name FROM trajectory_partitions WHERE {HOT_PARTITION_SQL} "
+            "ORDER BY start_ns"
+        )
+    ]
+    cur.execute("DROP VIEW IF EXISTS trajectory")
+    cur.execute(f"CREATE VIEW trajectory AS {get_union_sql(tables)}")
+
+
+def create_partitioned_trajectory(cur):
+    create_partitions_table(cur)
+    row = cur.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'view' AND name = 'trajectory'"
+    ).fetchone()
+    if row[0] == 0:
+        create_trajectory_view(cur)
+
+
+def get_partition(cur, start_ns, is_hot=True):
+    # the partition of the week starting at start_ns, created if missing,
+    # None if the week is compacted and its rows only go into the chunks;
+    # a missing week that is not is_hot is created compacted
+    name = get_partition_name(start_ns)
+    row = cur.execute(
+        "SELECT archive_path, compacted FROM trajectory_partitions WHERE name = ?",
+        (name,),
+    ).fetchone()
+    if row is not None and row[1]:
+        return None
+    if row is not None and row[0] is not None:
+        raise RuntimeError(
+            f"{name} is archived in {row[0]}, restore it with "
+            f"python partitions.py DB_PATH --restore {name}"
+        )
+    if row is None and not is_hot:
+        cur.execute(
+            "INSERT INTO trajectory_partitions(name, start_ns, end_ns, compacted) "
+            "VALUES (?, ?, ?, 1)",
+            (name, int(start_ns), int(start_ns) + PARTITION_NS),
+        )
+        return None
+    if row is None:
+        create_trajectory_table(cur, name)
+        cur.execute(
+            "INSERT INTO trajectory_partitions(name, start_ns, end_ns) "
+            "VALUES (?, ?, ?)",
+            (name, int(start_ns), int(start_ns) + PARTITION_NS),
+        )
+        create_trajectory_view(cur)
+    return name
+
+
+def get_partitions(cur, start_ns, end_ns):
+    # the partitions in this database with rows in [start_ns, end_ns)
+    return [
+        row[0]
+        for row in cur.execute(
+            f"SELECT name FROM trajectory_partitions WHERE {HOT_PARTITION_SQL} "
+            "AND start_ns < ? AND end_ns > ? ORDER BY start_ns",
+            (int(end_ns), int(start_ns)),
+        )
+    ]
+
+
+def insert_chunk_rows(cur, table, forklift_id, chunk):
+    # chunk are the columns of trajectory_chunks.decode_chunk
+    columns = TRAJECTORY_COLUMNS[1:]
+    cur.executemany(
+        f"INSERT INTO {table}(forklift_id, {', '.join(columns)}) "
+        f"VALUES (?, {', '.join('?' * len(columns))})",
+        zip(
+            [forklift_id] * len(chunk["time_ns"]),
+            *[
+                (
+                    np.where(chunk[column] >= 0, chunk[column], None)
+                    if column == "zone_id"
+                    else chunk[column]
+                ).tolist()
+                for column in columns
+            ],
+        ),
+    )
+
+
+def expand_trajectory_chunks(cur, start_ns, end_ns):
+    # Decodes the chunks of the compacted and archived partitions overlapping
+    # [start_ns, end_ns) into the temporary table trajectory_expanded, which
+    # is replaced on every call. Returns whether there are such partitions.
+    ranges = cur.execute(
+        "SELECT max(start_ns, ?), min(end_ns, ?) FROM trajectory_partitions "
+        f"WHERE NOT ({HOT_PARTITION_SQL}) AND start_ns < ? AND end_ns > ?",
+        (int(start_ns), int(end_ns), int(end_ns), int(start_ns)),
+    ).fetchall()
+    if len(ranges) == 0:
+        return False
+    create_trajectory_table(cur, "trajectory_expanded", "temp")
+    cur.execute("DELETE FROM temp.trajectory_expanded")
+    for range_start_ns, range_end_ns in ranges:
+        for forklift_id, chunk in read_chunked_trajectory(
+            cur, range_start_ns, range_end_ns
+        ):
+            insert_chunk_rows(cur, "temp.trajectory_expanded", forklift_id, chunk)
+    return True
+
+
+def get_trajectory_source(cur, start_ns, end_ns):
+    # what to select the trajectory rows in [start_ns, end_ns) from in place of
+    # the trajectory view, without the partitions outside the time range
+    if not is_partitioned(cur):
+        return "trajectory"
+    tables = get_partitions(cur, start_ns, end_ns)
+    if expand_trajectory_chunks(cur, start_ns, end_ns):
+        tables.append("temp.trajectory_expanded")
+    if len(tables) == 1:
+        return tables[0]
+    return f"({get_union_sql(tables)}) AS trajectory"
+
+
+def get_hot_start_ns(cur, hot_weeks, time_ns):
+    # start of the oldest of the hot_weeks weeks up to the newest one with
+    # rows, in the database or at time_ns (e.g. the rows being ingested)
+    (newest_start_ns,) = cur.execute(
+        "SELECT max(start_ns) FROM trajectory_partitions"
+    ).fetchone()
+    newest_start_ns = max(
+        int(get_partition_start_ns(int(time_ns))),
+        newest_start_ns if newest_start_ns is not None else 0,
+    )
+    return newest_start_ns - (hot_weeks - 1) * PARTITION_NS
+
+
+def insert_trajectory_rows(writer, columns, values, hot_start_ns=None):
+    # rows are routed to the partitions of their time_ns; the rows of weeks
+    # starting before hot_start_ns are not stored as rows
+    cur = writer.con.cursor()
+    if not is_partitioned(cur):
+        return writer.insert("trajectory", columns, values)
+    timestamps = np.asarray(values[columns.index("time_ns")], dtype=np.int64)
+    partition_starts = get_partition_start_ns(timestamps)
+    rows_count = 0
+    for start_ns in np.unique(partition_starts):
+        partition = get_partition(
+            cur, start_ns, hot_start_ns is None or start_ns >= hot_start_ns
+        )
+        if partition is None:
+            continue
+        mask = partition_starts == start_ns
+        rows_count += writer.insert(
+            partition,
+            columns,
+            [
+                value if np.ndim(value) == 0 else np.asarray(value)[mask]
+                for value in values
+            ],
+        )
+    return rows_count
+
+
+def delete_trajectory_rows(cur, forklift_id, start_ns, end_ns):
+    # rows of the forklift with start_ns <= time_ns <= end_ns
+    tables = (
+        get_partitions(cur, start_ns, end_ns + 1)
+        if is_partitioned(cur)
+        else ["trajectory"]
+    )
+    for table in tables:
+        cur.execute(
+            f"DELETE FROM {table} WHERE forklift_id = ? "
+            "AND time_ns >= ? AND time_ns <= ?",
+            (forklift_id, start_ns, end_ns),
+        )
+    delete_trajectory_chunks(cur, forklift_id, start_ns, end_ns)
+
+
+def partition_trajectory(cur):
+    # moves the rows of a single trajectory table into weekly partitions, the
+    # views on trajectory must be dropped before
+    cur.execute("ALTER TABLE trajectory RENAME TO trajectory_unpartitioned")
+    create_partitions_table(cur)
+    create_trajectory_view(cur)
+    time_min, time_max = cur.execute(
+        "SELECT min(time_ns), max(time_ns) FROM trajectory_unpartitioned"
+    ).fetchone()
+    if time_min is not None:
+        columns = ", ".join(TRAJECTORY_COLUMNS)
+        for start_ns in range(
+            get_partition_start_ns(time_min), time_max + 1, PARTITION_NS
+        ):
+            (rows_count,) = cur.execute(
+                "SELECT count(*) FROM trajectory_unpartitioned "
+                "WHERE time_ns >= ? AND time_ns < ?",
+                (start_ns, start_ns + PARTITION_NS),
+            ).fetchone()
+            if rows_count == 0:
+                continue
+            cur.execute(
+                f"INSERT INTO {get_partition(cur, start_ns)}({columns}) "
+                f"SELECT {columns} FROM trajectory_unpartitioned "
+                "WHERE time_ns >= ? AND time_ns < ? ORDER BY forklift_id, time_ns",
+                (start_ns, start_ns + PARTITION_NS),
+            )
+    cur.execute("DROP TABLE trajectory_unpartitioned")
+
+
+def fill_trajectory_chunks(cur):
+    # the chunks of the rows of all partitions in this database
+    cur.execute("DELETE FROM trajectory_chunks_rtree")
+    cur.execute("DELETE FROM trajectory_chunks")
+    for table in get_partitions(cur, 0, 2**63 - 1):
+        forklift_ids = cur.execute(
+            f"SELECT DISTINCT forklift_id FROM {table}"
+        ).fetchall()
+        for (forklift_id,) in forklift_ids:
+            rows = cur.execute(
+                "SELECT time_ns, x, y, heading_x, heading_y, "
+                "velocity_meters_per_second, coalesce(duration_s, 1.0), "
+                f"coalesce(zone_id, -1) FROM {table} WHERE forklift_id = ? "
+                "ORDER BY time_ns",
+                (forklift_id,),
+            ).fetchall()
+            timestamps, *values, zone_ids = zip(*rows)
+            values = np.array(values, dtype=np.float64)
+            insert_trajectory_chunks(
+                cur,
+                forklift_id,
+                np.array(timestamps, dtype=np.int64),
+                values[0:2].T,
+                values[2:4].T,
+                values[4],
+                values[5],
+                np.array(zone_ids, dtype=np.int64),
+            )
+
+
+def drop_partition_rows(cur, name):
+    # compacts the partition in the transaction of cur: drops its rows once
+    # its chunks hold all of them
+    start_ns, end_ns = cur.execute(
+        "SELECT start_ns, end_ns FROM trajectory_partitions WHERE name = ? "
+        f"AND {HOT_PARTITION_SQL}",
+        (name,),
+    ).fetchone() or (None, None)
+    if start_ns is None:
+        raise RuntimeError(f"{name} is not a partition in this database")
+    (rows_count,) = cur.execute(f"SELECT count(*) FROM {name}").fetchone()
+    (chunked_count,) = cur.execute(
+        "SELECT coalesce(sum(rows_count), 0) FROM trajectory_chunks "
+        "WHERE start_ns >= ? AND start_ns < ?",
+        (start_ns, end_ns),
+    ).fetchone()
+    if chunked_count != rows_count:
+        raise RuntimeError(
+            f"The chunks of {name} hold {chunked_count} of its {rows_count} rows"
+        )
+    cur.execute(f"DROP TABLE {name}")
+    cur.execute(
+        "UPDATE trajectory_partitions SET compacted = 1 WHERE name = ?", (name,)
+    )
+    create_trajectory_view(cur)
+    return rows_count
+
+
+def compact_partition(con, name):
+    cur = con.cursor()
+    cur.execute("BEGIN")
+    try:
+        rows_count = drop_partition_rows(cur, name)
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+    return rows_count
+
+
+def compact_partitions_before(cur, start_ns):
+    # compacts the hot partitions of the weeks ending by start_ns in the
+    # transaction of cur, returns their names
+    names = [
+        row[0]
+        for row in cur.execute(
+            f"SELECT name FROM trajectory_partitions WHERE {HOT_PARTITION_SQL} "
+            "AND end_ns <= ? ORDER BY start_ns",
+            (int(start_ns),),
+        ).fetchall()
+    ]
+    for name in names:
+        drop_partition_rows(cur, name)
+    return names
+
+
+def archive_partition(con, name, archive_dir):
+    # con is in autocommit mode (isolation_level=None), ATTACH cannot run in
+    # a transaction
+    archive_path = os.path.abspath(os.path.join(archive_dir, f"{name}.db"))
+    if os.path.exists(archive_path):
+        raise RuntimeError(f"{archive_path} exists already")
+    os.makedirs(archive_dir, exist_ok=True)
+    cur = con.cursor()
+    cur.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    try:
+        cur.execute("BEGIN")
+        try:
+            create_trajectory_table(cur, name, "archive")
+            cur.execute(f"INSERT INTO archive.{name} SELECT * FROM main.{name}")
+            cur.execute(f"DROP TABLE main.{name}")
+            cur.execute(
+                "UPDATE trajectory_partitions SET archive_path = ? WHERE name = ?",
+                (archive_path, name),
+            )
+            create_trajectory_view(cur)
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+    finally:
+        cur.execute("DETACH DATABASE archive")
+    return archive_path
+
+
+def restore_compacted_partition(con, name, start_ns, end_ns):
+    # the rows are expanded from the chunks, with their quantized values
+    cur = con.cursor()
+    cur.execute("BEGIN")
+    try:
+        create_trajectory_table(cur, name)
+        for forklift_id, chunk in read_chunked_trajectory(cur, start_ns, end_ns):
+            insert_chunk_rows(cur, name, forklift_id, chunk)
+        cur.execute(
+            "UPDATE trajectory_partitions SET compacted = 0 WHERE name = ?", (name,)
+        )
+        create_trajectory_view(cur)
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+
+
+def restore_partition(con, name):
+    # the archive file is kept
+    cur = con.cursor()
+    row = cur.execute(
+        "SELECT archive_path, compacted, start_ns, end_ns FROM trajectory_partitions "
+        "WHERE name = ?",
+        (name,),
+    ).fetchone()
+    if row is not None and row[1]:
+        restore_compacted_partition(con, name, row[2], row[3])
+        return
+    if row is None or row[0] is None:
+        raise RuntimeError(f"{name} is not an archived or compacted partition")
+    cur.execute("ATTACH DATABASE ? AS archive", (row[0],))
+    try:
+        cur.execute("BEGIN")
+        try:
+            create_trajectory_table(cur, name)
+            cur.execute(f"INSERT INTO main.{name} SELECT * FROM archive.{name}")
+            cur.execute(
+                "UPDATE trajectory_partitions SET archive_path = NULL WHERE name = ?",
+                (name,),
+            )
+            create_trajectory_view(cur)
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+    finally:
+        cur.execute("DETACH DATABASE archive")
+
+
+def get_partitions_before(cur, date):
+    # the hot partitions of the weeks ending before the YYYYMMDD date (UTC)
+    before = datetime.datetime.strptime(date, "%Y%m%d").replace(
+        tzinfo=datetime.timezone.utc
+    )
+    return [
+        row[0]
+        for row in cur.execute(
+            f"SELECT name FROM trajectory_partitions WHERE {HOT_PARTITION_SQL} "
+            "AND end_ns <= ? ORDER BY start_ns",
+            (int(before.timestamp()) * 1000000000,),
+        ).fetchall()
+    ]
+
+
+if __name__ == "__main__":
+    from schema import bump_generation
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_path", nargs="?", default="aware_data.db")
+    parser.add_argument(
+        "--compact_before",
+        help="YYYYMMDD, keeps only the chunks of the weeks ending before",
+    )
+    parser.add_argument(
+        "--archive_before",
+        help="YYYYMMDD, archives the partitions of the weeks ending before",
+    )
+    parser.add_argument("--archive_dir", default="archive")
+    parser.add_argument("--restore", nargs="+", default=[], help="partition names")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.db_path, isolation_level=None)
+    cur = con.cursor()
+    if not is_partitioned(cur):
+        parser.error(
+            f"{args.db_path} is not partitioned, upgrade it with "
+            f"python migrate_db.py {args.db_path}"
+        )
+    if args.compact_before is not None:
+        for name in get_partitions_before(cur, args.compact_before):
+            print(f"Compacted {name}, dropped {compact_partition(con, name)} rows")
+    if args.archive_before is not None:
+        for name in get_partitions_before(cur, args.archive_before):
+            print(
+                f"Archived {name} to {archive_partition(con, name, args.archive_dir)}"
+            )
+    for name in args.restore:
+        restore_partition(con, name)
+        print(f"Restored {name}")
+    if (
+        args.compact_before is not None
+        or args.archive_before is not None
+        or len(args.restore) > 0
+    ):
+        bump_generation(cur)
+    partitions = cur.execute(
+        "SELECT name, start_ns, end_ns, archive_path, compacted "
+        "FROM trajectory_partitions ORDER BY start_ns"
+    ).fetchall()
+    for name, start_ns, end_ns, archive_path, compacted in partitions:
+        chunks_count, chunks_bytes = cur.execute(
+            "SELECT count(*), coalesce(sum(length(data)), 0) FROM trajectory_chunks "
+            "WHERE start_ns >= ? AND start_ns < ?",
+            (start_ns, end_ns),
+        ).fetchone()
+        chunks = f"{chunks_count} chunks of {chunks_bytes / 1e6:.2f} MB"
+        if archive_path is not None:
+            print(f"{name}: archived in {archive_path}, {chunks}")
+        elif compacted:
+            print(f"{name}: compacted, {chunks}")
+        else:
+            (rows_count,) = cur.execute(f"SELECT count(*) FROM {name}").fetchone()
+            print(f"{name}: {rows_count} rows, {chunks}")
+    con.close()
@@ -0,0 +1,391 @@
+import argparse
+import sqlite3
+
+import numpy as np
+
+from partitions import get_trajectory_source
+from rollups import HOUR_NS
+from zones import get_zone_ids, load_zones
+
+# Forklifts close to each other and crowded zones. The positions of all
+# forklifts are sampled on a common clock, one slice per SLICE_NS, between
+# the trajectory rows of every forklift, and bucketed per slice into a
+# uniform grid of cells as wide as the proximity distance. Pairs closer than
+# the distance are then only searched among the forklifts in the same and the
+# neighbouring cells, so the work grows with the number of positions rather
+# than with the square of the forklifts.
+# - proximity_events has one row per pair of forklifts staying within the
+#   distance of each other, forklift_id < other_forklift_id, with the closest
+#   distance and where it happened. Gaps up to MAX_PROXIMITY_GAP_S are
+#   bridged.
+# - zone_congestion has per zone and hour the most forklifts in the zone at
+#   the same time, the seconds with two or more of them in it and the sum of
+#   the seconds of every forklift in it.
+# Both are recomputed for the hours an ingest wrote to, see
+# update_proximity. The distance is kept in db_meta, to change it:
+#
+#     python proximity.py aware_data.db --distance_m 5
+
+SLICE_NS = 1000000000
+PROXIMITY_M = 3.0
+MAX_PROXIMITY_GAP_S = 2.0
+# hours read into memory at once
+WINDOW_NS = 6 * HOUR_NS
+# the durations of the rows are rounded from float seconds
+CONTINUOUS_TOLERANCE_NS = 1000000
+# rows are averaged over a few seconds at most, see downsampling.py
+ROW_LOOKBACK_NS = 60 * 1000000000
+# the cells next to a cell with larger keys, so every pair of cells is
+# visited once
+NEIGHBOUR_CELLS = [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+def create_proximity_tables(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS proximity_events(forklift_id int not null, other_forklift_id int not null, start_ns int not null, end_ns int not null, duration_s float, min_distance_m float, x float, y float, zone_id int)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS proximity_events_time_index ON proximity_events(start_ns)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS proximity_events_forklift_time_index ON proximity_events(forklift_id, start_ns)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS proximity_events_other_forklift_time_index ON proximity_events(other_forklift_id, start_ns)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS proximity_events_zone_time_index ON proximity_events(zone_id, start_ns)"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS zone_congestion(zone_id int not null, hour_start_ns int not null, max_forklifts int, congested_seconds float, forklift_seconds float, PRIMARY KEY (zone_id, hour_start_ns))"
+    )
+
+
+def get_proximity_m(cur):
+    row = cur.execute("SELECT value FROM db_meta WHERE key = 'proximity_m'").fetchone()
+    return PROXIMITY_M if row is None else float(row[0])
+
+
+def set_proximity_m(cur, distance_m):
+    cur.execute(
+        "INSERT OR REPLACE INTO db_meta(key, value) VALUES ('proximity_m', ?)",
+        (float(distance_m),),
+    )
+
+
+def sample_positions(timestamps, end_ns, x, y, zone_ids, start_ns, slices_count):
+    # (slices, x, y, zone_ids) of one forklift at the slices of
+    # [start_ns, start_ns + slices_count * SLICE_NS) covered by its rows,
+    # interpolated between rows following each other without a gap
+    slice_times = start_ns + np.arange(slices_count, dtype=np.int64) * SLICE_NS
+    rows = np.searchsorted(timestamps, slice_times, side="right") - 1
+    is_covered = rows >= 0
+    is_covered[is_covered] &= slice_times[is_covered] < end_ns[rows[is_covered]]
+    slices = np.flatnonzero(is_covered)
+    rows = rows[is_covered]
+    next_rows = np.minimum(rows + 1, len(timestamps) - 1)
+    is_continuous = (next_rows > rows) & (
+        np.abs(timestamps[next_rows] - end_ns[rows]) <= CONTINUOUS_TOLERANCE_NS
+    )
+    fractions = np.where(
+        is_continuous,
+        (slice_times[slices] - timestamps[rows])
+        / np.maximum(end_ns[rows] - timestamps[rows], 1),
+        0.0,
+    )
+    return (
+        slices,
+        x[rows] + fractions * (x[next_rows] - x[rows]),
+        y[rows] + fractions * (y[next_rows] - y[rows]),
+        zone_ids[rows],
+    )
+
+
+def get_close_pairs(slices, x, y, distance_m):
+    # (first, second, distances) of the positions closer than distance_m in
+    # the same slice, first < second indexing the positions
+    cell_x = np.floor(x / distance_m).astype(np.int64)
+    cell_y = np.floor(y / distance_m).astype(np.int64)
+    # a border of empty cells, so neighbours do not wrap into the next row
+    cell_x -= cell_x.min() - 1
+    cell_y -= cell_y.min() - 1
+    width = int(cell_x.max()) + 2
+    height = int(cell_y.max()) + 2
+    keys = (slices * width + cell_x) * height + cell_y
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    firsts, seconds = [], []
+    for offset_x, offset_y in NEIGHBOUR_CELLS:
+        neighbour_keys = keys + offset_x * height + offset_y
+        lows = np.searchsorted(sorted_keys, neighbour_keys, side="left")
+        counts = np.searchsorted(sorted_keys, neighbour_keys, side="right") - lows
+        # every position paired with every position in the neighbour cell
+        first = np.repeat(np.arange(len(keys)), counts)
+        pair_offsets = np.arange(len(first)) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        second = order[np.repeat(lows, counts) + pair_offsets]
+        if (offset_x, offset_y) == (0, 0):
+            is_pair = first < second
+            first, second = first[is_pair], second[is_pair]
+        firsts.append(first)
+        seconds.append(second)
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    distances = np.hypot(x[first] - x[second], y[first] - y[second])
+    is_close = distances <= distance_m
+    return first[is_close], second[is_close], distances[is_close]
+
+
+def get_proximity_events(forklift_ids, slices, x, y, start_ns, distance_m):
+    # proximity_events rows of the positions of all forklifts in the slices
+    # after start_ns
+    first, second, distances = get_close_pairs(slices, x, y, distance_m)
+    if len(first) == 0:
+        return []
+    swap = forklift_ids[first] > forklift_ids[second]
+    first, second = np.where(swap, second, first), np.where(swap, first, second)
+    order = np.lexsort((slices[first], forklift_ids[second], forklift_ids[first]))
+    first, second, distances = first[order], second[order], distances[order]
+    pair_a = forklift_ids[first]
+    pair_b = forklift_ids[second]
+    pair_slices = slices[first]
+    is_event_start = np.ones(len(first), dtype=bool)
+    is_event_start[1:] = (
+        (pair_a[1:] != pair_a[:-1])
+        | (pair_b[1:] != pair_b[:-1])
+        | (
+            pair_slices[1:] - pair_slices[:-1]
+            > 1 + MAX_PROXIMITY_GAP_S * 1e9 / SLICE_NS
+        )
+    )
+    events = np.cumsum(is_event_start) - 1
+    event_starts = np.flatnonzero(is_event_start)
+    event_ends = np.append(event_starts[1:], len(first)) - 1
+    # the closest position of every event comes first when sorted by distance
+    closest = np.lexsort((distances, events))
+    closest = closest[np.flatnonzero(np.diff(events[closest], prepend=-1))]
+    return [
+        (
+            int(pair_a[event_start]),
+            int(pair_b[event_start]),
+            int(start_ns + pair_slices[event_start] * SLICE_NS),
+            int(start_ns + (pair_slices[event_end] + 1) * SLICE_NS),
+            float(distances[nearest]),
+            float((x[first[nearest]] + x[second[nearest]]) / 2),
+            float((y[first[nearest]] + y[second[nearest]]) / 2),
+        )
+        for event_start, event_end, nearest in zip(event_starts, event_ends, closest)
+    ]
+
+
+def get_zone_congestion(slices, zone_ids, start_ns):
+    # zone_congestion rows of the positions of all forklifts in the slices
+    # after start_ns
+    in_zone = zone_ids >= 0
+    slice_zones, forklift_counts = np.unique(
+        np.stack([zone_ids[in_zone], slices[in_zone]], axis=1),
+        axis=0,
+        return_counts=True,
+    )
+    if len(slice_zones) == 0:
+        return []
+    hours = (start_ns + slice_zones[:, 1] * SLICE_NS) // HOUR_NS
+    zone_hours, zone_hour_rows = np.unique(
+        np.stack([slice_zones[:, 0], hours], axis=1), axis=0, return_inverse=True
+    )
+    zone_hour_rows = zone_hour_rows.reshape(-1)
+    max_forklifts = np.zeros(len(zone_hours), dtype=np.int64)
+    np.maximum.at(max_forklifts, zone_hour_rows, forklift_counts)
+    congested_slices = np.bincount(
+        zone_hour_rows, weights=forklift_counts >= 2, minlength=len(zone_hours)
+    )
+    forklift_slices = np.bincount(
+        zone_hour_rows, weights=forklift_counts, minlength=len(zone_hours)
+    )
+    return [
+        (
+            int(zone_id),
+            int(hour * HOUR_NS),
+            int(max_count),
+            float(congested * SLICE_NS / 1e9),
+            float(forklift_slices_count * SLICE_NS / 1e9),
+        )
+        for (zone_id, hour), max_count, congested, forklift_slices_count in zip(
+            zone_hours, max_forklifts, congested_slices, forklift_slices
+        )
+    ]
+
+
+def read_positions(cur, start_ns, end_ns):
+    # (forklift_ids, slices, x, y, zone_ids) of all forklifts in the slices
+    # of [start_ns, end_ns), start_ns aligned to SLICE_NS
+    # with the rows started before and still covering start_ns
+    rows_start_ns = start_ns - ROW_LOOKBACK_NS
+    rows = cur.execute(
+        "SELECT forklift_id, time_ns, coalesce(duration_s, 1.0), x, y, "
+        "coalesce(zone_id, -1) "
+        f"FROM {get_trajectory_source(cur, rows_start_ns, end_ns)} "
+        "WHERE time_ns >= ? AND time_ns < ? ORDER BY forklift_id, time_ns",
+        (rows_start_ns, end_ns),
+    ).fetchall()
+    if len(rows) == 0:
+        return [np.zeros(0) for _ in range(5)]
+    # the times do not fit into float64
+    forklift_ids, timestamps, durations_s, x, y, zone_ids = zip(*rows)
+    forklift_ids = np.array(forklift_ids, dtype=np.int64)
+    timestamps = np.array(timestamps, dtype=np.int64)
+    end_ns_rows = timestamps + (np.array(durations_s) * 1e9).astype(np.int64)
+    x = np.array(x, dtype=np.float64)
+    y = np.array(y, dtype=np.float64)
+    zone_ids = np.array(zone_ids, dtype=np.int64)
+    slices_count = (end_ns - start_ns) // SLICE_NS
+    forklift_starts = np.flatnonzero(np.diff(forklift_ids, prepend=-1))
+    forklift_ends = np.append(forklift_starts[1:], len(forklift_ids))
+    columns = [[] for _ in range(5)]
+    for first, last in zip(forklift_starts, forklift_ends):
+        sampled = sample_positions(
+            timestamps[first:last],
+            end_ns_rows[first:last],
+            x[first:last],
+            y[first:last],
+            zone_ids[first:last],
+            start_ns,
+            slices_count,
+        )
+        columns[0].append(np.full(len(sampled[0]), forklift_ids[first]))
+        for column, values in zip(columns[1:], sampled):
+            column.append(values)
+    return [np.concatenate(column) for column in columns]
+
+
+def get_update_range(cur, start_ns, end_ns):
+    # whole hours, extended to the events overlapping them, which are
+    # deleted and found again
+    start_ns = start_ns - start_ns % HOUR_NS
+    end_ns = end_ns - end_ns % HOUR_NS + HOUR_NS
+    events_start_ns, events_end_ns = cur.execute(
+        "SELECT min(start_ns), max(end_ns) FROM proximity_events "
+        "WHERE start_ns < ? AND end_ns > ?",
+        (end_ns, start_ns - int(MAX_PROXIMITY_GAP_S * 1e9)),
+    ).fetchone()
+    if events_start_ns is not None:
+        start_ns = min(start_ns, events_start_ns - events_start_ns % HOUR_NS)
+        end_ns = max(end_ns, events_end_ns - events_end_ns % HOUR_NS + HOUR_NS)
+    return start_ns, end_ns
+
+
+def merge_events(events):
+    # events of the same pair split at the window borders joined again
+    merged = []
+    for event in sorted(events):
+        if (
+            len(merged) > 0
+            and merged[-1][:2] == event[:2]
+            and event[2] - merged[-1][3] <= MAX_PROXIMITY_GAP_S * 1e9
+        ):
+            closest = min(merged[-1], event, key=lambda event: event[4])
+            merged[-1] = merged[-1][:3] + (event[3],) + closest[4:]
+        else:
+            merged.append(event)
+    return merged
+
+
+def update_proximity(cur, start_ns, end_ns, zones=None, distance_m=None):
+    # Recomputes proximity_events and zone_congestion for the hours of
+    # [start_ns, end_ns), from the trajectory of all forklifts. Returns the
+    # number of events.
+    if zones is None:
+        zones = load_zones(cur)
+    if distance_m is None:
+        distance_m = get_proximity_m(cur)
+    start_ns, end_ns = get_update_range(cur, int(start_ns), int(end_ns))
+    cur.execute(
+        "DELETE FROM proximity_events WHERE start_ns < ? AND end_ns > ?",
+        (end_ns, start_ns),
+    )
+    cur.execute(
+        "DELETE FROM zone_congestion WHERE hour_start_ns >= ? AND hour_start_ns < ?",
+        (start_ns, end_ns),
+    )
+    events = []
+    for window_start_ns in range(start_ns, end_ns, WINDOW_NS):
+        window_end_ns = min(window_start_ns + WINDOW_NS, end_ns)
+        forklift_ids, slices, x, y, zone_ids = read_positions(
+            cur, window_start_ns, window_end_ns
+        )
+        if len(slices) == 0:
+            continue
+        events += get_proximity_events(
+            forklift_ids, slices, x, y, window_start_ns, distance_m
+        )
+        cur.executemany(
+            "INSERT INTO zone_congestion(zone_id, hour_start_ns, max_forklifts, "
+            "congested_seconds, forklift_seconds) VALUES (?, ?, ?, ?, ?)",
+            get_zone_congestion(slices, zone_ids, window_start_ns),
+        )
+    events = merge_events(events)
+    if len(events) > 0:
+        event_zone_ids = get_zone_ids(
+            np.array([event[5:7] for event in events], dtype=np.float64), zones
+        )
+    cur.executemany(
+        "INSERT INTO proximity_events(forklift_id, other_forklift_id, start_ns, "
+        "end_ns, duration_s, min_distance_m, x, y, zone_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            event[:4] + ((event[3] - event[2]) / 1e9,) + event[4:] + (int(zone_id),)
+            for event, zone_id in zip(events, event_zone_ids if events else [])
+        ],
+    )
+    return len(events)
+
+
+def update_proximity_ranges(cur, time_ranges, zones=None):
+    # update_proximity for the merged (start_ns, end_ns) ranges, e.g. of the
+    # shifts of one ingest
+    merged_ranges = []
+    for start_ns, end_ns in sorted(time_ranges):
+        if len(merged_ranges) > 0 and start_ns <= merged_ranges[-1][1]:
+            merged_ranges[-1][1] = max(merged_ranges[-1][1], end_ns)
+        else:
+            merged_ranges.append([start_ns, end_ns])
+    return sum(
+        update_proximity(cur, start_ns, end_ns, zones)
+        for start_ns, end_ns in merged_ranges
+    )
+
+
+def rebuild_proximity(cur, distance_m=None):
+    # for all shifts in the database, e.g. with a new distance
+    if distance_m is not None:
+        set_proximity_m(cur, distance_m)
+    cur.execute("DELETE FROM proximity_events")
+    cur.execute("DELETE FROM zone_congestion")
+    time_ranges = cur.execute(
+        "SELECT start_ns, end_ns FROM shifts UNION ALL "
+        "SELECT data_start_ns, data_end_ns + 1 FROM ingested_files "
+        "WHERE data_start_ns IS NOT NULL"
+    ).fetchall()
+    return update_proximity_ranges(cur, time_ranges)
+
+
+if __name__ == "__main__":
+    from schema import bump_generation
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_path", nargs="?", default="aware_data.db")
+    parser.add_argument(
+        "--distance_m",
+        type=float,
+        help=f"distance of forklifts counted as close, {PROXIMITY_M} by default",
+    )
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.db_path)
+    cur = con.cursor()
+    with con:
+        events_count = rebuild_proximity(cur, args.distance_m)
+        bump_generation(cur)
+    print(f"Found {events_count} proximity events within {get_proximity_m(cur)} m")
+    con.close()
@@ -0,0 +1,264 @@
+import asyncio
+import collections
+import re
+import time
+
+from langchain_core.prompts import ChatPromptTemplate
+from langgraph.graph import START, StateGraph
+from typing_extensions import Annotated, TypedDict
+
+from instrumentation import span
+from llm_usage import TokenUsageHandler
+from schema_digest import get_schema_digest_text
+from sql_cache import SQLResultCache
+from sql_guard import GuardedQuerySQLDatabaseTool
+
+# The reliable mode answers the question and two equivalent reformulations
+# independently and compares the results. The three branches run
+# concurrently, so the wall-clock time is about that of a single answer, and
+# as soon as a majority of the branches got the same SQL result the remaining
+# ones are cancelled.
+
+REFORMULATIONS_COUNT = 2
+
+query_system_message = """
+Given an input question, create a syntactically correct {dialect} query to
+run to help find the answer. Unless the user specifies in his question a
+specific number of examples they wish to obtain, always limit your query to
+at most {top_k} results.
+
+Never query for all the columns from a specific table, only ask for a the
+few relevant columns given the question. DO NOT make any DML statements
+(INSERT, UPDATE, DELETE, DROP etc.) to the database.
+
+Times are stored as integer nanoseconds since the Unix epoch in the *_ns
+columns. Only use the following tables and views:
+{table_info}
+"""
+
+reformulate_prompt = """
+Rewrite the following question in {count} different ways that have exactly the
+same meaning. Return only the rewritten questions, one per line.
+
+Question: {question}"""
+
+answer_prompt = """
+Given the following user question, corresponding SQL query, and SQL result,
+answer the user question. {consistency}
+
+Question: {question}
+SQL Query: {query}
+SQL Result: {result}"""
+
+
+class QueryOutput(TypedDict):
+    """Generated SQL query."""
+
+    query: Annotated[str, ..., "Syntactically valid SQL query."]
+
+
+class ReliableState(TypedDict):
+    question: str
+    questions: list
+    branches: list
+    consistent: bool
+    answer: str
+
+
+def parse_reformulations(text, question, count=REFORMULATIONS_COUNT):
+    # one question per line, numbering and bullets are removed
+    reformulations = []
+    for line in text.splitlines():
+        line = re.sub(r"^\s*(\d+[.)]|[-*])\s*", "", line).strip()
+        if len(line) > 0 and line != question:
+            reformulations.append(line)
+    reformulations = reformulations[:count]
+    while len(reformulations) < count:
+        reformulations.append(question)
+    return reformulations
+
+
+def normalize_result(result):
+    return re.sub(r"\s+", " ", result).strip()
+
+
+def get_majority(branches, branches_count):
+    # the most common result of the successful branches if more than half of
+    # all branches got it, otherwise None
+    results = collections.Counter(
+        normalize_result(branch["result"])
+        for branch in branches
+        if branch["error"] is None
+    )
+    if len(results) == 0:
+        return None
+    result, count = results.most_common(1)[0]
+    return result if count > branches_count // 2 else None
+
+
+def build_reliable_graph(db, llm, cache=None, branch_timeout_seconds=60.0, top_k=5):
+    table_info = get_schema_digest_text(db)
+    query_prompt_template = ChatPromptTemplate(
+        [("system", query_system_message), ("user", "Question: {input}")]
+    )
+    structured_llm = llm.with_structured_output(QueryOutput)
+    execute_query_tool = GuardedQuerySQLDatabaseTool(
+        db=db, cache=SQLResultCache() if cache is None else cache
+    )
+
+    async def answer_branch(index, question):
+        prompt = await query_prompt_template.ainvoke(
+            {
+                "dialect": db.dialect,
+                "top_k": top_k,
+                "table_info": table_info,
+                "input": question,
+            }
+        )
+        with span("write_query", branch=index):
+            output = await structured_llm.ainvoke(prompt)
+        query = output["query"]
+        # SQLite calls block, they run in a worker thread
+        with span("execute_query", branch=index) as attributes:
+            result = await asyncio.to_thread(execute_query_tool.invoke, query)
+            attributes["result_chars"] = len(result)
+        error = result if result.startswith("Error") else None
+        return {
+            "index": index,
+            "question": question,
+            "query": query,
+            "result": result,
+            "error": error,
+        }
+
+    async def answer_branch_with_timeout(index, question):
+        time_start = time.perf_counter()
+        try:
+            branch = await asyncio.wait_for(
+                answer_branch(index, question), branch_timeout_seconds
+            )
+        except asyncio.TimeoutError:
+            branch = {
+                "index": index,
+                "question": question,
+                "query": None,
+                "result": None,
+                "error": f"timeout after {branch_timeout_seconds} s",
+            }
+        branch["seconds"] = time.perf_counter() - time_start
+        return branch
+
+    async def reformulate_question(state: ReliableState):
+        """Rewrite the question into equivalent questions."""
+        response = await llm.ainvoke(
+            reformulate_prompt.format(
+                count=REFORMULATIONS_COUNT, question=state["question"]
+            )
+        )
+        reformulations = parse_reformulations(response.content, state["question"])
+        return {"questions": [state["question"]] + reformulations}
+
+    async def answer_questions(state: ReliableState):
+        """Answer all questions concurrently, stopping at a majority."""
+        questions = state["questions"]
+        pending = {
+            asyncio.create_task(answer_branch_with_timeout(index, question))
+            for index, question in enumerate(questions)
+        }
+        branches = []
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                branches += [task.result() for task in done]
+                if get_majority(branches, len(questions)) is not None:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        answered = [branch["index"] for branch in branches]
+        for index, question in enumerate(questions):
+            if index not in answered:
+                branches.append(
+                    {
+                        "index": index,
+                        "question": question,
+                        "query": None,
+                        "result": None,
+                        "error": "cancelled after a majority",
+                        "seconds": None,
+                    }
+                )
+        return {"branches": sorted(branches, key=lambda branch: branch["index"])}
+
+    async def compare_answers(state: ReliableState):
+        """Answer the question from the majority result of the branches."""
+        branches = state["branches"]
+        majority = get_majority(branches, len(branches))
+        consistent = majority is not None
+        if consistent:
+            branch = [
+                branch
+                for branch in branches
+                if branch["error"] is None
+                and normalize_result(branch["result"]) == majority
+            ][0]
+            consistency = ""
+        else:
+            successful = [branch for branch in branches if branch["error"] is None]
+            if len(successful) == 0:
+                return {
+                    "consistent": False,
+                    "answer": "The question could not be answered: "
+                    + "; ".join(str(branch["error"]) for branch in branches),
+                }
+            branch = successful[0]
+            consistency = (
+                "Equivalent formulations of the question gave different results, "
+                "let the user know the answer is not reliable."
+            )
+        response = await llm.ainvoke(
+            answer_prompt.format(
+                consistency=consistency,
+                question=state["question"],
+                query=branch["query"],
+                result=branch["result"],
+            )
+        )
+        return {"consistent": consistent, "answer": response.content}
+
+    graph_builder = StateGraph(ReliableState).add_sequence(
+        [reformulate_question, answer_questions, compare_answers]
+    )
+    graph_builder.add_edge(START, "reformulate_question")
+    return graph_builder.compile()
+
+
+async def request_with_a_reliable_graph_async(
+    question, db, llm, cache=None, branch_timeout_seconds=60.0
+):
+    graph = build_reliable_graph(db, llm, cache, branch_timeout_seconds)
+    state = {}
+    # the branches run concurrently, so tokens are counted for the whole graph
+    usage = TokenUsageHandler()
+    with span("reliable_graph") as attributes:
+        async for step in graph.astream(
+            {"question": question}, {"callbacks": [usage]}, stream_mode="updates"
+        ):
+            print(step)
+            for update in step.values():
+                state.update(update)
+        attributes.update(usage.usage)
+        attributes["consistent"] = state.get("consistent")
+    return state
+
+
+def request_with_a_reliable_graph(
+    question, db, llm, cache=None, branch_timeout_seconds=60.0
+):
+    return asyncio.run(
+        request_with_a_reliable_graph_async(
+            question, db, llm, cache, branch_timeout_seconds
+        )
+    )
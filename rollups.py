@@ -0,0 +1,170 @@
+from db_util import add_missing_columns
+from partitions import get_trajectory_source
+
+HOUR_NS = 3600 * 1000000000
+
+# Pre-aggregated utilization per forklift and hour, and per forklift and
+# shift. After a shift is ingested only the hours and shifts overlapping it
+# are recomputed from the indexed base tables.
+#
+# active_seconds: overlap of the hour with activity periods
+# idle_seconds: overlap of the hour with ingested shifts, minus active time
+# distance_m: sum of velocity_meters_per_second times duration_s in trajectory
+# sampled_seconds: sum of duration_s, rows without duration_s (see
+# migrate_db.fill_legacy_durations) count as one second
+# mean_velocity: distance_m / sampled_seconds
+# max_velocity: over velocity_meters_per_second
+# stop_count: stops starting within the hour
+ROLLUP_COLUMNS = [
+    "active_seconds",
+    "idle_seconds",
+    "distance_m",
+    "mean_velocity",
+    "max_velocity",
+    "stop_count",
+    "samples_count",
+    "sampled_seconds",
+]
+
+
+def create_rollup_tables(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS shifts(forklift_id int not null, shift_type text not null, start_ns int not null, end_ns int not null, PRIMARY KEY(forklift_id, start_ns))"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS rollup_forklift_hour(forklift_id int not null, hour_start_ns int not null, active_seconds float, idle_seconds float, distance_m float, mean_velocity float, max_velocity float, stop_count int, samples_count int, sampled_seconds float, PRIMARY KEY(forklift_id, hour_start_ns))"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS rollup_forklift_shift(forklift_id int not null, shift_type text not null, shift_start_ns int not null, shift_end_ns int not null, active_seconds float, idle_seconds float, distance_m float, mean_velocity float, max_velocity float, stop_count int, samples_count int, sampled_seconds float, PRIMARY KEY(forklift_id, shift_start_ns))"
+    )
+    for table in ["rollup_forklift_hour", "rollup_forklift_shift"]:
+        add_missing_columns(cur, table, {"sampled_seconds": "float"})
+
+
+def overlap_seconds_sql(table):
+    # seconds of the rows of table overlapping the hour of the outer query
+    return (
+        f"(SELECT coalesce(sum(min({table}.end_ns, hours.hour_start_ns + {HOUR_NS}) "
+        f"- max({table}.start_ns, hours.hour_start_ns)), 0) / 1e9 FROM {table} "
+        f"WHERE {table}.forklift_id = :forklift_id "
+        f"AND {table}.start_ns < hours.hour_start_ns + {HOUR_NS} "
+        f"AND {table}.end_ns > hours.hour_start_ns)"
+    )
+
+
+def update_hour_rollups(cur, forklift_id, start_ns, end_ns):
+    first_hour_ns = start_ns - start_ns % HOUR_NS
+    parameters = {
+        "forklift_id": forklift_id,
+        "first_hour_ns": first_hour_ns,
+        "end_ns": end_ns,
+    }
+    cur.execute(
+        "DELETE FROM rollup_forklift_hour WHERE forklift_id = :forklift_id "
+        "AND hour_start_ns >= :first_hour_ns AND hour_start_ns < :end_ns",
+        parameters,
+    )
+    cur.execute(
+        "INSERT INTO rollup_forklift_hour(forklift_id, hour_start_ns, "
+        + ", ".join(ROLLUP_COLUMNS)
+        + ") "
+        "WITH RECURSIVE hours(hour_start_ns) AS ("
+        "SELECT :first_hour_ns "
+        f"UNION ALL SELECT hour_start_ns + {HOUR_NS} FROM hours "
+        f"WHERE hour_start_ns + {HOUR_NS} < :end_ns), "
+        "trajectory_hours AS ("
+        f"SELECT time_ns - time_ns % {HOUR_NS} AS hour_start_ns, "
+        "sum(velocity_meters_per_second * coalesce(duration_s, 1.0)) AS distance_m, "
+        "sum(coalesce(duration_s, 1.0)) AS sampled_seconds, "
+        "max(velocity_meters_per_second) AS max_velocity, "
+        "count(*) AS samples_count "
+        f"FROM {get_trajectory_source(cur, first_hour_ns, end_ns + HOUR_NS)} "
+        "WHERE forklift_id = :forklift_id "
+        f"AND time_ns >= :first_hour_ns AND time_ns < :end_ns + {HOUR_NS} "
+        "GROUP BY 1), "
+        "stop_hours AS ("
+        f"SELECT start_ns - start_ns % {HOUR_NS} AS hour_start_ns, "
+        "count(*) AS stop_count FROM stops "
+        "WHERE forklift_id = :forklift_id "
+        f"AND start_ns >= :first_hour_ns AND start_ns < :end_ns + {HOUR_NS} "
+        "GROUP BY 1), "
+        "hour_rollups AS ("
+        "SELECT hours.hour_start_ns, "
+        f"{overlap_seconds_sql('activity')} AS active_seconds, "
+        f"{overlap_seconds_sql('shifts')} AS shift_seconds, "
+        "coalesce(trajectory_hours.distance_m, 0) AS distance_m, "
+        "trajectory_hours.distance_m "
+        "/ nullif(trajectory_hours.sampled_seconds, 0) AS mean_velocity, "
+        "trajectory_hours.max_velocity, "
+        "coalesce(stop_hours.stop_count, 0) AS stop_count, "
+        "coalesce(trajectory_hours.samples_count, 0) AS samples_count, "
+        "coalesce(trajectory_hours.sampled_seconds, 0) AS sampled_seconds "
+        "FROM hours "
+        "LEFT JOIN trajectory_hours USING (hour_start_ns) "
+        "LEFT JOIN stop_hours USING (hour_start_ns)) "
+        "SELECT :forklift_id, hour_start_ns, active_seconds, "
+        "max(shift_seconds - active_seconds, 0), distance_m, mean_velocity, "
+        "max_velocity, stop_count, samples_count, sampled_seconds FROM hour_rollups "
+        "WHERE shift_seconds > 0 OR active_seconds > 0 OR samples_count > 0 "
+        "OR stop_count > 0",
+        parameters,
+    )
+
+
+def update_shift_rollups(cur, forklift_id, start_ns, end_ns):
+    cur.execute(
+        "INSERT OR REPLACE INTO rollup_forklift_shift(forklift_id, shift_type, "
+        "shift_start_ns, shift_end_ns, " + ", ".join(ROLLUP_COLUMNS) + ") "
+        "SELECT shifts.forklift_id, shifts.shift_type, shifts.start_ns, "
+        "shifts.end_ns, coalesce(sum(active_seconds), 0), "
+        "coalesce(sum(idle_seconds), 0), coalesce(sum(distance_m), 0), "
+        "sum(distance_m) / nullif(sum(sampled_seconds), 0), "
+        "max(max_velocity), coalesce(sum(stop_count), 0), "
+        "coalesce(sum(samples_count), 0), coalesce(sum(sampled_seconds), 0) "
+        "FROM shifts LEFT JOIN rollup_forklift_hour "
+        "ON rollup_forklift_hour.forklift_id = shifts.forklift_id "
+        "AND rollup_forklift_hour.hour_start_ns >= shifts.start_ns "
+        "AND rollup_forklift_hour.hour_start_ns < shifts.end_ns "
+        "WHERE shifts.forklift_id = :forklift_id "
+        "AND shifts.start_ns < :end_ns AND shifts.end_ns > :start_ns "
+        "GROUP BY shifts.forklift_id, shifts.start_ns",
+        {"forklift_id": forklift_id, "start_ns": start_ns, "end_ns": end_ns},
+    )
+
+
+def update_rollups(cur, forklift_id, start_ns, end_ns):
+    update_hour_rollups(cur, forklift_id, start_ns, end_ns)
+    update_shift_rollups(cur, forklift_id, start_ns, end_ns)
+
+
+def insert_shift(cur, forklift_id, shift_type, start_ns, end_ns):
+    cur.execute(
+        "INSERT OR REPLACE INTO shifts(forklift_id, shift_type, start_ns, end_ns) "
+        "VALUES (?, ?, ?, ?)",
+        (forklift_id, shift_type, start_ns, end_ns),
+    )
+
+
+def backfill_shifts(cur):
+    # Shifts for data ingested before the shifts table existed: 12 hour
+    # windows starting at 06:00 (day) and 18:00 (night) local time.
+    local_seconds = "CAST(strftime('%s', time_ns / 1000000000, 'unixepoch', 'localtime') AS INTEGER)"
+    cur.execute(
+        "INSERT OR IGNORE INTO shifts(forklift_id, shift_type, start_ns, end_ns) "
+        "SELECT forklift_id, "
+        "CASE WHEN shift_index % 2 = 0 THEN 'day' ELSE 'night' END, "
+        "CAST(strftime('%s', shift_index * 43200 + 21600, 'unixepoch', 'utc') AS INTEGER) * 1000000000, "
+        "CAST(strftime('%s', shift_index * 43200 + 64800, 'unixepoch', 'utc') AS INTEGER) * 1000000000 "
+        f"FROM (SELECT DISTINCT forklift_id, ({local_seconds} - 21600) / 43200 AS shift_index "
+        "FROM trajectory)"
+    )
+
+
+def rebuild_rollups(cur):
+    cur.execute("DELETE FROM rollup_forklift_hour")
+    cur.execute("DELETE FROM rollup_forklift_shift")
+    rows = cur.execute(
+        "SELECT forklift_id, min(start_ns), max(end_ns) FROM shifts GROUP BY forklift_id"
+    ).fetchall()
+    for forklift_id, start_ns, end_ns in rows:
+        update_rollups(cur, forklift_id, start_ns, end_ns)
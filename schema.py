@@ -0,0 +1,165 @@
+from db_util import add_missing_columns
+from floorplan import create_floorplan_table
+from ingested_files import create_ingested_files_table
+from partitions import (
+    create_partitioned_trajectory,
+    create_trajectory_table,
+    is_partitioned,
+)
+from proximity import create_proximity_tables
+from rollups import create_rollup_tables
+from trajectory_chunks import create_trajectory_chunks_table
+from zone_visits import create_zone_visits_table
+from zones import create_zone_tables
+
+# Version 1: times are integer nanoseconds since the Unix epoch (*_ns columns),
+# trajectory, activity and stops are indexed by (forklift_id, time), and the
+# *_readable views show the times as local datetimes.
+# Version 2: ingested shifts and utilization rollups per forklift and hour and
+# per forklift and shift.
+# Version 3: db_meta with the generation counter bumped by every ingest.
+# Version 4: ingested_files with the content hash of every ingested shift CSV.
+# Version 5: trajectory.duration_s, the seconds every velocity is averaged
+# over, and the sampled_seconds of the rollups, as the downsampled poses are
+# no longer evenly spaced.
+# Version 6: floorplan with the scale and pixel size of the floorplan.
+# Version 7: zone_visits with the stays of the forklifts in the zones.
+# Version 8: trajectory is a view over weekly partitions, see partitions.py.
+# Version 9: trajectory_chunks with the trajectory in compressed chunks, and
+# partitions compacted to their chunks.
+# Version 10: proximity_events of forklifts close to each other and
+# zone_congestion per zone and hour, see proximity.py.
+SCHEMA_VERSION = 10
+
+
+def local_datetime_sql(column):
+    return f"datetime({column} / 1000000000, 'unixepoch', 'localtime')"
+
+
+def create_views(cur):
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS trajectory_readable AS "
+        f"SELECT forklift_id, {local_datetime_sql('time_ns')} AS time, time_ns, "
+        "x, y, heading_x, heading_y, velocity_meters_per_second, duration_s, "
+        "zone_id FROM trajectory"
+    )
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS activity_readable AS "
+        f"SELECT forklift_id, {local_datetime_sql('start_ns')} AS start, "
+        f"{local_datetime_sql('end_ns')} AS end, start_ns, end_ns "
+        "FROM activity"
+    )
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS stops_readable AS "
+        f"SELECT forklift_id, {local_datetime_sql('start_ns')} AS start, "
+        f"{local_datetime_sql('end_ns')} AS end, start_ns, end_ns, x, y "
+        "FROM stops"
+    )
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS trajectory_zones AS "
+        "SELECT trajectory.forklift_id, "
+        f"{local_datetime_sql('trajectory.time_ns')} AS time, trajectory.time_ns, "
+        "trajectory.x, trajectory.y, trajectory.velocity_meters_per_second, "
+        "trajectory.zone_id, zones.name AS zone "
+        "FROM trajectory JOIN zones ON zones.id = trajectory.zone_id"
+    )
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS zone_visits_readable AS "
+        "SELECT zone_visits.forklift_id, zones.name AS zone, "
+        f"{local_datetime_sql('zone_visits.enter_ns')} AS enter, "
+        f"{local_datetime_sql('zone_visits.exit_ns')} AS exit, "
+        "zone_visits.duration_s, zone_visits.zone_id, zone_visits.enter_ns, "
+        "zone_visits.exit_ns "
+        "FROM zone_visits JOIN zones ON zones.id = zone_visits.zone_id"
+    )
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS proximity_events_readable AS "
+        "SELECT proximity_events.forklift_id, proximity_events.other_forklift_id, "
+        f"{local_datetime_sql('proximity_events.start_ns')} AS start, "
+        f"{local_datetime_sql('proximity_events.end_ns')} AS end, "
+        "proximity_events.duration_s, proximity_events.min_distance_m, "
+        "proximity_events.x, proximity_events.y, zones.name AS zone, "
+        "proximity_events.zone_id, proximity_events.start_ns, proximity_events.end_ns "
+        "FROM proximity_events LEFT JOIN zones ON zones.id = proximity_events.zone_id"
+    )
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS zone_congestion_readable AS "
+        "SELECT zones.name AS zone, "
+        f"{local_datetime_sql('zone_congestion.hour_start_ns')} AS hour_start, "
+        "zone_congestion.max_forklifts, zone_congestion.congested_seconds, "
+        "zone_congestion.forklift_seconds, zone_congestion.zone_id, "
+        "zone_congestion.hour_start_ns "
+        "FROM zone_congestion JOIN zones ON zones.id = zone_congestion.zone_id"
+    )
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS rollup_forklift_hour_readable AS "
+        f"SELECT forklift_id, {local_datetime_sql('hour_start_ns')} AS hour_start, "
+        "hour_start_ns, active_seconds, idle_seconds, distance_m, mean_velocity, "
+        "max_velocity, stop_count FROM rollup_forklift_hour"
+    )
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS rollup_forklift_shift_readable AS "
+        "SELECT forklift_id, shift_type, "
+        f"{local_datetime_sql('shift_start_ns')} AS shift_start, "
+        f"{local_datetime_sql('shift_end_ns')} AS shift_end, shift_start_ns, "
+        "active_seconds, idle_seconds, distance_m, mean_velocity, max_velocity, "
+        "stop_count FROM rollup_forklift_shift"
+    )
+
+
+def drop_views(cur):
+    views = cur.execute("SELECT name FROM sqlite_master WHERE type = 'view'")
+    for (view,) in views.fetchall():
+        cur.execute(f"DROP VIEW {view}")
+
+
+def create_schema(cur):
+    if is_partitioned(cur):
+        create_partitioned_trajectory(cur)
+    else:
+        # a single table until migrate_v7_to_v8 partitions it
+        create_trajectory_table(cur, "trajectory")
+        add_missing_columns(cur, "trajectory", {"duration_s": "float"})
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS activity(forklift_id int not null, start_ns int not null, end_ns int not null)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS activity_forklift_time_index ON activity(forklift_id, start_ns)"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS stops(forklift_id int not null, start_ns int not null, end_ns int not null, x float, y float)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS stops_forklift_time_index ON stops(forklift_id, start_ns)"
+    )
+    create_zone_tables(cur)
+    create_zone_visits_table(cur)
+    create_trajectory_chunks_table(cur)
+    create_proximity_tables(cur)
+    create_rollup_tables(cur)
+    create_ingested_files_table(cur)
+    create_floorplan_table(cur)
+    create_views(cur)
+    cur.execute("CREATE TABLE IF NOT EXISTS db_meta(key text primary key, value)")
+    cur.execute("INSERT OR IGNORE INTO db_meta(key, value) VALUES ('generation', 0)")
+
+
+def get_schema_version(cur):
+    (version,) = cur.execute("PRAGMA user_version").fetchone()
+    return version
+
+
+def set_schema_version(cur, version):
+    cur.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def is_empty_database(cur):
+    (tables_count,) = cur.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table'"
+    ).fetchone()
+    return tables_count == 0
+
+
+def bump_generation(cur):
+    # lets caches of query results know the data has changed
+    cur.execute("UPDATE db_meta SET value = value + 1 WHERE key = 'generation'")
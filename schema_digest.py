@@ -0,0 +1,271 @@
+import json
+import os
+import sqlite3
+
+from partitions import HOT_PARTITION_SQL, is_partition_table, is_partitioned
+from schema import local_datetime_sql
+
+# A compact description of the tables and views the LLM can query: column
+# types, value ranges, row counts and zone names. It is built once per
+# database generation and stored next to the database, so prompts do not pay
+# for schema introspection and sample rows on every call. It is rebuilt after
+# every ingest, so it only reads indexes and small tables: the partitioned
+# trajectory is described from the indexes of its partitions and the hour
+# rollups, without ranges for its unindexed columns.
+
+HIDDEN_TABLES = [
+    "db_meta",
+    "floorplan",
+    "ingested_files",
+    "metrics",
+    "trajectory_chunks",
+    "trajectory_chunks_rtree",
+    "trajectory_chunks_rtree_node",
+    "trajectory_chunks_rtree_parent",
+    "trajectory_chunks_rtree_rowid",
+    "trajectory_partitions",
+    "zones_rtree_node",
+    "zones_rtree_rowid",
+    "zones_rtree_parent",
+]
+MAX_LISTED_VALUES = 50
+
+
+def get_digest_path(db_path):
+    return f"{db_path}.digest.json"
+
+
+def get_generation(cur):
+    try:
+        row = cur.execute(
+            "SELECT value FROM db_meta WHERE key = 'generation'"
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return None if row is None else row[0]
+
+
+def get_hidden_tables(cur):
+    # the tables and views of the database the LLM is not shown, the weekly
+    # partitions are queried through the trajectory view
+    return [
+        row[0]
+        for row in cur.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') "
+            "ORDER BY name"
+        )
+        if row[0] in HIDDEN_TABLES or is_partition_table(row[0])
+    ]
+
+
+def get_indexed_columns(cur, table):
+    # the columns leading an index of table, whose minimum and maximum are
+    # found by one index probe each
+    columns = set()
+    for index in cur.execute(f"PRAGMA index_list({table})").fetchall():
+        index_columns = cur.execute(f"PRAGMA index_info({index[1]})").fetchall()
+        if len(index_columns) > 0:
+            columns.add(index_columns[0][2])
+    return columns
+
+
+def get_column_range(cur, table, column, indexed_columns, where="", parameters=()):
+    if column in indexed_columns:
+        # separate queries, a min() and a max() in the same query scan
+        return [
+            cur.execute(
+                f"SELECT {aggregate}({column}) FROM {table} {where}", parameters
+            ).fetchone()[0]
+            for aggregate in ["min", "max"]
+        ]
+    return list(
+        cur.execute(
+            f"SELECT min({column}), max({column}) FROM {table} {where}", parameters
+        ).fetchone()
+    )
+
+
+def get_listed_values(cur, table, column, indexed_columns):
+    if column not in indexed_columns:
+        return [
+            row[0]
+            for row in cur.execute(
+                f"SELECT DISTINCT {column} FROM {table} ORDER BY 1 LIMIT {MAX_LISTED_VALUES}"
+            )
+        ]
+    # skips from value to value through the index instead of reading it all
+    values = []
+    (value,) = cur.execute(f"SELECT min({column}) FROM {table}").fetchone()
+    while value is not None and len(values) < MAX_LISTED_VALUES:
+        values.append(value)
+        (value,) = cur.execute(
+            f"SELECT min({column}) FROM {table} WHERE {column} > ?", (value,)
+        ).fetchone()
+    return values
+
+
+def get_datetime_range(cur, value_range):
+    return list(
+        cur.execute(
+            f"SELECT {local_datetime_sql('?')}, {local_datetime_sql('?')}",
+            value_range,
+        ).fetchone()
+    )
+
+
+def describe_table(cur, name, columns):
+    (rows_count,) = cur.execute(f"SELECT count(*) FROM {name}").fetchone()
+    indexed_columns = get_indexed_columns(cur, name)
+    for column in columns:
+        column_name = column["name"]
+        if column["type"] not in ["int", "integer", "float", "real"]:
+            continue
+        column["range"] = get_column_range(cur, name, column_name, indexed_columns)
+        if column_name.endswith("_ns") and column["range"][0] is not None:
+            column["datetime_range"] = get_datetime_range(cur, column["range"])
+        if column_name == "forklift_id":
+            column["values"] = get_listed_values(
+                cur, name, column_name, indexed_columns
+            )
+    return {"rows": rows_count, "columns": columns}
+
+
+def describe_partitioned_trajectory(cur, columns):
+    # the trajectory view, from the partitions in it: forklifts and zones from
+    # the indexes of every partition, times from the forklifts of the first
+    # and last partition, the rows from the samples of the hour rollups
+    partitions = cur.execute(
+        f"SELECT name, start_ns, end_ns FROM trajectory_partitions "
+        f"WHERE {HOT_PARTITION_SQL} ORDER BY start_ns"
+    ).fetchall()
+    forklift_ids = {}
+    zone_ranges = []
+    for name, _, _ in partitions:
+        indexed_columns = get_indexed_columns(cur, name)
+        forklift_ids[name] = get_listed_values(
+            cur, name, "forklift_id", indexed_columns
+        )
+        zone_ranges.append(get_column_range(cur, name, "zone_id", indexed_columns))
+    time_range = [None, None]
+    for name, _, _ in partitions:
+        for forklift_id in forklift_ids[name]:
+            (time_ns,) = cur.execute(
+                f"SELECT min(time_ns) FROM {name} WHERE forklift_id = ?",
+                (forklift_id,),
+            ).fetchone()
+            time_range[0] = min(time_ns, time_range[0] or time_ns)
+        if time_range[0] is not None:
+            break
+    for name, _, _ in reversed(partitions):
+        for forklift_id in forklift_ids[name]:
+            (time_ns,) = cur.execute(
+                f"SELECT max(time_ns) FROM {name} WHERE forklift_id = ?",
+                (forklift_id,),
+            ).fetchone()
+            time_range[1] = max(time_ns, time_range[1] or time_ns)
+        if time_range[1] is not None:
+            break
+    rows_count = 0
+    for _, start_ns, end_ns in partitions:
+        (samples_count,) = cur.execute(
+            "SELECT coalesce(sum(samples_count), 0) FROM rollup_forklift_hour "
+            "WHERE hour_start_ns >= ? AND hour_start_ns < ?",
+            (start_ns, end_ns),
+        ).fetchone()
+        rows_count += samples_count
+    zone_ids = [value for zone_range in zone_ranges for value in zone_range]
+    zone_ids = [value for value in zone_ids if value is not None]
+    for column in columns:
+        if column["name"] == "forklift_id":
+            column["values"] = sorted(set().union(*forklift_ids.values()))[
+                :MAX_LISTED_VALUES
+            ]
+        elif column["name"] == "time_ns":
+            column["range"] = time_range
+            if time_range[0] is not None:
+                column["datetime_range"] = get_datetime_range(cur, time_range)
+        elif column["name"] == "zone_id" and len(zone_ids) > 0:
+            column["range"] = [min(zone_ids), max(zone_ids)]
+    return {"rows": rows_count, "columns": columns}
+
+
+def build_schema_digest(cur):
+    objects = cur.execute(
+        "SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view') "
+        "AND name NOT LIKE 'sqlite_%' ORDER BY type, name"
+    ).fetchall()
+    digest = {"generation": get_generation(cur), "tables": {}, "views": {}}
+    hidden_tables = get_hidden_tables(cur)
+    for name, object_type in objects:
+        if name in hidden_tables:
+            continue
+        columns = [
+            {"name": row[1], "type": row[2].lower()}
+            for row in cur.execute(f"PRAGMA table_info({name})")
+        ]
+        # the partitioned trajectory is described as the table it replaces
+        if object_type == "view" and name != "trajectory":
+            digest["views"][name] = {"columns": columns}
+        elif name == "trajectory" and is_partitioned(cur):
+            digest["tables"][name] = describe_partitioned_trajectory(cur, columns)
+        else:
+            digest["tables"][name] = describe_table(cur, name, columns)
+    if "zones" in digest["tables"]:
+        digest["zone_names"] = [
+            row[0] for row in cur.execute("SELECT name FROM zones ORDER BY id")
+        ]
+    return digest
+
+
+def load_schema_digest(db_path):
+    # the digest on disk is reused while its generation matches the database
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    cur = con.cursor()
+    generation = get_generation(cur)
+    digest_path = get_digest_path(db_path)
+    if generation is not None and os.path.exists(digest_path):
+        with open(digest_path) as digest_file:
+            digest = json.load(digest_file)
+        if digest.get("generation") == generation:
+            con.close()
+            return digest
+    digest = build_schema_digest(cur)
+    con.close()
+    if generation is not None:
+        with open(digest_path, "w") as digest_file:
+            json.dump(digest, digest_file)
+    return digest
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    return str(value)
+
+
+def format_column(column):
+    text = f"{column['name']} {column['type']}"
+    if "values" in column:
+        text += " in {" + ", ".join(format_value(v) for v in column["values"]) + "}"
+    elif "datetime_range" in column:
+        text += " from {} to {}".format(*column["datetime_range"])
+    elif column.get("range", [None])[0] is not None:
+        text += " from {} to {}".format(*[format_value(v) for v in column["range"]])
+    return text
+
+
+def format_schema_digest(digest):
+    lines = []
+    for name, table in digest["tables"].items():
+        columns = "; ".join(format_column(column) for column in table["columns"])
+        lines.append(f"TABLE {name} ({table['rows']} rows): {columns}")
+    for name, view in digest["views"].items():
+        columns = ", ".join(column["name"] for column in view["columns"])
+        lines.append(f"VIEW {name}: {columns}")
+    if "zone_names" in digest:
+        lines.append("Zone names: " + ", ".join(digest["zone_names"]))
+    return "\n".join(lines)
+
+
+def get_schema_digest_text(db):
+    return format_schema_digest(load_schema_digest(db._engine.url.database))
@@ -0,0 +1,175 @@
+import numpy as np
+
+# Run-length and gap detection on sorted timestamps. Every function takes an
+# optional group_index (e.g. forklift index, non-decreasing) so that several
+# forklifts concatenated into one array are segmented in a single pass;
+# gaps and runs never cross a group boundary.
+
+# A pose is static below this speed. Velocities used to be the displacement
+# between every 15th pose, which the forklifts log every 0.1 s, and a pose was
+# static below 0.05 m of it; this is the same speed in m/s.
+STATIC_VELOCITY_M_S = 0.05 / (15 * 0.1)
+
+
+def get_group_boundaries(values_count, group_index):
+    # True between elements i and i + 1 that belong to different groups
+    if group_index is None:
+        return np.zeros(max(values_count - 1, 0), dtype=bool)
+    group_index = np.asarray(group_index)
+    return group_index[1:] != group_index[:-1]
+
+
+def find_runs(mask, group_index=None):
+    # first and last index of every run of True values in mask
+    mask = np.asarray(mask, dtype=bool)
+    if len(mask) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    group_boundaries = get_group_boundaries(len(mask), group_index)
+    run_starts_mask = np.copy(mask)
+    run_starts_mask[1:] &= np.invert(mask[:-1]) | group_boundaries
+    run_ends_mask = np.copy(mask)
+    run_ends_mask[:-1] &= np.invert(mask[1:]) | group_boundaries
+    return np.flatnonzero(run_starts_mask), np.flatnonzero(run_ends_mask)
+
+
+def get_activity_periods_batch(
+    min_time_interval_ns, shift_starts_ns, shift_ends_ns, timestamps, group_index
+):
+    # Every group's timestamps are preceded by its shift start. A gap longer
+    # than min_time_interval_ns is an inactivity period (status 0); the time
+    # between two gaps is an activity period (status 1). After the last
+    # timestamp the group is inactive until the shift end.
+    shift_starts_ns = np.asarray(shift_starts_ns, dtype=np.int64)
+    shift_ends_ns = np.asarray(shift_ends_ns, dtype=np.int64)
+    groups_count = len(shift_starts_ns)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    group_index = np.asarray(group_index, dtype=np.int64)
+
+    group_offsets = np.searchsorted(group_index, np.arange(groups_count))
+    sequence = np.insert(timestamps, group_offsets, shift_starts_ns)
+    sequence_group_index = np.insert(
+        group_index, group_offsets, np.arange(groups_count)
+    )
+    group_lasts = np.append(
+        group_offsets[1:] + np.arange(groups_count - 1), len(sequence) - 1
+    )
+
+    gaps_mask = (sequence[1:] - sequence[:-1]) > min_time_interval_ns
+    gaps_mask &= np.invert(get_group_boundaries(len(sequence), sequence_group_index))
+    gaps = np.flatnonzero(gaps_mask)
+    gap_groups = sequence_group_index[gaps]
+    is_first_gap_in_group = np.ones(len(gaps), dtype=bool)
+    is_first_gap_in_group[1:] = gap_groups[1:] != gap_groups[:-1]
+
+    # activity between the previous gap of the same group and this one
+    active_gaps = np.flatnonzero(np.invert(is_first_gap_in_group))
+    active_starts = sequence[gaps[active_gaps - 1] + 1]
+    active_ends = sequence[gaps[active_gaps]]
+
+    # activity after the last gap, then inactivity until the shift end
+    tails_mask = sequence[group_lasts] < shift_ends_ns
+    last_gaps = np.full(groups_count, -1)
+    np.maximum.at(last_gaps, gap_groups, gaps)
+    tail_active_mask = tails_mask & (last_gaps >= 0)
+    tail_active_groups = np.flatnonzero(tail_active_mask)
+    tail_groups = np.flatnonzero(tails_mask)
+
+    records = [
+        (
+            gap_groups[active_gaps],
+            gaps[active_gaps],
+            np.zeros(len(active_gaps)),
+            active_starts,
+            active_ends,
+            np.ones(len(active_gaps)),
+        ),
+        (
+            gap_groups,
+            gaps,
+            np.ones(len(gaps)),
+            sequence[gaps],
+            sequence[gaps + 1],
+            np.zeros(len(gaps)),
+        ),
+        (
+            tail_active_groups,
+            group_lasts[tail_active_groups],
+            np.full(len(tail_active_groups), 2),
+            sequence[last_gaps[tail_active_groups] + 1],
+            sequence[group_lasts[tail_active_groups]],
+            np.ones(len(tail_active_groups)),
+        ),
+        (
+            tail_groups,
+            group_lasts[tail_groups],
+            np.full(len(tail_groups), 3),
+            sequence[group_lasts[tail_groups]],
+            shift_ends_ns[tail_groups],
+            np.zeros(len(tail_groups)),
+        ),
+    ]
+    groups, positions, sub_positions, starts, ends, statuses = [
+        np.concatenate(values) for values in zip(*records)
+    ]
+    order = np.lexsort((sub_positions, positions))
+    return (
+        groups[order].astype(np.int64),
+        starts[order].astype(np.int64),
+        ends[order].astype(np.int64),
+        statuses[order].astype(np.int64),
+    )
+
+
+def get_activity_periods(
+    min_time_interval_ns, shift_start_ns, shift_end_ns, timestamps
+):
+    _, starts, ends, statuses = get_activity_periods_batch(
+        min_time_interval_ns,
+        [shift_start_ns],
+        [shift_end_ns],
+        timestamps,
+        np.zeros(len(timestamps), dtype=np.int64),
+    )
+    return starts, ends, statuses
+
+
+def get_stopping_locations_batch(
+    timestamps,
+    t_x,
+    t_y,
+    velocities,
+    static_velocity_m_s,
+    group_index,
+    start_timestamps=None,
+):
+    # a stop is a run of poses slower than static_velocity_m_s, located at the
+    # first pose of the run. With start_timestamps, the times the velocities
+    # are measured from, a stop starts at the start of its first velocity.
+    timestamps = np.asarray(timestamps)
+    start_timestamps = (
+        timestamps if start_timestamps is None else np.asarray(start_timestamps)
+    )
+    run_starts, run_ends = find_runs(
+        np.asarray(velocities) < static_velocity_m_s, group_index
+    )
+    groups = (
+        np.zeros(len(run_starts), dtype=np.int64)
+        if group_index is None
+        else np.asarray(group_index)[run_starts]
+    )
+    return (
+        groups,
+        start_timestamps[run_starts],
+        timestamps[run_ends],
+        np.asarray(t_x)[run_starts],
+        np.asarray(t_y)[run_starts],
+    )
+
+
+def get_stopping_locations(
+    timestamps, t_x, t_y, velocities, static_velocity_m_s, start_timestamps=None
+):
+    _, starts, ends, s_x, s_y = get_stopping_locations_batch(
+        timestamps, t_x, t_y, velocities, static_velocity_m_s, None, start_timestamps
+    )
+    return starts, ends, s_x, s_y
@@ -0,0 +1,160 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+from ingested_files import get_file_hash
+from util import (
+    CATEGORY_COLUMN,
+    SHIFT_CSV_DTYPES,
+    ShiftFrame,
+    encode_categories,
+    read_shift_csv_chunks,
+    read_shift_csv_frames,
+)
+
+# Every shift CSV is parsed once into binary columns of the SHIFT_CSV_DTYPES,
+# in a directory named by the hash of the CSV content. Later runs map the
+# columns into memory instead of parsing the text again. The reference frame
+# category is stored as int16 codes into the categories listed in meta.json.
+
+CACHE_FORMAT_VERSION = 1
+META_FILE_NAME = "meta.json"
+
+
+def get_default_cache_dir():
+    return os.environ.get(
+        "AWARE_SHIFT_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "aware_shift_cache"),
+    )
+
+
+def get_column_file_name(column):
+    # e.g. "acq_timestamp [ns]" -> acq_timestamp_ns.bin
+    return re.sub(r"\W+", "_", column).strip("_") + ".bin"
+
+
+def write_shift_cache(csv_path, cache_path, chunk_size=1000000):
+    # written into a temporary directory renamed at the end, so readers never
+    # see a partial cache
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary_path = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_")
+    try:
+        column_files = {
+            column: open(
+                os.path.join(temporary_path, get_column_file_name(column)), "wb"
+            )
+            for column in SHIFT_CSV_DTYPES.keys()
+        }
+        categories = {}
+        rows_count = 0
+        try:
+            for chunk in read_shift_csv_chunks(csv_path, chunk_size):
+                for column, column_file in column_files.items():
+                    if column == CATEGORY_COLUMN:
+                        values = encode_categories(chunk[column], categories, np.int16)
+                    else:
+                        values = chunk[column].to_numpy(SHIFT_CSV_DTYPES[column])
+                    column_file.write(np.ascontiguousarray(values).tobytes())
+                rows_count += len(chunk)
+        finally:
+            for column_file in column_files.values():
+                column_file.close()
+        meta = {
+            "version": CACHE_FORMAT_VERSION,
+            "csv_path": os.path.abspath(csv_path),
+            "rows": rows_count,
+            "columns": {
+                column: {
+                    "file": get_column_file_name(column),
+                    "dtype": (
+                        "int16" if column == CATEGORY_COLUMN else np.dtype(dtype).name
+                    ),
+                }
+                for column, dtype in SHIFT_CSV_DTYPES.items()
+            },
+            "categories": sorted(categories, key=categories.get),
+        }
+        with open(os.path.join(temporary_path, META_FILE_NAME), "w") as meta_file:
+            json.dump(meta, meta_file)
+        try:
+            os.rename(temporary_path, cache_path)
+        except OSError:
+            # written concurrently by another process
+            if not os.path.exists(os.path.join(cache_path, META_FILE_NAME)):
+                raise
+    finally:
+        if os.path.exists(temporary_path):
+            shutil.rmtree(temporary_path)
+
+
+def load_shift_columns(cache_path):
+    # read-only memory maps of the columns, and the categories
+    with open(os.path.join(cache_path, META_FILE_NAME)) as meta_file:
+        meta = json.load(meta_file)
+    if meta["version"] != CACHE_FORMAT_VERSION:
+        raise ValueError(f"{cache_path} has cache format version {meta['version']}")
+    columns = {}
+    for column, column_meta in meta["columns"].items():
+        dtype = np.dtype(column_meta["dtype"])
+        if meta["rows"] == 0:
+            columns[column] = np.zeros(0, dtype=dtype)
+        else:
+            columns[column] = np.memmap(
+                os.path.join(cache_path, column_meta["file"]),
+                dtype=dtype,
+                mode="r",
+                shape=(meta["rows"],),
+            )
+    return columns, meta["categories"]
+
+
+def read_cached_shift_chunks(
+    cache_path, chunk_size=1000000, positions_dtype=np.float64
+):
+    # util.ShiftFrames like those of util.read_shift_csv_frames, the times,
+    # float64 positions and frame indexes being views of the memory maps
+    columns, categories = load_shift_columns(cache_path)
+    rows_count = len(columns[CATEGORY_COLUMN])
+    for chunk_start in range(0, rows_count, chunk_size):
+        chunk_end = chunk_start + chunk_size
+        # plain ndarray views of the memory maps
+        timestamps, t_x, t_y, category_codes, frame_indexes = [
+            np.asarray(columns[column][chunk_start:chunk_end])
+            for column in SHIFT_CSV_DTYPES.keys()
+        ]
+        yield ShiftFrame(
+            timestamps,
+            t_x.astype(positions_dtype, copy=False),
+            t_y.astype(positions_dtype, copy=False),
+            category_codes.astype(np.int8),
+            frame_indexes,
+            categories,
+        )
+
+
+def read_shift_chunks(
+    csv_path,
+    chunk_size=1000000,
+    cache_dir=None,
+    content_hash=None,
+    positions_dtype=np.float64,
+):
+    # util.read_shift_csv_frames going through the cache in cache_dir, or
+    # parsing the CSV if cache_dir is None or cannot be written
+    if cache_dir is None:
+        return read_shift_csv_frames(csv_path, chunk_size, positions_dtype)
+    if content_hash is None:
+        content_hash = get_file_hash(csv_path)
+    cache_path = os.path.join(cache_dir, content_hash)
+    if not os.path.exists(os.path.join(cache_path, META_FILE_NAME)):
+        try:
+            write_shift_cache(csv_path, cache_path, chunk_size)
+        except OSError as e:
+            print(f"Cannot cache {csv_path} in {cache_dir}: {e}")
+            return read_shift_csv_frames(csv_path, chunk_size, positions_dtype)
+    return read_cached_shift_chunks(cache_path, chunk_size, positions_dtype)
@@ -0,0 +1,132 @@
+import collections
+import re
+import threading
+from typing import Any
+
+from langchain_community.tools.sql_database.tool import QuerySQLDatabaseTool
+from pydantic import Field
+from sqlalchemy.exc import OperationalError
+
+SQL_TOKEN_PATTERN = re.compile(
+    r"(?P<string>'(?:[^']|'')*')"
+    r"|(?P<identifier>\"(?:[^\"]|\"\")*\")"
+    r"|(?P<comment>--[^\n]*|/\*.*?\*/)"
+    r"|(?P<space>\s+)"
+    r"|(?P<other>[^'\"\s]+?(?=--|/\*|['\"\s]|$))",
+    re.DOTALL,
+)
+SPACES_AROUND_OPERATORS_PATTERN = re.compile(r" ?([(),=<>+*/%|-]) ?")
+
+
+def normalize_sql(query):
+    # Lower case outside of string literals, without comments, with single
+    # spaces and without spaces around operators, so that formatting
+    # differences of the same query share a cache entry.
+    segments = []
+    for match in SQL_TOKEN_PATTERN.finditer(query):
+        if match.lastgroup == "string":
+            segments.append(match.group())
+            continue
+        if match.lastgroup in ["comment", "space"]:
+            text = " "
+        else:
+            text = match.group().lower()
+        if len(segments) > 0 and not segments[-1].startswith("'"):
+            segments[-1] += text
+        else:
+            segments.append(text)
+    segments = [
+        (
+            segment
+            if segment.startswith("'")
+            else SPACES_AROUND_OPERATORS_PATTERN.sub(
+                r"\1", re.sub(r"\s+", " ", segment)
+            )
+        )
+        for segment in segments
+    ]
+    return "".join(segments).strip().rstrip(";").strip()
+
+
+class SQLResultCache:
+    # LRU cache of query results, capped by the number of entries and by the
+    # total length of the cached results
+    def __init__(self, max_entries=256, max_result_chars=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_result_chars = max_result_chars
+        self.entries = collections.OrderedDict()
+        self.result_chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        if len(result) > self.max_result_chars:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.result_chars -= len(self.entries.pop(key))
+            self.entries[key] = result
+            self.result_chars += len(result)
+            while (
+                len(self.entries) > self.max_entries
+                or self.result_chars > self.max_result_chars
+            ):
+                _, evicted_result = self.entries.popitem(last=False)
+                self.result_chars -= len(evicted_result)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests > 0 else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "result_chars": self.result_chars,
+            }
+
+
+def get_database_generation(db):
+    # bumped by every ingest, see schema.bump_generation
+    try:
+        with db._engine.connect() as connection:
+            return connection.exec_driver_sql(
+                "SELECT value FROM db_meta WHERE key = 'generation'"
+            ).scalar()
+    except OperationalError:
+        return None
+
+
+class CachedQuerySQLDatabaseTool(QuerySQLDatabaseTool):
+    """Tool for querying a SQL database, reusing results of earlier queries
+    while the database has not been changed by an ingest."""
+
+    cache: Any = Field(default_factory=SQLResultCache, exclude=True)
+
+    def run_query(self, query):
+        return self.db.run_no_throw(query)
+
+    def _run(self, query, run_manager=None):
+        generation = get_database_generation(self.db)
+        if generation is None:
+            return self.run_query(query)
+        key = (normalize_sql(query), generation)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.run_query(query)
+            if not result.startswith("Error"):
+                self.cache.put(key, result)
+        return result
@@ -0,0 +1,279 @@
+import contextlib
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+from typing import Any
+
+from langchain_community.utilities.sql_database import truncate_word
+from pydantic import Field
+
+from instrumentation import span
+from sql_cache import CachedQuerySQLDatabaseTool
+
+# Queries written by the LLM run through SQLGuard: the query plan is checked
+# first and queries estimated to go through too many rows, e.g. a trajectory
+# and zones join missing its join condition, are rejected. Queries passing the
+# check run on a read-only connection with a time and step budget enforced by
+# the SQLite progress handler. Rejected and aborted queries return an error
+# with a JSON description, so the agent can retry with a cheaper query.
+
+PROGRESS_HANDLER_STEPS = 10000
+ALIAS_PATTERN = re.compile(
+    r"(?:\bfrom|\bjoin|,)\s+([a-z_][a-z0-9_]*)\s+(?:as\s+)?([a-z_][a-z0-9_]*)",
+    re.IGNORECASE,
+)
+NOT_ALIASES = [
+    "where",
+    "join",
+    "inner",
+    "left",
+    "right",
+    "full",
+    "cross",
+    "natural",
+    "on",
+    "using",
+    "group",
+    "order",
+    "limit",
+    "union",
+    "having",
+    "window",
+]
+
+
+class QueryRejectedError(Exception):
+    def __init__(self, error, message, **details):
+        super().__init__(message)
+        self.error = error
+        self.details = details
+
+    def to_tool_result(self):
+        return "Error: " + json.dumps(
+            {"error": self.error, "message": str(self), **self.details}
+        )
+
+
+class ReadOnlyConnectionPool:
+    # connections are opened lazily up to size and shared between threads,
+    # each connection being used by a single thread at a time
+    def __init__(self, db_path, size=4):
+        self.db_path = db_path
+        self.size = size
+        self.connections = queue.Queue()
+        self.connections_count = 0
+        self.lock = threading.Lock()
+
+    def open_connection(self):
+        con = sqlite3.connect(
+            f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False
+        )
+        con.set_authorizer(deny_attach)
+        return con
+
+    @contextlib.contextmanager
+    def connection(self):
+        con = None
+        with self.lock:
+            if self.connections.empty() and self.connections_count < self.size:
+                self.connections_count += 1
+                con = self.open_connection()
+        if con is None:
+            con = self.connections.get()
+        try:
+            yield con
+        finally:
+            con.set_progress_handler(None, 0)
+            self.connections.put(con)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+def deny_attach(action, arg1, arg2, db_name, trigger):
+    # attached databases would not be opened read-only
+    if action in [sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH]:
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+
+def get_table_rows(con):
+    # row counts from ANALYZE, see db_util.update_statistics, and the largest
+    # rowid for tables without statistics
+    rows = {}
+    try:
+        for table, stat in con.execute("SELECT tbl, stat FROM sqlite_stat1"):
+            rows[table] = max(rows.get(table, 0), int(stat.split()[0]))
+    except sqlite3.OperationalError:
+        pass
+    tables = con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' "
+        "AND sql NOT LIKE 'CREATE VIRTUAL TABLE%'"
+    ).fetchall()
+    for (table,) in tables:
+        if table not in rows:
+            (max_rowid,) = con.execute(f'SELECT max(rowid) FROM "{table}"').fetchone()
+            rows[table] = max_rowid or 0
+    return rows
+
+
+def get_aliases(query):
+    return {
+        alias.lower(): table.lower()
+        for table, alias in ALIAS_PATTERN.findall(query)
+        if alias.lower() not in NOT_ALIASES
+    }
+
+
+def estimate_plan_rows(plan, table_rows, aliases, parent=0, subquery_rows=None):
+    # Upper bound of the rows visited by the plan below parent: full scans of
+    # one loop nest multiply, index searches are counted as one row, correlated
+    # subqueries run once per row of the loop and other subqueries once.
+    if subquery_rows is None:
+        subquery_rows = {}
+    default_rows = max(table_rows.values(), default=0)
+    loop_rows = 1
+    correlated_rows = 1
+    other_rows = 0
+    scans = []
+    for node_id, node_parent, _, detail in plan:
+        if node_parent != parent:
+            continue
+        words = detail.split()
+        if words[0] == "SCAN" and len(words) > 1:
+            name = words[1].lower()
+            if "VIRTUAL TABLE" in detail or name == "constant":
+                continue
+            name = aliases.get(name, name)
+            if name in subquery_rows:
+                rows = subquery_rows[name]
+            else:
+                rows = table_rows.get(name, default_rows)
+            loop_rows *= max(rows, 1)
+            scans.append(name)
+        elif words[0] in ["MATERIALIZE", "CO-ROUTINE"] and len(words) > 1:
+            rows, _ = estimate_plan_rows(
+                plan, table_rows, aliases, node_id, subquery_rows
+            )
+            subquery_rows[words[1].lower()] = rows
+            other_rows += rows
+        elif words[0] == "CORRELATED":
+            rows, _ = estimate_plan_rows(
+                plan, table_rows, aliases, node_id, subquery_rows
+            )
+            correlated_rows *= max(rows, 1)
+        else:
+            rows, nested_scans = estimate_plan_rows(
+                plan, table_rows, aliases, node_id, subquery_rows
+            )
+            other_rows += rows
+            scans += nested_scans
+    if len(scans) == 0 and correlated_rows == 1:
+        loop_rows = 0
+    return loop_rows * correlated_rows + other_rows, scans
+
+
+class SQLGuard:
+    def __init__(
+        self,
+        db_path,
+        max_estimated_rows=100000000,
+        max_seconds=10.0,
+        max_steps=1000000000,
+        pool_size=4,
+    ):
+        self.pool = ReadOnlyConnectionPool(db_path, pool_size)
+        self.max_estimated_rows = max_estimated_rows
+        self.max_seconds = max_seconds
+        self.max_steps = max_steps
+
+    def check_query_plan(self, con, query):
+        plan = con.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+        estimated_rows, scans = estimate_plan_rows(
+            plan, get_table_rows(con), get_aliases(query)
+        )
+        if estimated_rows > self.max_estimated_rows:
+            raise QueryRejectedError(
+                "query_too_expensive",
+                f"The query would go through about {estimated_rows:.3g} rows, "
+                f"the limit is {self.max_estimated_rows:.3g}. Add join conditions, "
+                "filter on indexed columns (forklift_id and the *_ns times) or use "
+                "the rollup tables and the trajectory_zones view.",
+                estimated_rows=estimated_rows,
+                full_scans=scans,
+            )
+
+    def execute(self, con, query):
+        time_start = time.perf_counter()
+        steps = [0]
+
+        def progress_handler():
+            steps[0] += PROGRESS_HANDLER_STEPS
+            if time.perf_counter() - time_start > self.max_seconds:
+                return 1
+            if self.max_steps is not None and steps[0] > self.max_steps:
+                return 1
+            return 0
+
+        con.set_progress_handler(progress_handler, PROGRESS_HANDLER_STEPS)
+        try:
+            return con.execute(query).fetchall()
+        except sqlite3.OperationalError as e:
+            if str(e) != "interrupted":
+                raise
+            raise QueryRejectedError(
+                "query_interrupted",
+                f"The query was aborted after {time.perf_counter() - time_start:.1f} s "
+                f"and {steps[0]} steps, the limits are {self.max_seconds} s and "
+                f"{self.max_steps} steps. Write a cheaper query.",
+                seconds=time.perf_counter() - time_start,
+                steps=steps[0],
+            )
+
+    def run(self, query, max_string_length=300):
+        # formatted like SQLDatabase.run_no_throw
+        with span("sql_execute") as attributes:
+            try:
+                with self.pool.connection() as con:
+                    self.check_query_plan(con, query)
+                    rows = self.execute(con, query)
+            except QueryRejectedError as e:
+                attributes["rejected"] = e.error
+                return e.to_tool_result()
+            except sqlite3.Error as e:
+                attributes["rejected"] = "sql_error"
+                return "Error: " + json.dumps({"error": "sql_error", "message": str(e)})
+            attributes["rows"] = len(rows)
+        result = [
+            tuple(truncate_word(value, length=max_string_length) for value in row)
+            for row in rows
+        ]
+        return str(result) if len(result) > 0 else ""
+
+
+sql_guards = {}
+sql_guards_lock = threading.Lock()
+
+
+def get_sql_guard(db):
+    # one guard, and so one connection pool, per database file
+    db_path = db._engine.url.database
+    with sql_guards_lock:
+        if db_path not in sql_guards:
+            sql_guards[db_path] = SQLGuard(db_path)
+        return sql_guards[db_path]
+
+
+class GuardedQuerySQLDatabaseTool(CachedQuerySQLDatabaseTool):
+    """Tool for querying a SQL database, rejecting queries with too expensive
+    plans and aborting queries running over the time or step budget."""
+
+    guard: Any = Field(default=None, exclude=True)
+
+    def run_query(self, query):
+        guard = self.guard if self.guard is not None else get_sql_guard(self.db)
+        return guard.run(query, self.db._max_string_length)
@@ -0,0 +1,74 @@
+import asyncio
+import time
+from typing import Any
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+
+def get_prompt_text(messages):
+    return "\n".join(str(message.content) for message in messages)
+
+
+class StubChatModel(BaseChatModel):
+    """Chat model answering locally without network access, to run the graphs
+    without API keys. Plain calls echo the last line of the prompt, structured
+    calls return the given queries in turn. The n-th call is delayed by
+    delays[n % len(delays)] seconds, to try out slow branches."""
+
+    queries: list = ["SELECT count(*) FROM trajectory"]
+    delays: list = [0.0]
+    calls_count: int = 0
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def next_delay(self):
+        delay = self.delays[self.calls_count % len(self.delays)]
+        self.calls_count += 1
+        return delay
+
+    def respond(self, messages):
+        lines = get_prompt_text(messages).strip().splitlines()
+        content = lines[-1] if len(lines) > 0 else ""
+        # words stand in for tokens
+        input_tokens = sum(len(line.split()) for line in lines)
+        output_tokens = len(content.split())
+        message = AIMessage(
+            content,
+            usage_metadata={
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.next_delay())
+        return self.respond(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.next_delay())
+        return self.respond(messages)
+
+    def with_structured_output(self, schema: Any, **kwargs):
+        queries_count = [0]
+
+        def next_query():
+            query = self.queries[queries_count[0] % len(self.queries)]
+            queries_count[0] += 1
+            return {"query": query}
+
+        def invoke(prompt):
+            time.sleep(self.next_delay())
+            return next_query()
+
+        async def ainvoke(prompt):
+            await asyncio.sleep(self.next_delay())
+            return next_query()
+
+        return RunnableLambda(invoke, afunc=ainvoke)
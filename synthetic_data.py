@@ -0,0 +1,258 @@
+import argparse
+import datetime
+import os
+
+import numpy as np
+import pandas
+
+from util import FIDUCIAL_WORLD_CATEGORY
+
+# Shift CSVs with the column layout of the trajectory exports, for benchmarks
+# and for trying the pipeline without the real data. Only the columns in
+# util.SHIFT_CSV_DTYPES are read by the pipeline, the others are written so
+# the parser skips them as it does with real files.
+SHIFT_CSV_COLUMNS = [
+    "acq_timestamp [ns]",
+    "ref_timestamp [ns]",
+    "t_x [m]",
+    "t_y [m]",
+    "t_z [m]",
+    "q_x",
+    "q_y",
+    "q_z",
+    "q_w",
+    "reference_frame_category",
+    "reference_frame_index",
+]
+ODOMETRY_CATEGORY = "ReferenceFrameCategory.Odometry"
+SHIFT_START_HOURS = {"day": 6, "night": 18}
+
+
+def fold(values, minimum, maximum):
+    # maps unbounded coordinates into [minimum, maximum], reflecting at the
+    # walls, so the forklift bounces around the floor without jumps
+    length = maximum - minimum
+    phase = np.mod(values - minimum, 2 * length)
+    return minimum + length - np.abs(phase - length)
+
+
+def get_segments(rng, duration_ns, mean_drive_s, mean_stop_s, speed_mps):
+    # alternating drive and stop segments covering the shift: end times,
+    # speeds and headings
+    segments_count = int(duration_ns / ((mean_drive_s + mean_stop_s) * 1e9)) * 2 + 16
+    while True:
+        is_driving = np.arange(segments_count) % 2 == 0
+        durations = rng.exponential(
+            np.where(is_driving, mean_drive_s, mean_stop_s), segments_count
+        )
+        ends_ns = np.cumsum((durations * 1e9).astype(np.int64))
+        if ends_ns[-1] > duration_ns:
+            break
+        segments_count *= 2
+    speeds = np.where(is_driving, rng.uniform(0.5, 1.0, segments_count), 0.0)
+    speeds *= speed_mps
+    headings = rng.uniform(0, 2 * np.pi, segments_count)
+    return ends_ns, speeds, headings
+
+
+def get_intervals(rng, count, duration_ns, min_s, max_s):
+    # non overlapping random intervals within the shift, as sorted starts and
+    # ends
+    starts = np.sort(rng.uniform(0, duration_ns, count)).astype(np.int64)
+    lengths = (rng.uniform(min_s, max_s, count) * 1e9).astype(np.int64)
+    ends = starts + lengths
+    ends[:-1] = np.minimum(ends[:-1], starts[1:])
+    return starts, ends
+
+
+def get_interval_indexes(starts, ends, times):
+    # index of the interval every time is in, -1 outside of them
+    indexes = np.searchsorted(starts, times, side="right") - 1
+    if len(starts) == 0:
+        return indexes
+    is_inside = (indexes >= 0) & (times < ends[np.maximum(indexes, 0)])
+    return np.where(is_inside, indexes, -1)
+
+
+def generate_shift_chunks(
+    start_ns,
+    duration_s=12 * 3600,
+    pose_rate_hz=15.0,
+    mean_drive_s=120.0,
+    mean_stop_s=90.0,
+    speed_mps=1.5,
+    gaps_count=5,
+    gap_range_s=(3.0, 1200.0),
+    frame_switches_count=4,
+    frame_switch_range_s=(30.0, 600.0),
+    area=(0.0, 200.0, 50.0, 250.0),
+    noise_m=0.005,
+    seed=0,
+    chunk_size=1000000,
+):
+    # Yields DataFrames of consecutive poses of one shift. The forklift drives
+    # straight at a constant speed and stops in turns. During gaps there are
+    # no poses. During frame switches the poses are in an odometry frame with
+    # its own index and a random offset.
+    rng = np.random.default_rng(seed)
+    duration_ns = int(duration_s * 1e9)
+    pose_interval_ns = 1e9 / pose_rate_hz
+    segment_ends_ns, speeds, headings = get_segments(
+        rng, duration_ns, mean_drive_s, mean_stop_s, speed_mps
+    )
+    # position at the start of every segment, unbounded before folding
+    segment_durations_s = np.diff(segment_ends_ns, prepend=0) / 1e9
+    segment_starts_x = np.concatenate(
+        [[0.0], np.cumsum(speeds * np.cos(headings) * segment_durations_s)[:-1]]
+    )
+    segment_starts_y = np.concatenate(
+        [[0.0], np.cumsum(speeds * np.sin(headings) * segment_durations_s)[:-1]]
+    )
+    start_x = rng.uniform(area[0], area[1])
+    start_y = rng.uniform(area[2], area[3])
+    gap_starts, gap_ends = get_intervals(rng, gaps_count, duration_ns, *gap_range_s)
+    switch_starts, switch_ends = get_intervals(
+        rng, frame_switches_count, duration_ns, *frame_switch_range_s
+    )
+    switch_offsets = rng.uniform(-50, 50, (frame_switches_count, 2))
+
+    time_ns = 0
+    while time_ns < duration_ns:
+        intervals = pose_interval_ns * rng.uniform(0.9, 1.1, chunk_size)
+        times = time_ns + np.cumsum(intervals).astype(np.int64)
+        times = times[times < duration_ns]
+        if len(times) == 0:
+            break
+        time_ns = int(times[-1])
+        in_gap = get_interval_indexes(gap_starts, gap_ends, times) >= 0
+        times = times[~in_gap]
+        if len(times) == 0:
+            continue
+
+        segments = np.minimum(
+            np.searchsorted(segment_ends_ns, times, side="right"), len(speeds) - 1
+        )
+        segment_starts_ns = np.where(
+            segments > 0, segment_ends_ns[np.maximum(segments - 1, 0)], 0
+        )
+        elapsed_s = (times - segment_starts_ns) / 1e9
+        distances = speeds[segments] * elapsed_s
+        x = fold(
+            start_x
+            + segment_starts_x[segments]
+            + distances * np.cos(headings[segments]),
+            area[0],
+            area[1],
+        )
+        y = fold(
+            start_y
+            + segment_starts_y[segments]
+            + distances * np.sin(headings[segments]),
+            area[2],
+            area[3],
+        )
+        x += rng.normal(0, noise_m, len(times))
+        y += rng.normal(0, noise_m, len(times))
+
+        switches = get_interval_indexes(switch_starts, switch_ends, times)
+        in_switch = switches >= 0
+        x[in_switch] += switch_offsets[switches[in_switch], 0]
+        y[in_switch] += switch_offsets[switches[in_switch], 1]
+        categories = np.where(in_switch, ODOMETRY_CATEGORY, FIDUCIAL_WORLD_CATEGORY)
+        frame_indexes = np.where(in_switch, switches + 1, 0)
+
+        yaws = headings[segments]
+        acq_timestamps = start_ns + times
+        yield pandas.DataFrame(
+            {
+                "acq_timestamp [ns]": acq_timestamps,
+                "ref_timestamp [ns]": acq_timestamps,
+                "t_x [m]": x,
+                "t_y [m]": y,
+                "t_z [m]": np.zeros(len(times)),
+                "q_x": np.zeros(len(times)),
+                "q_y": np.zeros(len(times)),
+                "q_z": np.sin(yaws / 2),
+                "q_w": np.cos(yaws / 2),
+                "reference_frame_category": categories,
+                "reference_frame_index": frame_indexes,
+            },
+            columns=SHIFT_CSV_COLUMNS,
+        )
+
+
+def get_shift_start_ns(date, shift_type):
+    # local time, as the shift windows of util.get_shift_time
+    start = datetime.datetime.strptime(date, "%Y%m%d").replace(
+        hour=SHIFT_START_HOURS[shift_type]
+    )
+    return int(start.timestamp()) * int(1e9)
+
+
+def get_shift_file_name(forklift_id, date, shift_type):
+    # matches ingest_all.SHIFT_FILE_PATTERN
+    return f"{forklift_id}_shift_{date}_{SHIFT_START_HOURS[shift_type]:02d}00.csv"
+
+
+def write_shift_csv(csv_path, start_ns, **kwargs):
+    rows_count = 0
+    for chunk_index, chunk in enumerate(generate_shift_chunks(start_ns, **kwargs)):
+        chunk.to_csv(
+            csv_path,
+            mode="w" if chunk_index == 0 else "a",
+            header=chunk_index == 0,
+            index=False,
+            float_format="%.6f",
+        )
+        rows_count += len(chunk)
+    return rows_count
+
+
+def generate_zones(area=(0.0, 200.0, 50.0, 250.0), rows=4, columns=4):
+    # a grid of zones covering the area, as x_min, x_max, y_min, y_max, name
+    x_edges = np.linspace(area[0], area[1], columns + 1)
+    y_edges = np.linspace(area[2], area[3], rows + 1)
+    return [
+        (
+            x_edges[column],
+            x_edges[column + 1],
+            y_edges[row],
+            y_edges[row + 1],
+            f"Zone-{row * columns + column + 1}",
+        )
+        for row in range(rows)
+        for column in range(columns)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir")
+    parser.add_argument("--forklifts", type=int, default=1)
+    parser.add_argument("--date", default="20241125", help="YYYYMMDD")
+    parser.add_argument("--shift_type", choices=["day", "night"], default="day")
+    parser.add_argument("--hours", type=float, default=12.0)
+    parser.add_argument("--pose_rate", type=float, default=15.0)
+    parser.add_argument("--gaps", type=int, default=5)
+    parser.add_argument("--frame_switches", type=int, default=4)
+    parser.add_argument("--mean_stop", type=float, default=90.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for forklift_id in range(1, args.forklifts + 1):
+        csv_path = os.path.join(
+            args.output_dir,
+            get_shift_file_name(forklift_id, args.date, args.shift_type),
+        )
+        rows_count = write_shift_csv(
+            csv_path,
+            get_shift_start_ns(args.date, args.shift_type),
+            duration_s=args.hours * 3600,
+            pose_rate_hz=args.pose_rate,
+            gaps_count=args.gaps,
+            frame_switches_count=args.frame_switches,
+            mean_stop_s=args.mean_stop,
+            seed=args.seed + forklift_id,
+        )
+        print(f"Wrote {rows_count} poses to {csv_path}")
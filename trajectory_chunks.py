@@ -0,0 +1,200 @@
+import numpy as np
+import zstandard
+
+# Compact long-term storage of the trajectory: the rows of one forklift within
+# one minute are packed into a chunk, a zstandard compressed BLOB of
+# delta-encoded, quantized columns, about a sixth of the size of the rows with
+# their indexes.
+# Every chunk has its time range and bounding box in trajectory_chunks and an
+# R-tree, so readers only decompress the chunks a query touches.
+#
+# Quantization steps: positions 1 mm, headings 1e-4, velocities 1 mm/s,
+# durations 1 us. Times are exact.
+
+CHUNK_NS = 60 * 1000000000
+POSITION_STEP_M = 0.001
+HEADING_STEP = 0.0001
+VELOCITY_STEP = 0.001
+DURATION_STEP_S = 0.000001
+ZSTD_LEVEL = 3
+# the columns of a chunk after the time deltas, in the order they are packed
+CHUNK_DTYPES = [
+    ("time_ns", np.int64),
+    ("x", np.int32),
+    ("y", np.int32),
+    ("heading_x", np.int16),
+    ("heading_y", np.int16),
+    ("velocity_meters_per_second", np.int32),
+    ("duration_s", np.int32),
+    ("zone_id", np.int32),
+]
+
+
+def create_trajectory_chunks_table(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS trajectory_chunks(id integer primary key, forklift_id int not null, start_ns int not null, end_ns int not null, x_min float, x_max float, y_min float, y_max float, rows_count int, data blob)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS trajectory_chunks_forklift_time_index ON trajectory_chunks(forklift_id, start_ns)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS trajectory_chunks_time_index ON trajectory_chunks(start_ns)"
+    )
+    cur.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS trajectory_chunks_rtree USING rtree(id, x_min, x_max, y_min, y_max)"
+    )
+
+
+def quantize(values, step):
+    return np.round(np.nan_to_num(np.asarray(values, dtype=np.float64)) / step)
+
+
+def encode_chunk(
+    timestamps, x, y, heading_x, heading_y, velocities_abs, durations_s, zone_ids
+):
+    # times and positions are stored as differences to the previous row, the
+    # first time relative to the start of the chunk
+    columns = [
+        np.diff(timestamps, prepend=timestamps[0]),
+        np.diff(quantize(x, POSITION_STEP_M), prepend=0),
+        np.diff(quantize(y, POSITION_STEP_M), prepend=0),
+        quantize(heading_x, HEADING_STEP),
+        quantize(heading_y, HEADING_STEP),
+        quantize(velocities_abs, VELOCITY_STEP),
+        quantize(durations_s, DURATION_STEP_S),
+        zone_ids,
+    ]
+    data = b"".join(
+        np.asarray(column).astype(dtype).tobytes()
+        for column, (_, dtype) in zip(columns, CHUNK_DTYPES)
+    )
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def decode_chunk(data, start_ns, rows_count):
+    # the columns of CHUNK_DTYPES as time_ns int64, zone_id int64 with -1
+    # outside of the zones and float64 values
+    data = zstandard.ZstdDecompressor().decompress(data)
+    columns = {}
+    offset = 0
+    for name, dtype in CHUNK_DTYPES:
+        column = np.frombuffer(data, dtype=dtype, count=rows_count, offset=offset)
+        offset += column.nbytes
+        columns[name] = column
+    columns["time_ns"] = start_ns + np.cumsum(columns["time_ns"])
+    for name in ["x", "y"]:
+        columns[name] = np.cumsum(columns[name], dtype=np.int64) * POSITION_STEP_M
+    for name in ["heading_x", "heading_y"]:
+        columns[name] = columns[name] * HEADING_STEP
+    columns["velocity_meters_per_second"] = (
+        columns["velocity_meters_per_second"] * VELOCITY_STEP
+    )
+    columns["duration_s"] = columns["duration_s"] * DURATION_STEP_S
+    columns["zone_id"] = columns["zone_id"].astype(np.int64)
+    return columns
+
+
+def insert_trajectory_chunks(
+    cur,
+    forklift_id,
+    velocity_timestamps,
+    coordinates,
+    headings,
+    velocities_abs,
+    durations_s,
+    zone_ids,
+):
+    # rows sorted by time, zone_ids -1 outside of the zones
+    if len(velocity_timestamps) == 0:
+        return 0
+    velocity_timestamps = np.asarray(velocity_timestamps, dtype=np.int64)
+    minutes = velocity_timestamps // CHUNK_NS
+    chunk_starts = np.flatnonzero(np.diff(minutes, prepend=minutes[0] - 1))
+    chunk_ends = np.append(chunk_starts[1:], len(minutes))
+    (max_id,) = cur.execute("SELECT max(id) FROM trajectory_chunks").fetchone()
+    chunks = []
+    for chunk_id, (first, last) in enumerate(
+        zip(chunk_starts, chunk_ends), start=(max_id or 0) + 1
+    ):
+        x = coordinates[first:last, 0]
+        y = coordinates[first:last, 1]
+        chunks.append(
+            (
+                chunk_id,
+                forklift_id,
+                int(velocity_timestamps[first]),
+                int(velocity_timestamps[last - 1]),
+                float(x.min()),
+                float(x.max()),
+                float(y.min()),
+                float(y.max()),
+                int(last - first),
+                encode_chunk(
+                    velocity_timestamps[first:last],
+                    x,
+                    y,
+                    headings[first:last, 0],
+                    headings[first:last, 1],
+                    velocities_abs[first:last],
+                    durations_s[first:last],
+                    zone_ids[first:last],
+                ),
+            )
+        )
+    cur.executemany(
+        "INSERT INTO trajectory_chunks(id, forklift_id, start_ns, end_ns, x_min, "
+        "x_max, y_min, y_max, rows_count, data) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        chunks,
+    )
+    cur.executemany(
+        "INSERT INTO trajectory_chunks_rtree(id, x_min, x_max, y_min, y_max) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [chunk[:1] + chunk[4:8] for chunk in chunks],
+    )
+    return len(chunks)
+
+
+def delete_trajectory_chunks(cur, forklift_id, start_ns, end_ns):
+    # chunks of the forklift starting in start_ns <= time_ns <= end_ns
+    parameters = (forklift_id, start_ns, end_ns)
+    cur.execute(
+        "DELETE FROM trajectory_chunks_rtree WHERE id IN (SELECT id FROM "
+        "trajectory_chunks WHERE forklift_id = ? AND start_ns >= ? AND start_ns <= ?)",
+        parameters,
+    )
+    cur.execute(
+        "DELETE FROM trajectory_chunks WHERE forklift_id = ? "
+        "AND start_ns >= ? AND start_ns <= ?",
+        parameters,
+    )
+
+
+def read_chunked_trajectory(cur, start_ns, end_ns, forklift_ids=None, bounds=None):
+    # Yields the forklift_id and decoded columns of every chunk with rows in
+    # [start_ns, end_ns), and overlapping bounds (x_min, x_max, y_min, y_max)
+    # if given, cut to the rows in the time range.
+    query = (
+        "SELECT id, forklift_id, start_ns, rows_count, data FROM trajectory_chunks "
+        "WHERE start_ns >= ? AND start_ns < ? AND end_ns >= ?"
+    )
+    # a chunk spans less than CHUNK_NS, so its start is within the index range
+    parameters = [int(start_ns) - CHUNK_NS, int(end_ns), int(start_ns)]
+    if forklift_ids:
+        query += f" AND forklift_id IN ({', '.join('?' * len(forklift_ids))})"
+        parameters += list(forklift_ids)
+    if bounds is not None:
+        query += (
+            " AND id IN (SELECT id FROM trajectory_chunks_rtree "
+            "WHERE x_max >= ? AND x_min <= ? AND y_max >= ? AND y_min <= ?)"
+        )
+        parameters += [bounds[0], bounds[1], bounds[2], bounds[3]]
+    query += " ORDER BY forklift_id, start_ns"
+    for _, forklift_id, chunk_start_ns, rows_count, data in cur.execute(
+        query, parameters
+    ).fetchall():
+        columns = decode_chunk(data, chunk_start_ns, rows_count)
+        mask = (columns["time_ns"] >= start_ns) & (columns["time_ns"] < end_ns)
+        if not mask.all():
+            columns = {name: column[mask] for name, column in columns.items()}
+        yield forklift_id, columns
@@ -1,5 +1,77 @@
 import datetime
+import itertools
+from typing import NamedTuple
 import numpy as np
+import pandas
+import segmentation
+from downsampling import StrideDownsampling, get_pose_breaks, parse_downsampling
+
+FIDUCIAL_WORLD_CATEGORY = "ReferenceFrameCategory.FiducialWorld"
+CATEGORY_COLUMN = "reference_frame_category"
+# a code no category has, e.g. for a category missing from a shift
+NO_CATEGORY_CODE = -2
+
+# the only columns of a shift CSV used by the pipeline
+SHIFT_CSV_DTYPES = {
+    "acq_timestamp [ns]": np.int64,
+    "t_x [m]": np.float64,
+    "t_y [m]": np.float64,
+    CATEGORY_COLUMN: "category",
+    "reference_frame_index": np.int64,
+}
+
+
+class ShiftFrame(NamedTuple):
+    # The poses of a chunk of a shift CSV as contiguous arrays: times in
+    # int64 nanoseconds, positions in float64 or float32, and the reference
+    # frame category as int8 codes into categories, the lookup table shared by
+    # all frames of a shift, -1 where missing.
+    timestamps: np.ndarray
+    t_x: np.ndarray
+    t_y: np.ndarray
+    category_codes: np.ndarray
+    frame_indexes: np.ndarray
+    categories: list
+
+    def get_category_code(self, category):
+        return get_category_code(self.categories, category)
+
+
+def get_category_code(categories, category):
+    if category in categories:
+        return categories.index(category)
+    return NO_CATEGORY_CODE
+
+
+def encode_categories(values, categories, dtype=np.int8):
+    # codes of the category values into categories, a dict of category to
+    # code extended by the categories seen first
+    values = pandas.Series(values).astype("category")
+    chunk_codes = np.array(
+        [
+            categories.setdefault(category, len(categories))
+            for category in values.cat.categories
+        ]
+        + [-1],
+        dtype=np.int64,
+    )
+    if len(categories) > np.iinfo(dtype).max:
+        raise ValueError(f"More than {np.iinfo(dtype).max} reference frame categories")
+    # code -1 (missing) stays -1
+    return chunk_codes.astype(dtype)[values.cat.codes.to_numpy()]
+
+
+def get_shift_frame(chunk, categories, positions_dtype=np.float64):
+    # ShiftFrame of a DataFrame of read_shift_csv_chunks, categories as for
+    # encode_categories
+    return ShiftFrame(
+        np.ascontiguousarray(chunk["acq_timestamp [ns]"].to_numpy(np.int64)),
+        np.ascontiguousarray(chunk["t_x [m]"].to_numpy(positions_dtype)),
+        np.ascontiguousarray(chunk["t_y [m]"].to_numpy(positions_dtype)),
+        encode_categories(chunk[CATEGORY_COLUMN], categories),
+        np.ascontiguousarray(chunk["reference_frame_index"].to_numpy(np.int64)),
+        list(categories),
+    )
 
 
 def get_shift_time(timestamps, shift_type):
@@ -25,85 +97,213 @@ def get_shift_time(timestamps, shift_type):
     return shift_start, shift_end
 
 
+def read_shift_csv_chunks(csv_path, chunk_size=1000000):
+    # only the columns used by the pipeline are parsed, so memory per chunk is
+    # fixed regardless of the shift length
+    return pandas.read_csv(
+        csv_path,
+        usecols=list(SHIFT_CSV_DTYPES.keys()),
+        dtype=SHIFT_CSV_DTYPES,
+        chunksize=chunk_size,
+    )
+
+
+def read_shift_csv_frames(csv_path, chunk_size=1000000, positions_dtype=np.float64):
+    # the chunks of read_shift_csv_chunks as ShiftFrames
+    categories = {}
+    for chunk in read_shift_csv_chunks(csv_path, chunk_size):
+        yield get_shift_frame(chunk, categories, positions_dtype)
+
+
+def get_pair_velocities(
+    timestamps, t_x, t_y, ref_frame_cat, ref_frame_ind, continuous_mask=None
+):
+    # continuous_mask overrides the continuity of consecutive poses, which is
+    # otherwise judged on the given poses alone. ref_frame_cat are category
+    # codes.
+    if continuous_mask is None:
+        correct_velocity_mask = (
+            (timestamps[1:] - timestamps[:-1] < 2 * 1e9)
+            & (ref_frame_cat[1:] == ref_frame_cat[:-1])
+            & (ref_frame_ind[1:] == ref_frame_ind[:-1])
+        )
+    else:
+        correct_velocity_mask = continuous_mask
+    # the differences are only computed for the continuous pairs
+    starts = np.flatnonzero(correct_velocity_mask)
+    ends = starts + 1
+    dx = t_x[ends] - t_x[starts]
+    dy = t_y[ends] - t_y[starts]
+    displacements = np.sqrt(dx * dx + dy * dy)
+    nonzero_velocities_mask = displacements > 0.01
+    headings = np.zeros((len(starts), 2), dtype=dx.dtype)
+    headings[nonzero_velocities_mask, 0] = (
+        dx[nonzero_velocities_mask] / displacements[nonzero_velocities_mask]
+    )
+    headings[nonzero_velocities_mask, 1] = (
+        dy[nonzero_velocities_mask] / displacements[nonzero_velocities_mask]
+    )
+    velocity_timestamps = timestamps[starts]
+    # meters per second, the kept poses are not evenly spaced in time
+    durations_s = (timestamps[ends] - velocity_timestamps) / 1e9
+    velocities_abs = np.divide(
+        displacements,
+        durations_s,
+        out=np.zeros(len(starts)),
+        where=durations_s > 0,
+    )
+    return velocities_abs, headings, velocity_timestamps, correct_velocity_mask
+
+
 def get_velocities(df, time_subsampling_rate):
-    timestamps = df["acq_timestamp [ns]"].array[::time_subsampling_rate]
-    t_x = df["t_x [m]"].array[::time_subsampling_rate]
-    t_y = df["t_y [m]"].array[::time_subsampling_rate]
-    data_mask = np.zeros((len(df["t_x [m]"].array)), dtype=bool)
+    frame = get_shift_frame(df, {})
+    timestamps = frame.timestamps[::time_subsampling_rate]
+    t_x = frame.t_x[::time_subsampling_rate]
+    t_y = frame.t_y[::time_subsampling_rate]
+    data_mask = np.zeros(len(frame.timestamps), dtype=bool)
     data_mask[::time_subsampling_rate] = True
     data_mask[0] = False
-    dx = t_x[1:] - t_x[:-1]
-    dy = t_y[1:] - t_y[:-1]
-    dt = timestamps[1:] - timestamps[:-1]
-    continuous_diffs_mask = dt < 2 * 1e9
-    ref_frame_cat = df["reference_frame_category"].array[::time_subsampling_rate]
-    ref_frame_ind = df["reference_frame_index"].array[::time_subsampling_rate]
-    same_reference_frame_mask = (ref_frame_cat[1:] == ref_frame_cat[:-1]) * (
-        ref_frame_ind[1:] == ref_frame_ind[:-1]
+    ref_frame_cat = frame.category_codes[::time_subsampling_rate]
+    ref_frame_ind = frame.frame_indexes[::time_subsampling_rate]
+    velocities_abs, headings, velocity_timestamps, correct_velocity_mask = (
+        get_pair_velocities(timestamps, t_x, t_y, ref_frame_cat, ref_frame_ind)
     )
-    correct_velocity_mask = continuous_diffs_mask * same_reference_frame_mask
-    velocities_abs = np.sqrt(dx * dx + dy * dy)
-    headings_unnorm = np.stack(
-        [dx[correct_velocity_mask], dy[correct_velocity_mask]], axis=1
-    )
-    velocities_abs = velocities_abs[correct_velocity_mask]
-    nonzero_velocities_mask = velocities_abs > 0.01
-    headings = np.zeros_like(headings_unnorm)
-    headings[nonzero_velocities_mask] = headings_unnorm[
-        nonzero_velocities_mask
-    ] / np.linalg.norm(headings_unnorm[nonzero_velocities_mask], axis=1).reshape(-1, 1)
-    velocity_timestamps = timestamps[:-1][correct_velocity_mask]
 
     data_mask[data_mask] = correct_velocity_mask
 
     return velocities_abs, headings, velocity_timestamps, data_mask
 
 
-def get_activity_periods(min_time_interval_ns, shift_start, shift_end, timestamps):
-    previous_timestamp = int(shift_start.timestamp()) * int(1e9)
-    previous_recorded_timestamp = None
-    time_periods = []
-    for ts in timestamps:
-        if ts - previous_timestamp > min_time_interval_ns:
-            # let's make a record of an inactivity period > min_time_interval_ns
-            if previous_recorded_timestamp is not None:
-                time_periods.append(
-                    (previous_recorded_timestamp, previous_timestamp, 1)
-                )
-            time_periods.append((previous_timestamp, ts, 0))
-            previous_recorded_timestamp = ts
-        previous_timestamp = ts
-
-    last_timestamp = int(shift_end.timestamp()) * int(1e9)
-    if previous_timestamp < last_timestamp:
-        if previous_recorded_timestamp is not None:
-            time_periods.append((previous_recorded_timestamp, previous_timestamp, 1))
-        time_periods.append((previous_timestamp, last_timestamp, 0))
-
-    return time_periods
-
-
-def get_stopping_locations(df, data_mask, velocities, static_threshold_m):
-    timestamps = df["acq_timestamp [ns]"].array[data_mask]
-    static_mask = velocities < static_threshold_m
-    t_x = df["t_x [m]"].array[data_mask]
-    t_y = df["t_y [m]"].array[data_mask]
-    stop_records = []
-    stop_started = None
-    stop_finished = None
-    s_x = None
-    s_y = None
-    for i, ts in enumerate(timestamps):
-        if static_mask[i]:
-            if stop_started is None:
-                stop_started = ts
-                s_x = t_x[i]
-                s_y = t_y[i]
-            stop_finished = ts
+def take_sample(values, indices, previous_value):
+    # values[indices] after previous_value if not None, in one copy
+    offset = 0 if previous_value is None else 1
+    sample = np.empty(len(indices) + offset, dtype=values.dtype)
+    if previous_value is not None:
+        sample[0] = previous_value
+    np.take(values, indices, out=sample[offset:])
+    return sample
+
+
+def get_velocities_chunked(frames, downsampling=15):
+    # Yields, for every ShiftFrame, the same values get_velocities computes
+    # for the whole file. Instead of data_mask, the poses selected by
+    # data_mask are returned directly: their timestamps, coordinates and
+    # whether they are in the fiducial world frame, followed by the seconds
+    # every velocity is averaged over. downsampling is a rate, a spec like
+    # error:0.1 or an object of downsampling.py, which carries its state over
+    # to the next frame, as are the last kept pose and the poses it has not
+    # decided on yet, which are yielded with the next frame or after the last.
+    if isinstance(downsampling, str):
+        downsampling = parse_downsampling(downsampling)
+    elif isinstance(downsampling, (int, np.integer)):
+        downsampling = StrideDownsampling(downsampling)
+    previous_sample = None
+    previous_pose = None
+    carried = None
+    categories = []
+    for frame in itertools.chain(frames, [None]):
+        is_last = frame is None
+        if is_last:
+            values = carried
         else:
-            if stop_started is not None:
-                stop_records.append((stop_started, stop_finished, s_x, s_y))
-                stop_started = None
-    if stop_started is not None:
-        stop_records.append((stop_started, stop_finished, s_x, s_y))
-    return stop_records
+            values = frame[:5]
+            categories = frame.categories
+            if carried is not None and len(carried[0]) > 0:
+                values = [
+                    np.concatenate([carried_value, value])
+                    for carried_value, value in zip(carried, values)
+                ]
+        if values is None or len(values[0]) == 0:
+            continue
+        timestamps, t_x, t_y, category_codes, frame_indexes = values
+        breaks = None
+        if downsampling.is_continuity_from_poses:
+            breaks = get_pose_breaks(
+                timestamps, category_codes, frame_indexes, previous_pose
+            )
+        indices, decided_count = downsampling.select(
+            timestamps, t_x, t_y, breaks, is_last
+        )
+        carried = [value[decided_count:] for value in values]
+        if decided_count > 0:
+            previous_pose = (
+                timestamps[decided_count - 1],
+                category_codes[decided_count - 1],
+                frame_indexes[decided_count - 1],
+            )
+        if len(indices) == 0:
+            continue
+        sample = [
+            take_sample(
+                value,
+                indices,
+                None if previous_sample is None else previous_sample[column],
+            )
+            for column, value in enumerate(values)
+        ]
+        continuous_mask = None
+        if breaks is not None:
+            break_counts = np.cumsum(breaks)[indices]
+            if previous_sample is not None:
+                break_counts = np.concatenate([[0], break_counts])
+            continuous_mask = break_counts[1:] == break_counts[:-1]
+        previous_sample = [value[-1] for value in sample]
+        timestamps, t_x, t_y, ref_frame_cat, ref_frame_ind = sample
+
+        velocities_abs, headings, velocity_timestamps, correct_velocity_mask = (
+            get_pair_velocities(
+                timestamps, t_x, t_y, ref_frame_cat, ref_frame_ind, continuous_mask
+            )
+        )
+        pose_rows = np.flatnonzero(correct_velocity_mask) + 1
+        pose_timestamps = timestamps[pose_rows]
+        coordinates = np.empty((len(pose_rows), 2), dtype=t_x.dtype)
+        np.take(t_x, pose_rows, out=coordinates[:, 0])
+        np.take(t_y, pose_rows, out=coordinates[:, 1])
+        fid_world_mask = ref_frame_cat[pose_rows] == get_category_code(
+            categories, FIDUCIAL_WORLD_CATEGORY
+        )
+        yield (
+            velocities_abs,
+            headings,
+            velocity_timestamps,
+            pose_timestamps,
+            coordinates,
+            fid_world_mask,
+            (pose_timestamps - velocity_timestamps) / 1e9,
+        )
+
+
+def concatenate_velocity_chunks(velocity_chunks):
+    velocity_chunks = list(velocity_chunks)
+    if len(velocity_chunks) == 0:
+        return (
+            np.zeros(0),
+            np.zeros((0, 2)),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=np.int64),
+            np.zeros((0, 2)),
+            np.zeros(0, dtype=bool),
+            np.zeros(0),
+        )
+    return tuple(np.concatenate(values) for values in zip(*velocity_chunks))
+
+
+def get_activity_periods(min_time_interval_ns, shift_start, shift_end, timestamps):
+    starts, ends, statuses = segmentation.get_activity_periods(
+        min_time_interval_ns,
+        int(shift_start.timestamp()) * int(1e9),
+        int(shift_end.timestamp()) * int(1e9),
+        timestamps,
+    )
+    return list(zip(starts.tolist(), ends.tolist(), statuses.tolist()))
+
+
+def get_stopping_locations(df, data_mask, velocities, static_velocity_m_s):
+    timestamps = df["acq_timestamp [ns]"].to_numpy()[data_mask]
+    t_x = df["t_x [m]"].to_numpy()[data_mask]
+    t_y = df["t_y [m]"].to_numpy()[data_mask]
+    starts, ends, s_x, s_y = segmentation.get_stopping_locations(
+        timestamps, t_x, t_y, velocities[: len(timestamps)], static_velocity_m_s
+    )
+    return list(zip(starts, ends, s_x, s_y))
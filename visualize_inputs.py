@@ -1,24 +1,31 @@
-import pandas
 import numpy as np
 import matplotlib.pyplot as plt
 import argparse
 import datetime, timedelta
 import cv2
-import slamcore
-
-from matplotlib.backend_bases import MouseButton
 
 from util import (
+    FIDUCIAL_WORLD_CATEGORY,
     get_shift_time,
     get_activity_periods,
-    get_velocities,
-    get_stopping_locations,
+    get_velocities_chunked,
+    concatenate_velocity_chunks,
+)
+from segmentation import STATIC_VELOCITY_M_S, get_stopping_locations
+from downsampling import parse_downsampling
+from floorplan import get_meter_to_unit
+from annotation import ZoneAnnotator, open_zones_database
+from shift_cache import get_default_cache_dir, read_shift_chunks
+from heatmap import (
+    METRICS,
+    accumulate_grids,
+    build_pyramid,
+    create_grids,
+    get_bounds_grid,
+    get_floorplan_grid,
+    get_plot_coordinates,
+    show_heatmap,
 )
-
-
-def get_meter_to_unit(session_path):
-    session = slamcore.load_session_file(str(session_path))
-    return session.floor_plan.unit_to_meters
 
 
 def scatter_on_floorplan(x, y, s, c, meter_to_pixel, floorplan_height_pix):
@@ -39,36 +46,90 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--shift_type", choices=["day", "night"], required=True)
     parser.add_argument("-m", "--map_session")
     parser.add_argument("-f", "--floorplan")
-    parser.add_argument("-o", "--output")
+    parser.add_argument("-o", "--output", help="zones CSV the zones are appended to")
+    parser.add_argument(
+        "--zones_db", help="database the zones are inserted into as they are drawn"
+    )
+    parser.add_argument("--cache_dir", default=get_default_cache_dir())
+    parser.add_argument(
+        "--no_cache", action="store_true", help="parse the CSV without caching it"
+    )
+    parser.add_argument(
+        "--downsampling",
+        default="stride:15",
+        help="stride:RATE, time:SECONDS or error:METERS, see downsampling.py",
+    )
+    parser.add_argument(
+        "--render",
+        choices=["scatter", "heatmap"],
+        default="scatter",
+        help="the trajectory as points or as a heatmap, see heatmap.py",
+    )
+    parser.add_argument("--metric", choices=METRICS, default="dwell")
+    parser.add_argument(
+        "--cell_size",
+        type=float,
+        default=0.1,
+        help="meters per heatmap cell, without a floorplan",
+    )
     args = parser.parse_args()
+    try:
+        parse_downsampling(args.downsampling)
+    except ValueError as e:
+        parser.error(str(e))
 
     meter_to_unit = get_meter_to_unit(args.map_session)
 
-    path_to_file = args.csv_path
-    df = pandas.read_csv(path_to_file, dtype={"acq_timestamp [ns]": np.int64})
-    print(df.columns)
-
-    print(np.unique(df["reference_frame_category"]))
-    fid_world_mask = (
-        df["reference_frame_category"] == "ReferenceFrameCategory.FiducialWorld"
-    )
-    print(f"Fiduial world poses: {np.sum(fid_world_mask)} out of {len(fid_world_mask)}")
-
-    timestamps = df["acq_timestamp [ns]"].array
-    time_intervals = timestamps[1:] - timestamps[:-1]
-    print(time_intervals[10])
-    print(f"Median time between poses {np.median(time_intervals) / 1e9}")
-
     # data processing params
-    time_subsampling_rate = 15
-    static_threshold_m = 0.05
     min_time_interval_ns = 600 * 1e9
+    chunk_size = 1000000
     # data processing starts here
-    velocities_abs, headings, velocity_timestamps, data_mask = get_velocities(
-        df, time_subsampling_rate
+    chunk_stats = {"poses": 0, "fid_world_poses": 0, "categories": set()}
+
+    def inspect_chunks(frames):
+        for frame in frames:
+            if chunk_stats["poses"] == 0:
+                timestamps = frame.timestamps
+                chunk_stats["first_timestamp"] = timestamps[0]
+                time_intervals = timestamps[1:] - timestamps[:-1]
+                print(f"Median time between poses {np.median(time_intervals) / 1e9}")
+            chunk_stats["poses"] += len(frame.timestamps)
+            chunk_stats["fid_world_poses"] += np.sum(
+                frame.category_codes == frame.get_category_code(FIDUCIAL_WORLD_CATEGORY)
+            )
+            chunk_stats["categories"].update(
+                frame.categories[code]
+                for code in np.unique(frame.category_codes)
+                if code >= 0
+            )
+            yield frame
+
+    (
+        velocities_abs,
+        headings,
+        velocity_timestamps,
+        pose_timestamps,
+        pose_coordinates,
+        fid_world_mask,
+        durations_s,
+    ) = concatenate_velocity_chunks(
+        get_velocities_chunked(
+            inspect_chunks(
+                read_shift_chunks(
+                    args.csv_path,
+                    chunk_size,
+                    None if args.no_cache else args.cache_dir,
+                )
+            ),
+            args.downsampling,
+        )
+    )
+    print(sorted(chunk_stats["categories"]))
+    print(
+        f"Fiduial world poses: {chunk_stats['fid_world_poses']} out of {chunk_stats['poses']}"
     )
 
-    static_mask = velocities_abs < static_threshold_m
+    static_mask = velocities_abs < STATIC_VELOCITY_M_S
     dynamic_mask = np.invert(static_mask)
 
     print(f"Static {np.sum(static_mask)} out of {len(static_mask)}")
@@ -90,7 +151,9 @@ if __name__ == "__main__":
         latest_time_str = latest_time.strftime(date_time_format)
         print(f"Active from {earliest_time_str} to {latest_time_str}")
 
-    shift_start, shift_end = get_shift_time(timestamps[0], args.shift_type)
+    shift_start, shift_end = get_shift_time(
+        chunk_stats["first_timestamp"], args.shift_type
+    )
     shift_start_str = shift_start.strftime(date_time_format)
     shift_end_str = shift_end.strftime(date_time_format)
     print(f"Shift from {shift_start_str} to {shift_end_str}")
@@ -116,10 +179,18 @@ if __name__ == "__main__":
     plt.plot(activity_status_time, activity_status_value)
 
     # visualize stopping moments
-    fid_world_data_mask = np.copy(data_mask)
-    fid_world_data_mask = data_mask * fid_world_mask
-    stopping_records = get_stopping_locations(
-        df, fid_world_data_mask, velocities_abs, static_threshold_m
+    fid_world_timestamps = pose_timestamps[fid_world_mask]
+    t_x = pose_coordinates[fid_world_mask, 0]
+    t_y = pose_coordinates[fid_world_mask, 1]
+    stopping_records = zip(
+        *get_stopping_locations(
+            fid_world_timestamps,
+            t_x,
+            t_y,
+            velocities_abs[fid_world_mask],
+            STATIC_VELOCITY_M_S,
+            velocity_timestamps[fid_world_mask],
+        )
     )
     small_stop_thr = 60 * 1e9
     small_stops = []
@@ -135,6 +206,7 @@ if __name__ == "__main__":
 
     fig = plt.figure("Trajectories and stops")
 
+    ax = plt.gca()
     floorplan_height_pix = None
     if args.floorplan is not None:
         img_floorplan = cv2.imread(args.floorplan)
@@ -147,13 +219,35 @@ if __name__ == "__main__":
     all_plots = []
     all_legends = []
 
-    t_x = df["t_x [m]"][fid_world_data_mask]
-    t_y = df["t_y [m]"][fid_world_data_mask]
-    traj_plot = scatter_on_floorplan(
-        t_x, t_y, 1, "b", meter_to_pixel, floorplan_height_pix
-    )
-    all_plots.append(traj_plot)
-    all_legends.append("Trajectory")
+    if args.render == "heatmap":
+        plot_x, plot_y = get_plot_coordinates(
+            t_x, t_y, meter_to_pixel, floorplan_height_pix
+        )
+        if floorplan_height_pix is None:
+            grid = get_bounds_grid(
+                np.min(plot_x, initial=0),
+                np.max(plot_x, initial=1),
+                np.min(plot_y, initial=0),
+                np.max(plot_y, initial=1),
+                args.cell_size,
+            )
+        else:
+            grid = get_floorplan_grid(img_floorplan.shape[1], floorplan_height_pix)
+        grids = accumulate_grids(
+            create_grids(grid), grid, plot_x, plot_y, durations_s[fid_world_mask]
+        )
+        heatmap_image = show_heatmap(ax, grid, build_pyramid(grids[args.metric]))
+        fig.colorbar(
+            heatmap_image,
+            ax=ax,
+            label="trajectory points" if args.metric == "occupancy" else "seconds",
+        )
+    else:
+        traj_plot = scatter_on_floorplan(
+            t_x, t_y, 1, "b", meter_to_pixel, floorplan_height_pix
+        )
+        all_plots.append(traj_plot)
+        all_legends.append("Trajectory")
     if len(large_stops) > 0:
         large_stops = np.array(large_stops)
         large_plot = scatter_on_floorplan(
@@ -186,40 +280,12 @@ if __name__ == "__main__":
     ax = plt.gca()
     ax.set_aspect("equal", adjustable="box")
 
-    pt1_coords = None
-    output_path = args.output
-    area_list = []
-
-    def on_click(event):
-        global pt1_coords
-        global fig
-        global output_path
-        if event.button is MouseButton.LEFT:
-            print(
-                f"data coords {event.xdata} {event.ydata},",
-                f"pixel coords {event.x} {event.y}",
-            )
-            if pt1_coords is None:
-                pt1_coords = [event.xdata, event.ydata]
-            else:
-                pt2_coords = [event.xdata, event.ydata]
-                lx = np.min([pt2_coords[0], pt1_coords[0]])
-                ly = np.min([pt2_coords[1], pt1_coords[1]])
-                w = np.abs(pt2_coords[0] - pt1_coords[0])
-                h = np.abs(pt2_coords[1] - pt1_coords[1])
-                ax.add_patch(plt.Rectangle((lx, ly), w, h, fill=False))
-                print("rect ")
-                print(f"({lx}, {ly}), {w} {h}")
-                pt1_coords = None
-
-                text = input("What is the name of this area?")
-                area_list.append([lx, ly, w, h, text])
-
-                df = pandas.DataFrame(area_list)
-                df.to_csv(output_path)
-
-                fig.canvas.draw()
-
-    plt.connect("button_press_event", on_click)
+    # zones are drawn with two clicks and named by typing into the figure
+    zones_con = None
+    if args.zones_db is not None:
+        zones_con = open_zones_database(args.zones_db)
+    annotator = ZoneAnnotator(
+        ax, args.output, zones_con, meter_to_pixel, floorplan_height_pix
+    )
 
     plt.show()
@@ -0,0 +1,190 @@
+import numpy as np
+
+from partitions import get_trajectory_source
+
+# Visits of forklifts to zones: one row per continuous stay in a zone, from
+# the time of the first trajectory row in it to the end of the last one.
+# Visits are derived from the zone ids of the trajectory rows in one
+# vectorized pass, with two kinds of hysteresis against jitter at zone
+# borders:
+# - a forklift that has entered a zone only leaves it once it is more than
+#   margin_m outside the zone, so positions wobbling across the border do
+#   not split the visit,
+# - visits shorter than min_visit_s, e.g. cutting across a corner of a zone,
+#   are dropped.
+# A visit also ends at a gap of more than max_gap_s in the trajectory.
+# Visits are computed per ingested shift file, so a stay across two files is
+# two visits.
+
+ZONE_VISIT_MARGIN_M = 0.5
+MIN_ZONE_VISIT_S = 2.0
+MAX_ZONE_VISIT_GAP_S = 2.0
+
+
+def create_zone_visits_table(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS zone_visits(forklift_id int not null, zone_id int not null, enter_ns int not null, exit_ns int not null, duration_s float)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS zone_visits_zone_time_index ON zone_visits(zone_id, enter_ns)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS zone_visits_forklift_time_index ON zone_visits(forklift_id, enter_ns)"
+    )
+
+
+def forward_fill(values, is_set, first=None):
+    # values[i] replaced by the last values[j] with j <= i and is_set[j],
+    # values before the first set one are first if given, else kept
+    if first is not None:
+        return forward_fill(
+            np.concatenate([[first], values]), np.concatenate([[True], is_set])
+        )[1:]
+    indices = np.where(is_set, np.arange(len(values)), 0)
+    np.maximum.accumulate(indices, out=indices)
+    filled = values[indices]
+    if len(values) > 0 and not is_set[0]:
+        first_set = np.argmax(is_set) if is_set.any() else len(values)
+        filled[:first_set] = values[:first_set]
+    return filled
+
+
+def get_zone_states(coordinates, zone_ids, zones, margin_m, previous_state=None):
+    # The zone a forklift counts as being in at every row: the zone of the
+    # row where it is inside one, else the zone it was last inside while it
+    # stays within margin_m of that zone, else -1. zones are the rows of
+    # zones.load_zones. previous_state is the zone last inside and the state
+    # at the end of earlier rows these rows continue, if any.
+    if len(zones) == 0 or len(zone_ids) == 0:
+        return zone_ids.copy()
+    last_zone_id, state = (None, None) if previous_state is None else previous_state
+    is_inside = zone_ids >= 0
+    last_zone_ids = forward_fill(zone_ids, is_inside, last_zone_id)
+    zone_rows = np.searchsorted(zones[:, 0], last_zone_ids).clip(0, len(zones) - 1)
+    bounds = zones[zone_rows]
+    is_near = (
+        (last_zone_ids >= 0)
+        & (coordinates[:, 0] >= bounds[:, 1] - margin_m)
+        & (coordinates[:, 0] <= bounds[:, 2] + margin_m)
+        & (coordinates[:, 1] >= bounds[:, 3] - margin_m)
+        & (coordinates[:, 1] <= bounds[:, 4] + margin_m)
+    )
+    # rows inside a zone or away from the last one set the state, rows near
+    # the last zone keep it
+    is_state_set = is_inside | ~is_near
+    states = np.where(is_inside, zone_ids, -1)
+    return forward_fill(states, is_state_set, state)
+
+
+def get_zone_runs(
+    timestamps,
+    durations_s,
+    coordinates,
+    zone_ids,
+    zones,
+    margin_m=ZONE_VISIT_MARGIN_M,
+    max_gap_s=MAX_ZONE_VISIT_GAP_S,
+    previous_run=None,
+):
+    # (states, enter_ns, exit_ns) of the runs of trajectory rows sorted by
+    # time in the same state of get_zone_states without a gap, the visits
+    # before they are filtered. A row covers timestamps to timestamps +
+    # durations_s. previous_run is (zone last inside, state, enter_ns,
+    # exit_ns) of the last run of earlier rows, which the first run of these
+    # rows continues if in the same state without a gap.
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    zone_ids = np.asarray(zone_ids, dtype=np.int64)
+    if len(timestamps) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    end_ns = timestamps + (np.nan_to_num(durations_s, nan=0.0) * 1e9).astype(np.int64)
+    states = get_zone_states(
+        coordinates,
+        zone_ids,
+        zones,
+        margin_m,
+        None if previous_run is None else previous_run[:2],
+    )
+    is_run_start = np.ones(len(states), dtype=bool)
+    is_run_start[1:] = (states[1:] != states[:-1]) | (
+        timestamps[1:] - end_ns[:-1] > max_gap_s * 1e9
+    )
+    run_starts = np.flatnonzero(is_run_start)
+    run_ends = np.append(run_starts[1:], len(states)) - 1
+    enter_ns = timestamps[run_starts]
+    if previous_run is not None:
+        _, previous_state, previous_enter_ns, previous_exit_ns = previous_run
+        if (
+            states[0] == previous_state
+            and timestamps[0] - previous_exit_ns <= max_gap_s * 1e9
+        ):
+            enter_ns[0] = previous_enter_ns
+    return states[run_starts], enter_ns, end_ns[run_ends]
+
+
+def is_zone_visit(states, enter_ns, exit_ns, min_visit_s=MIN_ZONE_VISIT_S):
+    return (states >= 0) & (exit_ns - enter_ns >= min_visit_s * 1e9)
+
+
+def get_zone_visits(
+    timestamps,
+    durations_s,
+    coordinates,
+    zone_ids,
+    zones,
+    margin_m=ZONE_VISIT_MARGIN_M,
+    min_visit_s=MIN_ZONE_VISIT_S,
+    max_gap_s=MAX_ZONE_VISIT_GAP_S,
+):
+    # (zone_ids, enter_ns, exit_ns) of the visits in trajectory rows sorted by
+    # time. A row covers timestamps to timestamps + durations_s.
+    states, enter_ns, exit_ns = get_zone_runs(
+        timestamps, durations_s, coordinates, zone_ids, zones, margin_m, max_gap_s
+    )
+    is_visit = is_zone_visit(states, enter_ns, exit_ns, min_visit_s)
+    return states[is_visit], enter_ns[is_visit], exit_ns[is_visit]
+
+
+def insert_zone_visits(forklift_id, zone_visits, writer):
+    zone_ids, enter_ns, exit_ns = zone_visits
+    writer.insert(
+        "zone_visits",
+        ["forklift_id", "zone_id", "enter_ns", "exit_ns", "duration_s"],
+        [forklift_id, zone_ids, enter_ns, exit_ns, (exit_ns - enter_ns) / 1e9],
+    )
+
+
+def rebuild_zone_visits(cur, zones):
+    # from the trajectory rows already in the database, per forklift and
+    # ingested shift, as the ingest computes them
+    cur.execute("DELETE FROM zone_visits")
+    shifts = cur.execute(
+        "SELECT forklift_id, start_ns, end_ns FROM shifts ORDER BY forklift_id, start_ns"
+    ).fetchall()
+    for forklift_id, start_ns, end_ns in shifts:
+        rows = cur.execute(
+            "SELECT time_ns, coalesce(duration_s, 1.0), x, y, coalesce(zone_id, -1) "
+            f"FROM {get_trajectory_source(cur, start_ns, end_ns)} "
+            "WHERE forklift_id = ? AND time_ns >= ? AND time_ns < ? "
+            "ORDER BY time_ns",
+            (forklift_id, start_ns, end_ns),
+        ).fetchall()
+        if len(rows) == 0:
+            continue
+        # the times do not fit into float64
+        timestamps, durations_s, x, y, zone_ids = zip(*rows)
+        zone_ids, enter_ns, exit_ns = get_zone_visits(
+            np.array(timestamps, dtype=np.int64),
+            np.array(durations_s, dtype=np.float64),
+            np.stack([x, y], axis=1).astype(np.float64),
+            np.array(zone_ids, dtype=np.int64),
+            zones,
+        )
+        cur.executemany(
+            "INSERT INTO zone_visits(forklift_id, zone_id, enter_ns, exit_ns, "
+            "duration_s) VALUES (?, ?, ?, ?, ?)",
+            [
+                (forklift_id, int(zone_id), int(enter), int(exit), (exit - enter) / 1e9)
+                for zone_id, enter, exit in zip(zone_ids, enter_ns, exit_ns)
+            ],
+        )
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def create_zone_tables(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS zones(id integer primary key, x_min float, x_max float, y_min float, y_max float, name text)"
+    )
+    cur.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS zones_rtree USING rtree(id, x_min, x_max, y_min, y_max)"
+    )
+    # databases created before the R-tree existed
+    (rtree_count,) = cur.execute("SELECT count(*) FROM zones_rtree").fetchone()
+    if rtree_count == 0:
+        fill_zones_rtree(cur)
+
+
+def fill_zones_rtree(cur):
+    # rowid is the zone id, also for zones tables created without an id column
+    cur.execute("DELETE FROM zones_rtree")
+    cur.execute(
+        "INSERT INTO zones_rtree(id, x_min, x_max, y_min, y_max) "
+        "SELECT rowid, min(x_min, x_max), max(x_min, x_max), "
+        "min(y_min, y_max), max(y_min, y_max) FROM zones"
+    )
+
+
+def get_zone_bounds(minimum_x, minimum_y, w, h, meter_to_unit, floorplan_height):
+    # x_min, x_max, y_min, y_max in meters of a rectangle drawn on the
+    # floorplan image, or in meters already if floorplan_height is None
+    if floorplan_height is None:
+        return minimum_x, minimum_x + w, minimum_y, minimum_y + h
+    # the image y axis points down, so the top edge in pixels is the maximum y
+    # in meters
+    return (
+        minimum_x / meter_to_unit,
+        (minimum_x + w) / meter_to_unit,
+        (floorplan_height - (minimum_y + h)) / meter_to_unit,
+        (floorplan_height - minimum_y) / meter_to_unit,
+    )
+
+
+def load_zones(cur):
+    rows = cur.execute(
+        "SELECT rowid, min(x_min, x_max), max(x_min, x_max), "
+        "min(y_min, y_max), max(y_min, y_max) FROM zones ORDER BY rowid"
+    ).fetchall()
+    return np.array(rows, dtype=np.float64).reshape(-1, 5)
+
+
+def get_zone_ids(coordinates, zones, chunk_size=100000):
+    # Id of the zone every point lies in, -1 outside of all zones. Where zones
+    # overlap, the smallest one wins, being the most specific.
+    zone_ids = np.full(len(coordinates), -1, dtype=np.int64)
+    if len(zones) == 0:
+        return zone_ids
+    areas = (zones[:, 2] - zones[:, 1]) * (zones[:, 4] - zones[:, 3])
+    zones = zones[np.argsort(areas, kind="stable")]
+    for chunk_start in range(0, len(coordinates), chunk_size):
+        chunk = coordinates[chunk_start : chunk_start + chunk_size]
+        x = chunk[:, 0].reshape(-1, 1)
+        y = chunk[:, 1].reshape(-1, 1)
+        inside = (
+            (x >= zones[:, 1])
+            & (x <= zones[:, 2])
+            & (y >= zones[:, 3])
+            & (y <= zones[:, 4])
+        )
+        first_inside = np.argmax(inside, axis=1)
+        zone_ids[chunk_start : chunk_start + chunk_size] = np.where(
+            inside[np.arange(len(chunk)), first_inside],
+            zones[first_inside, 0].astype(np.int64),
+            -1,
+        )
+    return zone_ids